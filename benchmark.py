@@ -0,0 +1,120 @@
+#!/bin/env python2
+
+# Measures how each phase of the pipeline scales with the number of taxi trips, using synthetic trips
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import main
+import mbta_graph
+import metrics
+import read_data
+from constants import MBTA_YAML_PATH, NOT_SEEN
+from util import build_trip_index, scale_latlng
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_PATH = 'tmp/benchmark.json'
+BENCHMARK_SIZES = [10000, 100000, 1000000]
+
+# synthetic trips are drawn around downtown Boston
+BOSTON_LATLNG = (42.3555, -71.0640)
+TRIP_SPREAD = (0.03, 0.04)  # standard deviations in degrees of lat/lng, most trips are within a few km of downtown
+TRIP_START = 1338508800  # 6/1/2012
+TRIP_PERIOD = 183 * 24 * 60 * 60  # six months of trips, in seconds
+
+
+def generate_trips(n, seed=None):
+    """
+    Returns n random taxi trips around Boston as read_data.TRIP_DTYPE records.
+    Pickup times are at minute granularity like the real data, durations are log-normal around 10 min
+    with a few zero time trips.
+    """
+    rng = np.random.RandomState(seed)
+    trips = np.empty(n, dtype=read_data.TRIP_DTYPE)
+    trips['pickup'] = rng.normal(BOSTON_LATLNG, TRIP_SPREAD, size=(n, 2))
+    trips['dropoff'] = rng.normal(BOSTON_LATLNG, TRIP_SPREAD, size=(n, 2))
+    trips['pickup_time'] = TRIP_START + rng.randint(0, TRIP_PERIOD // 60, size=n) * 60
+    durations = np.round(rng.lognormal(np.log(10), 0.6, size=n)) * 60
+    durations[rng.random_sample(n) < 0.01] = 0
+    trips['dropoff_time'] = trips['pickup_time'] + durations.astype(np.int64)
+    return trips
+
+
+def benchmark(n, tmp_dir, seed=None):
+    """ Runs every phase of the pipeline on n synthetic trips, returning the metrics of each phase """
+    metrics.reset()
+    with metrics.phase('build_graph'):
+        graph, _ = mbta_graph.build_graph(MBTA_YAML_PATH)
+
+    trips_path = os.path.join(tmp_dir, 'trips-%d.bin' % n)
+    generate_trips(n, seed=seed).tofile(trips_path)
+
+    with metrics.phase('load_trips'):
+        store = read_data.load_trip_store(trips_path)
+        # copies out of the memory map, like main does for its sample
+        pickups, dropoffs, taxi_times = [np.array(column) for column in read_data.trip_store_columns(store)]
+
+    station_names, _ = mbta_graph.station_index(graph)
+    with metrics.phase('shortest_paths'):
+        t_matrix = mbta_graph.shortest_travel_times(graph, station_names)
+    station_ids = {name: i for i, name in enumerate(station_names)}
+    coords = np.array([graph.node[name]['latlng'] for name in station_names])
+    station_tree = cKDTree(scale_latlng(coords))
+
+    with metrics.phase('baseline'):
+        baseline = main.build_baseline(t_matrix, station_tree, pickups, dropoffs, taxi_times)
+    trip_arrays = main.TripArrays(pickups, dropoffs, taxi_times, baseline, station_ids)
+    with metrics.phase('trip_index'):
+        trip_index = build_trip_index(pickups, dropoffs)
+
+    frontier = [
+        (name, graph.node[name]['latlng'], NOT_SEEN, NOT_SEEN, NOT_SEEN)
+        for name in graph if graph.degree(name) == 1
+    ]
+    last_time = [time.time()]
+
+    def on_iteration(iteration, frontier):
+        now = time.time()
+        metrics.record('beam_search_iteration_seconds', now - last_time[0])
+        last_time[0] = now
+
+    random.seed(seed)
+    with metrics.phase('beam_search'):
+        main.beam_search(graph, t_matrix, trip_arrays, frontier, trip_index=trip_index, on_iteration=on_iteration)
+
+    return dict(metrics.report(), trips=n)
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-n", "--sizes", type=int, nargs='+', default=BENCHMARK_SIZES,
+                    help="Numbers of synthetic trips to benchmark")
+parser.add_argument("-s", "--seed", type=int, default=0, help="Seed of the synthetic trips and beam searches")
+parser.add_argument("-o", "--output", default=BENCHMARK_PATH, help="Path of the JSON results to be output")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        results = [benchmark(n, tmp_dir, seed=args.seed) for n in args.sizes]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output, 'w') as output_file:
+        json.dump({'seed': args.seed, 'python': sys.version, 'results': results}, output_file, indent=2)
+    logger.info('Wrote results to %s', args.output)
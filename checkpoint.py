@@ -0,0 +1,61 @@
+# Checkpoints of a run, so a crashed or preempted run can resume without recomputing finished work
+
+import cPickle
+import logging
+import os
+
+import numpy as np
+
+import metrics
+from util import write_atomically
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint(object):
+    """
+    State of a run, pickled atomically to a file every time it's saved.
+    Large arrays that are only computed once, like the trips and their baseline, are saved to their own .npz
+    files next to it instead of being rewritten with every save.
+    The config identifies the run, a checkpoint is only loaded by a run with the same config.
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.state = {}
+
+    def arrays_path(self, name):
+        return '%s.%s.npz' % (os.path.splitext(self.path)[0], name)
+
+    def load(self):
+        """ Loads the state of the last checkpoint, returning False if there is none """
+        if not os.path.exists(self.path):
+            logger.warn('No checkpoint at %s, starting from scratch', self.path)
+            return False
+        with open(self.path, 'rb') as checkpoint_file:
+            config, state = cPickle.load(checkpoint_file)
+        if config != self.config:
+            raise ValueError('Checkpoint %s is of a run with different options: %s' % (self.path, config))
+        self.state = state
+        logger.info('Resuming from %s: %s', self.path, sorted(state))
+        return True
+
+    def save(self, **state):
+        """ Updates the state and writes it """
+        self.state.update(state)
+        write_atomically(self.path, lambda checkpoint_file: cPickle.dump(
+            (self.config, self.state), checkpoint_file, cPickle.HIGHEST_PROTOCOL))
+        metrics.count('checkpoints_saved')
+
+    def save_arrays(self, name, arrays):
+        """ Writes a list of arrays, recording in the state that they were saved """
+        write_atomically(self.arrays_path(name), lambda arrays_file: np.savez(arrays_file, *arrays))
+        self.save(**{name + '_arrays': len(arrays)})
+
+    def load_arrays(self, name):
+        """ Returns the list of arrays saved under name, or None if they weren't saved """
+        if name + '_arrays' not in self.state:
+            return None
+        arrays = np.load(self.arrays_path(name))
+        return [arrays['arr_%d' % i] for i in xrange(self.state[name + '_arrays'])]
@@ -0,0 +1,44 @@
+# Tests for saving and loading run checkpoints
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from nose.tools import *
+
+from checkpoint import Checkpoint
+
+tmp_dir = None
+
+
+def setup_module():
+    global tmp_dir
+    tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(tmp_dir)
+
+
+def test_checkpoint():
+    path = os.path.join(tmp_dir, 'checkpoint.pkl')
+    checkpoint = Checkpoint(path, {'seed': 1})
+    assert not checkpoint.load()
+    assert checkpoint.load_arrays('trips') is None
+
+    checkpoint.save(overall_search={'iteration': 3})
+    checkpoint.save_arrays('trips', (np.arange(5), np.ones((5, 2))))
+    checkpoint.save(terminal_searches={0: ['node']})
+    assert sorted(os.listdir(tmp_dir)) == ['checkpoint.pkl', 'checkpoint.trips.npz']
+
+    resumed = Checkpoint(path, {'seed': 1})
+    assert resumed.load()
+    assert resumed.state['overall_search'] == {'iteration': 3}
+    assert resumed.state['terminal_searches'] == {0: ['node']}
+    trips = resumed.load_arrays('trips')
+    assert len(trips) == 2
+    assert (trips[0] == np.arange(5)).all()
+    assert trips[1].shape == (5, 2)
+
+    assert_raises(ValueError, Checkpoint(path, {'seed': 2}).load)
@@ -1,5 +1,9 @@
 MBTA_YAML_PATH = 'data/mbta.yaml'
 DEBUG_GRAPH_PATH = 'tmp/mbta_graph.svg'
+CACHE_DIR = 'tmp/cache'
+METRICS_PATH = 'tmp/metrics.json'
+CHECKPOINT_PATH = 'tmp/checkpoint.pkl'
+SHARD_DIR = 'tmp/shards'
 
 TAXI_PICKUP_PATH = 'data/taxi/pickup6.csv'
 TAXI_DROPOFF_PATH = 'data/taxi/dropoff6.csv'
@@ -23,6 +27,7 @@ TAXI_DROPOFF_PATHS = [
 ]
 
 PREPROCESSED_PATH = 'tmp/trips.csv'
+PREPROCESSED_BINARY_PATH = 'tmp/trips.bin'
 PREPROCESSED_12HR_DATE_FORMAT = "%m/%d/%y %I:%M %p"
 PREPROCESSED_24HR_DATE_FORMAT = "%m/%d/%Y %H:%M"
 PREPROCESSED_KEYS = {
@@ -54,3 +59,11 @@ FRONTIER_SIZE = 10
 BRANCH_FACTOR = 6
 NEW_GAP = 1.5
 SAMPLE_NUM = 10000
+EVAL_CHUNK_SIZE = 10000  # trips scored together by the batched evaluation engine
+SCORE_CACHE_RESOLUTION = 0.00001  # degrees of lat/lng, about 1m, well below the finest grid of the grid search
+SCORE_CACHE_SIZE = 100000  # node scores remembered per run
+BIN_TIME_BUCKET = 1  # min, taxi time bucket of trips binned by origin-destination cell
+GRID_SPACING = 0.4  # km between the points of the first grid scored around each terminal by the grid search
+GRID_REFINEMENTS = 3  # finer grids scored around the best nodes of the grid search
+SHARD_SIZE = 500000  # trips per shard of the archive scored out of core, about 40MB of trips and baseline
+PROGRESS_POLL_SECONDS = 0.5  # how often the progress of searches running in a process pool is written
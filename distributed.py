@@ -0,0 +1,334 @@
+#!/bin/env python2
+
+# Candidate stops scored by worker processes, on this or other hosts, each holding some shards of the trips.
+# A coordinator sends every batch of candidates to all the workers and adds up their partial scores.
+
+import argparse
+import cPickle
+import logging
+import multiprocessing
+import random
+import socket
+import SocketServer
+import struct
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import main
+import mbta_graph
+import metrics
+from constants import MBTA_YAML_PATH, NOT_SEEN, SHARD_SIZE
+from util import build_trip_index, scale_latlng
+
+logger = logging.getLogger(__name__)
+
+WORKER_HOST = '127.0.0.1'
+WORKER_PORT = 9001
+WORKER_TIMEOUT = 600  # seconds a worker may take to answer before it's considered failed
+MESSAGE_HEADER = struct.Struct('!Q')  # length of the pickled message that follows
+
+
+class WorkerError(Exception):
+    """ A request a worker answered with an error, reassigning its shards to another worker wouldn't help """
+    pass
+
+
+def send_message(sock, message):
+    """ Sends a length prefixed pickled message """
+    data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+    sock.sendall(MESSAGE_HEADER.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def recv_message(sock):
+    """ Receives a message sent by send_message, raising EOFError if the connection was closed """
+    size, = MESSAGE_HEADER.unpack(recv_exactly(sock, MESSAGE_HEADER.size))
+    return cPickle.loads(recv_exactly(sock, size))
+
+
+class WorkerHandler(SocketServer.BaseRequestHandler):
+    """
+    Answers the requests of a coordinator, holding the T times and the shards it was sent for the connection:
+    ('setup', graph, t_matrix, station_ids) - the T times every shard is scored with
+    ('shard', shard_id, (pickups, dropoffs, taxi_times, baseline)) - a shard of trips and their baseline to hold
+    ('score', shard_ids, nodes) - the partial (T_difs, taxi_difs, tot_saved) of the nodes over each shard
+    Every request is answered with ('ok', result) or ('error', message).
+    """
+
+    def handle(self):
+        shards = {}  # shard id -> (TripArrays, TripIndex)
+        setup = None
+        while True:
+            try:
+                request = recv_message(self.request)
+            except (EOFError, socket.error):
+                return  # the coordinator is gone
+            try:
+                if request[0] == 'setup':
+                    setup = request[1:]
+                    result = None
+                elif request[0] == 'shard':
+                    _, shard_id, (pickups, dropoffs, taxi_times, baseline) = request
+                    trip_arrays = main.with_trip_points(
+                        main.TripArrays(pickups, dropoffs, taxi_times, main.Baseline(*baseline), setup[2]))
+                    shards[shard_id] = trip_arrays, build_trip_index(pickups, dropoffs)
+                    result = None
+                elif request[0] == 'score':
+                    _, shard_ids, nodes = request
+                    graph, t_matrix, _ = setup
+                    result = {}
+                    for shard_id in shard_ids:
+                        trip_arrays, trip_index = shards[shard_id]
+                        scored = main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, nodes,
+                                                           trip_index=trip_index)
+                        result[shard_id] = [node[2:] for node in scored]
+                else:
+                    raise ValueError('Unknown request %s' % request[0])
+                response = ('ok', result)
+            except Exception as e:
+                logger.exception('Failed %s request', request[0])
+                response = ('error', '%s: %s' % (type(e).__name__, e))
+            try:
+                send_message(self.request, response)
+            except socket.error:
+                return
+
+
+class WorkerServer(SocketServer.ThreadingTCPServer):
+    """ TCP server of a worker, each coordinator connection is answered in its own thread """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        SocketServer.ThreadingTCPServer.__init__(self, address, WorkerHandler)
+
+
+def serve_worker(host, port, ports=None):
+    """ Process entry point running a worker until it's killed, putting its port on the ports queue if given """
+    server = WorkerServer((host, port))
+    if ports is not None:
+        ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_local_workers(n, host=WORKER_HOST):
+    """
+    Starts n worker processes listening on random ports of this host, e.g. to run or test a distributed search
+    on one machine
+    :return tuple[list[multiprocessing.Process], list[tuple[str, int]]] - the workers and their addresses
+    """
+    ports = multiprocessing.Queue()
+    processes = []
+    for _ in xrange(n):
+        process = multiprocessing.Process(target=serve_worker, args=(host, 0, ports))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    return processes, [(host, ports.get(timeout=WORKER_TIMEOUT)) for _ in processes]
+
+
+class Coordinator(object):
+    """
+    Partitions shards of trips, see main.write_shards, across workers and scores candidate stops on all of them.
+    Scores are sums over trips, so each worker returns partial scores over its shards, which are added up.
+    A worker that fails, by closing its connection or timing out, is dropped and its shards are sent to the
+    other workers, so a search carries on as long as one worker is left.
+    Messages are pickled, workers must only be reachable from a trusted network.
+    """
+
+    def __init__(self, G, t_matrix, station_ids, shard_paths, addresses, timeout=WORKER_TIMEOUT):
+        self.G = G
+        self.t_matrix = t_matrix
+        self.station_ids = station_ids
+        self.shard_paths = shard_paths
+        self.timeout = timeout
+        self.workers = {}  # address -> connected socket
+        self.assignments = {}  # address -> ids of the shards the worker holds
+        try:
+            for address in addresses:
+                self.connect(address)
+            self.assign(range(len(shard_paths)))
+        except Exception:
+            self.close()
+            raise
+
+    def connect(self, address):
+        try:
+            sock = socket.create_connection(address, timeout=self.timeout)
+            self.workers[address] = sock
+            self.request(address, ('setup', self.G, self.t_matrix, self.station_ids))
+        except (socket.error, EOFError, WorkerError) as e:
+            self.fail(address, e)
+            return
+        self.assignments[address] = []
+
+    def close(self):
+        for sock in self.workers.itervalues():
+            sock.close()
+        self.workers.clear()
+
+    def fail(self, address, error):
+        """ Drops a failed worker, returning the ids of the shards it held """
+        logger.warn('Worker %s:%s failed: %s', address[0], address[1], error)
+        metrics.count('worker_failures')
+        sock = self.workers.pop(address, None)
+        if sock is not None:
+            sock.close()
+        return self.assignments.pop(address, [])
+
+    def request(self, address, message):
+        """ Sends a request to a worker and returns its result """
+        send_message(self.workers[address], message)
+        return self.response(address)
+
+    def response(self, address):
+        status, result = recv_message(self.workers[address])
+        if status == 'error':
+            raise WorkerError('Worker %s:%s: %s' % (address[0], address[1], result))
+        return result
+
+    def assign(self, shard_ids):
+        """ Sends shards to the workers holding the fewest, until each shard is held by a live worker """
+        shard_ids = list(shard_ids)
+        while shard_ids:
+            if not self.workers:
+                raise RuntimeError('Every worker failed, %d shards are unassigned' % len(shard_ids))
+            address = min(self.workers, key=lambda address: (len(self.assignments[address]), address))
+            trip_arrays = main.load_shard(self.shard_paths[shard_ids[0]], self.station_ids)
+            try:
+                self.request(address, ('shard', shard_ids[0], tuple(trip_arrays[:3]) + (tuple(trip_arrays.baseline),)))
+            except (socket.error, EOFError) as e:
+                shard_ids.extend(self.fail(address, e))
+                continue
+            self.assignments[address].append(shard_ids.pop(0))
+            metrics.count('shards_assigned')
+
+    def eval_nodes(self, nodes):
+        """
+        Evaluates every unseen node against the trips of every shard, like main.eval_nodes_for_shards.
+        The workers score their shards in parallel, then the partial scores are added up in shard order,
+        so they don't depend on which worker held which shard. A WorkerError is raised once every worker's
+        response was read, so the coordinator can still be used after it.
+        :return list[node] - the nodes with their scores filled in
+        """
+        results = list(nodes)
+        unseen = [i for i, node in enumerate(nodes) if node[2] == NOT_SEEN]
+        if not unseen:
+            return results
+        unseen_nodes = [nodes[i] for i in unseen]
+        metrics.count('candidates_evaluated', len(unseen))
+
+        partials = {}  # shard id -> scores of the unseen nodes
+        while len(partials) < len(self.shard_paths):
+            # every live worker scores its shards that aren't scored yet at the same time
+            pending = []
+            failed = []  # shards of the workers that failed this round
+            error = None
+            for address, shard_ids in self.assignments.items():
+                shard_ids = [shard_id for shard_id in shard_ids if shard_id not in partials]
+                if not shard_ids:
+                    continue
+                try:
+                    send_message(self.workers[address], ('score', shard_ids, unseen_nodes))
+                    pending.append(address)
+                except socket.error as e:
+                    failed.extend(self.fail(address, e))
+            for address in pending:
+                try:
+                    partials.update(self.response(address))
+                except (socket.error, EOFError) as e:
+                    failed.extend(self.fail(address, e))
+                except WorkerError as e:
+                    # raised once every response is read, so the next request doesn't read this one's responses
+                    error = error or e
+            # once every response is read, other workers get the failed workers' shards to score on the next round
+            self.assign(failed)
+            if error is not None:
+                raise error
+
+        T_difs = np.zeros(len(unseen))
+        taxi_difs = np.zeros(len(unseen))
+        tot_saved = np.zeros(len(unseen), dtype=np.int64)
+        for shard_id in xrange(len(self.shard_paths)):
+            shard_difs, shard_taxi_difs, shard_saved = zip(*partials[shard_id])
+            T_difs += shard_difs
+            taxi_difs += shard_taxi_difs
+            tot_saved += shard_saved
+
+        for k, i in enumerate(unseen):
+            results[i] = nodes[i][:2] + (float(T_difs[k]), float(taxi_difs[k]), int(tot_saved[k]))
+        return results
+
+
+def parse_address(address):
+    """ Parses a host:port worker address """
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError('Worker addresses are host:port, not %s' % address)
+    return host, int(port)
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--serve", action='store_true', help="Run a worker, waiting for a coordinator to connect")
+parser.add_argument("--host", default=WORKER_HOST, help="Address the worker listens on")
+parser.add_argument("-p", "--port", type=int, default=WORKER_PORT, help="Port the worker listens on")
+parser.add_argument("-w", "--workers", nargs='+', default=[],
+                    help="host:port addresses of the workers to run an overall search on")
+parser.add_argument("--local-workers", type=int, default=0,
+                    help="Number of worker processes to start on this host, in addition to --workers")
+parser.add_argument("-s", "--seed", type=int, help="Seed of the search, so runs can be reproduced")
+parser.add_argument("--search", choices=['beam', 'grid'], default='beam', help="Search to run, see main.py")
+parser.add_argument("--shard-size", type=int, default=SHARD_SIZE,
+                    help="Number of trips per shard, shards are the unit of work handed to the workers")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    if args.serve:
+        logger.info('Worker listening on %s:%s', args.host, args.port)
+        serve_worker(args.host, args.port)
+
+    try:
+        addresses = [parse_address(address) for address in args.workers]
+    except ValueError as e:
+        parser.error(str(e))
+    if args.local_workers:
+        addresses.extend(start_local_workers(args.local_workers)[1])
+    if not addresses:
+        parser.error('No workers, give --workers or --local-workers')
+
+    random.seed(args.seed)
+    graph, _, (station_names, coords, _) = mbta_graph.load_graph(MBTA_YAML_PATH)
+    _, t_matrix = mbta_graph.load_travel_times(graph, MBTA_YAML_PATH)
+    station_ids = {name: i for i, name in enumerate(station_names)}
+    shard_dir = main.archive_shard_dir(args.shard_size)
+    shards = main.load_shards(shard_dir)
+    if shards is None:
+        shards = main.write_shards(main.trip_chunks(args.shard_size), t_matrix, cKDTree(scale_latlng(coords)),
+                                   shard_dir)
+    shard_paths, n_trips = shards
+
+    coordinator = Coordinator(graph, t_matrix, station_ids, shard_paths, addresses)
+    try:
+        frontier = [(name, graph.node[name]['latlng'], NOT_SEEN, NOT_SEEN, NOT_SEEN)
+                    for name in graph if graph.degree(name) == 1]
+        search = main.grid_search if args.search == 'grid' else main.beam_search
+        final_frontier = search(graph, t_matrix, None, frontier, evaluate=coordinator.eval_nodes)
+    finally:
+        coordinator.close()
+
+    print "The best stops for the overall %s search over all %d trips are: " % (args.search, n_trips)
+    for i, stop in enumerate(final_frontier):
+        print str(i + 1) + ". Near terminal " + stop[0] + ", location " + str(stop[1]) + " saves " + str(
+            stop[2]) + "min of T time"
@@ -0,0 +1,135 @@
+# Tests for the distributed evaluation, over worker processes on random ports of localhost
+
+import random
+import shutil
+import tempfile
+
+from nose.tools import *
+from scipy.spatial import cKDTree
+
+import benchmark
+import distributed
+import main
+import mbta_graph
+import read_data
+from constants import MBTA_YAML_PATH, NOT_SEEN
+from util import scale_latlng
+
+graph = None
+t_matrix = None
+station_ids = None
+trip_arrays = None
+shard_dir = None
+shard_paths = None
+nodes = None
+
+
+def setup_module():
+    global graph, t_matrix, station_ids, trip_arrays, shard_dir, shard_paths, nodes
+    graph, _ = mbta_graph.build_graph(MBTA_YAML_PATH)
+    station_names, coords, _ = mbta_graph.station_arrays(graph)
+    t_matrix = mbta_graph.shortest_travel_times(graph, station_names)
+    station_ids = {name: i for i, name in enumerate(station_names)}
+    station_tree = cKDTree(scale_latlng(coords))
+    records = benchmark.generate_trips(2000, seed=0)
+    pickups, dropoffs, taxi_times = read_data.trip_store_columns(records)
+    trip_arrays = main.TripArrays(pickups, dropoffs, taxi_times,
+                                  main.build_baseline(t_matrix, station_tree, pickups, dropoffs, taxi_times),
+                                  station_ids)
+    shard_dir = tempfile.mkdtemp()
+    shard_paths, _ = main.write_shards(read_data.trip_store_chunks(records, 400), t_matrix, station_tree, shard_dir)
+
+    random.seed(0)
+    terminals = [(name, graph.node[name]['latlng'], NOT_SEEN, NOT_SEEN, NOT_SEEN)
+                 for name in graph if graph.degree(name) == 1]
+    nodes = terminals + [main.get_random_successor(graph, node) for node in terminals for _ in xrange(3)]
+
+
+def teardown_module():
+    shutil.rmtree(shard_dir)
+
+
+def stop_workers(processes):
+    for process in processes:
+        process.terminate()
+        process.join()
+
+
+def assert_same_scores(result, expected):
+    assert len(result) == len(expected)
+    for node, expected_node in zip(result, expected):
+        assert node[0] == expected_node[0]
+        assert list(node[1]) == list(expected_node[1])
+        assert_almost_equal(node[2], expected_node[2])
+        assert_almost_equal(node[3], expected_node[3])
+        assert node[4] == expected_node[4]
+
+
+def test_eval_nodes():
+    processes, addresses = distributed.start_local_workers(2)
+    coordinator = distributed.Coordinator(graph, t_matrix, station_ids, shard_paths, addresses)
+    try:
+        assert sorted(len(shard_ids) for shard_ids in coordinator.assignments.values()) == [2, 3]
+        result = coordinator.eval_nodes(nodes)
+        assert_same_scores(result, main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, nodes))
+        assert result == main.eval_nodes_for_shards(graph, t_matrix, shard_paths, station_ids, nodes)
+        # scored nodes aren't sent again
+        assert coordinator.eval_nodes(result) == result
+    finally:
+        coordinator.close()
+        stop_workers(processes)
+
+
+def test_worker_failure():
+    processes, addresses = distributed.start_local_workers(3)
+    coordinator = distributed.Coordinator(graph, t_matrix, station_ids, shard_paths, addresses)
+    try:
+        expected = coordinator.eval_nodes(nodes)
+        stop_workers(processes[:1])
+        # the failed worker's shards are scored by the others
+        assert coordinator.eval_nodes(nodes) == expected
+        assert sorted(coordinator.workers) == sorted(addresses[1:])
+        assert sorted(sum(coordinator.assignments.values(), [])) == range(len(shard_paths))
+
+        stop_workers(processes[1:])
+        assert_raises(RuntimeError, coordinator.eval_nodes, nodes)
+    finally:
+        coordinator.close()
+        stop_workers(processes)
+
+
+def test_worker_error():
+    processes, addresses = distributed.start_local_workers(2)
+    coordinator = distributed.Coordinator(graph, t_matrix, station_ids, shard_paths, addresses)
+    try:
+        # an error of the worker itself would happen on any worker, it isn't retried
+        assert_raises(distributed.WorkerError, coordinator.eval_nodes,
+                      [('Unknown Station', nodes[0][1], NOT_SEEN, NOT_SEEN, NOT_SEEN)])
+        # every worker's response was read, so the next request gets its own responses
+        assert sorted(coordinator.workers) == sorted(addresses)
+        assert coordinator.eval_nodes(nodes) == main.eval_nodes_for_shards(
+            graph, t_matrix, shard_paths, station_ids, nodes)
+    finally:
+        coordinator.close()
+        stop_workers(processes)
+
+
+def test_distributed_search():
+    processes, addresses = distributed.start_local_workers(2)
+    coordinator = distributed.Coordinator(graph, t_matrix, station_ids, shard_paths, addresses)
+    frontier = [node for node in nodes[:4]]
+    try:
+        random.seed(1)
+        expected = main.beam_search(graph, t_matrix, trip_arrays, frontier)
+        random.seed(1)
+        result = main.beam_search(graph, t_matrix, None, frontier, evaluate=coordinator.eval_nodes)
+        assert_same_scores(result, expected)
+    finally:
+        coordinator.close()
+        stop_workers(processes)
+
+
+def test_parse_address():
+    assert distributed.parse_address('10.0.0.2:9001') == ('10.0.0.2', 9001)
+    assert_raises(ValueError, distributed.parse_address, '10.0.0.2')
+    assert_raises(ValueError, distributed.parse_address, ':9001')
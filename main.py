@@ -1,22 +1,131 @@
+import argparse
+import hashlib
 import heapq
 import itertools
+import json
 import logging
+import multiprocessing
+import os
+import Queue
 import random
+import sys
+import time
+from collections import namedtuple, OrderedDict
 
-import networkx as nx
 from scipy.spatial import cKDTree
-from tqdm import tqdm
 
 import mbta_graph
+import metrics
 import read_data
-from constants import MBTA_YAML_PATH, PREPROCESSED_PATH
+from checkpoint import Checkpoint
+from constants import MBTA_YAML_PATH, PREPROCESSED_PATH, PREPROCESSED_BINARY_PATH, METRICS_PATH, CHECKPOINT_PATH, \
+    SHARD_DIR, CACHE_DIR
 from constants import WALKING_SPEED, T_WAIT_TIME, MAX_STATIONS_TO_CHECK, STOP_NO_IMPROVEMENT, NOT_SEEN, \
-    MAX_BEAM_SEARCH_ITERATIONS, FRONTIER_SIZE, BRANCH_FACTOR, NEW_GAP, SAMPLE_NUM
+    MAX_BEAM_SEARCH_ITERATIONS, FRONTIER_SIZE, BRANCH_FACTOR, NEW_GAP, SAMPLE_NUM, EVAL_CHUNK_SIZE, \
+    SCORE_CACHE_RESOLUTION, SCORE_CACHE_SIZE, BIN_TIME_BUCKET, GRID_SPACING, GRID_REFINEMENTS, SHARD_SIZE, \
+    PROGRESS_POLL_SECONDS
 from util import *
 
 logger = logging.getLogger(__name__)
 
 
+class ScoreCache(object):
+    """
+    LRU cache of node scores (T_difs, taxi_time_saved, tot_saved), keyed by terminal and latlng quantized to
+    a grid of the given resolution in degrees. Nodes in the same grid cell share a score. Only the grid search's
+    searches score the same nodes often enough to hit it, the beam search's random successors rarely share a cell.
+    """
+
+    def __init__(self, resolution=SCORE_CACHE_RESOLUTION, max_size=SCORE_CACHE_SIZE):
+        self.resolution = resolution
+        self.max_size = max_size
+        self.scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, terminal, latlng):
+        return terminal, int(round(latlng[0] / self.resolution)), int(round(latlng[1] / self.resolution))
+
+    def cell_km(self):
+        """ Returns the width of a grid cell in km, its shorter side """
+        return self.resolution * R * radians(1.) * cos_factor
+
+    def get(self, key):
+        """ Returns the score of a key, or None if it isn't cached """
+        score = self.scores.pop(key, None)
+        if score is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.scores[key] = score  # most recently used
+        return score
+
+    def put(self, key, score):
+        self.scores.pop(key, None)
+        self.scores[key] = score
+        if len(self.scores) > self.max_size:
+            self.scores.popitem(last=False)  # least recently used
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.scores)}
+
+
+class SearchBudget(object):
+    """
+    Wall clock time and node evaluations a search may use. Once either is spent the search stops cleanly
+    after its current iteration, returning its best frontier so far.
+    """
+
+    def __init__(self, seconds=None, evaluations=None):
+        self.seconds = seconds
+        self.evaluations = evaluations
+        self.start = time.time()
+        self.spent = 0
+
+    def fresh(self, used=None):
+        """ Returns a budget with the same limits, starting now, less the (seconds, evaluations) used if given """
+        budget = SearchBudget(self.seconds, self.evaluations)
+        if used is not None:
+            seconds, budget.spent = used
+            budget.start -= seconds
+        return budget
+
+    def used(self):
+        """ Returns the (seconds, evaluations) used so far, e.g. to checkpoint them for fresh """
+        return time.time() - self.start, self.spent
+
+    def spend(self, evaluations):
+        self.spent += evaluations
+
+    def exhausted(self):
+        return (self.seconds is not None and time.time() - self.start >= self.seconds) or \
+               (self.evaluations is not None and self.spent >= self.evaluations)
+
+
+# read only data of the per-terminal beam searches, set before the process pool forks
+# so workers share it copy-on-write instead of having it pickled per task
+search_data = {}
+
+# Columnar T_old baseline: the best T time of each trip's itinerary, its origin and destination stations and
+# the walking times to and from them. Stations index into the T times matrix. Trips that can't be improved
+# (invalid or with no close stations) are not valid, with a nan time, -1 stations and no walks
+Baseline = namedtuple('Baseline', ['t_old', 'from_stations', 'from_walks', 'to_stations', 'to_walks', 'valid'])
+
+# Flat per-trip arrays used by the evaluation engine
+# station_ids maps station names to their index in the T times matrix,
+# weights are the number of trips each one stands for when trips are binned, None if they aren't,
+# points are the TripPoints of the trips, see with_trip_points, None to compute them for every batch
+TripArrays = namedtuple('TripArrays', ['pickups', 'dropoffs', 'taxi_times', 'baseline', 'station_ids', 'weights',
+                                       'points'])
+TripArrays.__new__.__defaults__ = (None, None)
+
+# GeoPoints of the trips' pickups and dropoffs, computed once instead of for every batch of nodes scored,
+# and whether walking distances to them use the equirectangular approximation, see geo_dist
+TripPoints = namedtuple('TripPoints', ['pickups', 'dropoffs', 'approximate'])
+
+
 def analyze_trip(t_times, stations, station_tree, trip):
     """ Measure time needed for a taxi trip itinerary on the MBTA """
     global zero_count
@@ -63,70 +172,135 @@ def analyze_trip(t_times, stations, station_tree, trip):
     return min_trip
 
 
-def eval_node_for_trip(t_times, trip, t_old, new_node, new_gap):
-    """ Evaluates the effective of adding a new station using one specific taxi trip """
+def build_baseline(t_matrix, station_tree, pickups, dropoffs, taxi_times, chunk_size=EVAL_CHUNK_SIZE):
+    """
+    Measures the time needed for all taxi trip itineraries on the MBTA at once, see analyze_trip
+    :type t_matrix: np.array - (stations, stations) T times, indexed like the station_tree
+    :type station_tree: cKDTree - scipy cKDTree mapping stations to points
+    :type pickups: np.array - (trips, 2) latlngs
+    :type dropoffs: np.array - (trips, 2) latlngs
+    :type taxi_times: np.array - (trips,) taxi trip times in minutes
+    :return Baseline - trips that took no time or have no close stations are not valid
+    """
+    n_trips = len(taxi_times)
+    n_stations = len(t_matrix)
+    k = MAX_STATIONS_TO_CHECK
+    # missing stations from the kd-tree queries index the trailing inf row and column
+    padded_t_matrix = np.full((n_stations + 1, n_stations + 1), float('inf'))
+    padded_t_matrix[:n_stations, :n_stations] = t_matrix
+    padded_t_matrix[np.arange(n_stations + 1), np.arange(n_stations + 1)] = float('inf')  # can't ride to itself
+
+    best_times = np.empty(n_trips, dtype=np.float64)
+    from_stations = np.empty(n_trips, dtype=np.int32)
+    to_stations = np.empty(n_trips, dtype=np.int32)
+    from_walks = np.empty(n_trips, dtype=np.float64)
+    to_walks = np.empty(n_trips, dtype=np.float64)
+
+    for start in xrange(0, n_trips, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        from_dists, from_ids = station_tree.query(
+            scale_latlng(pickups[chunk]), k=k, distance_upper_bound=WALKING_LIMIT)
+        to_dists, to_ids = station_tree.query(
+            scale_latlng(dropoffs[chunk]), k=k, distance_upper_bound=WALKING_LIMIT)
+        from_dists, from_ids = from_dists.reshape(-1, k), from_ids.reshape(-1, k)
+        to_dists, to_ids = to_dists.reshape(-1, k), to_ids.reshape(-1, k)
+
+        # try all combinations of closest stations, in the same order as analyze_trip
+        w_from = from_dists * WALKING_SPEED
+        w_to = to_dists * WALKING_SPEED
+        t_time = padded_t_matrix[from_ids[:, :, None], to_ids[:, None, :]]
+        trip_times = (w_from[:, :, None] + t_time + w_to[:, None, :] + T_WAIT_TIME).reshape(-1, k * k)
+
+        # get the fastest station pair itinerary
+        best = np.argmin(trip_times, axis=1)
+        rows = np.arange(len(best))
+        from_best, to_best = best // k, best % k
+        best_times[chunk] = trip_times[rows, best]
+        from_stations[chunk] = from_ids[rows, from_best]
+        to_stations[chunk] = to_ids[rows, to_best]
+        from_walks[chunk] = w_from[rows, from_best]
+        to_walks[chunk] = w_to[rows, to_best]
+
+    invalid = (taxi_times == 0) | (best_times == float('inf'))
+    best_times[invalid] = np.nan
+    from_stations[invalid] = -1
+    to_stations[invalid] = -1
+    from_walks[invalid] = 0.
+    to_walks[invalid] = 0.
+    return Baseline(best_times, from_stations, from_walks, to_stations, to_walks, ~invalid)
+
+
+def eval_node_for_trip(t_matrix, trip_arrays, i, new_node, new_gap):
+    """ Evaluates the effective of adding a new station using one specific taxi trip, the i-th of the trip_arrays """
     terminal, new_station, _, _, _ = new_node
-    from_coords, to_coords, t_start, t_stop = trip
+    baseline = trip_arrays.baseline
 
     trip_saved = 0
 
-    taxi_time = float(int(t_stop) - int(t_start)) / 60.  # converts seconds to minutes
+    taxi_time = trip_arrays.taxi_times[i]
+    t_old = baseline.t_old[i]
 
-    dist1 = latlng_dist(from_coords, new_station)
-    dist2 = latlng_dist(to_coords, new_station)
+    dist1 = latlng_dist(trip_arrays.pickups[i], new_station)
+    dist2 = latlng_dist(trip_arrays.dropoffs[i], new_station)
     start = False
 
     if dist1 > WALKING_LIMIT and dist2 > WALKING_LIMIT:
         return STOP_NO_IMPROVEMENT
 
+    # trips without a T itinerary can never be improved
+    if not baseline.valid[i]:
+        return STOP_NO_IMPROVEMENT
+
     if dist1 < dist2:
         start = True
 
+    terminal_times = t_matrix[trip_arrays.station_ids[terminal]]
     if start:
-        to_station = t_old[2][0]
-        to_time = t_old[2][1]
-        if to_station == None:
-            return STOP_NO_IMPROVEMENT
         w_from = dist1 * WALKING_SPEED
-        t_time = new_gap + t_times[terminal][to_station]
+        t_time = new_gap + terminal_times[baseline.to_stations[i]]
 
-        t_new = w_from + t_time + to_time + T_WAIT_TIME
+        t_new = w_from + t_time + baseline.to_walks[i] + T_WAIT_TIME
 
     else:
-        from_station = t_old[1][0]
-        from_time = t_old[1][1]
-
-        if from_station is None:
-            return STOP_NO_IMPROVEMENT
         w_to = dist2 * WALKING_SPEED
-        t_time = new_gap + t_times[terminal][from_station]
-        t_new = from_time + w_to + t_time + T_WAIT_TIME
+        t_time = new_gap + terminal_times[baseline.from_stations[i]]
+        t_new = baseline.from_walks[i] + w_to + t_time + T_WAIT_TIME
 
     if t_new == float('inf'):
-        logger.info("didn't calculate t_new for trip: " + str(trip) + " at stop " + str(new_station))
+        logger.info("didn't calculate t_new for trip " + str(i) + " at stop " + str(new_station))
         return STOP_NO_IMPROVEMENT
 
-    if t_new >= t_old[0]:
+    if t_new >= t_old:
         return STOP_NO_IMPROVEMENT
 
-    if t_old[0] is None:
-        t_dif = t_new
-    else:
-        t_dif = t_old[0] - t_new
+    t_dif = t_old - t_new
 
     taxi_time_saved = 0.0
 
     # trip can only be saved if previous trip was "necessary"
     # this is why we order by T_difs, a fuller picture of the improvement
-    if t_new <= taxi_time < t_old[0]:
+    if t_new <= taxi_time < t_old:
         trip_saved = 1
         taxi_time_saved = taxi_time - t_new
 
     return t_dif, taxi_time_saved, trip_saved
 
 
-def eval_node_for_trips(G, t_times, trips, T_old, new_node):
-    """ Evaluates the effective of adding a new station over all specific taxi trip """
+def get_new_gap(G, terminal, new_coord):
+    """ Returns the T time (min) between a terminal and a new stop extending its line """
+    # new t-gap distance between the new stop and the old terminal
+    new_gap_dist = latlng_dist(new_coord, G.node[terminal]['latlng'])
+    # grabs first line from line array because it's a terminus--just one line
+    return mbta_graph.line_rate(G.node[terminal]['lines'][0]) * new_gap_dist
+
+
+def eval_node_for_trips(G, t_matrix, trip_arrays, new_node, trip_index=None):
+    """
+    Evaluates the effective of adding a new station over all specific taxi trip, one trip at a time
+    If a TripIndex over the trips is given, only trips near the new station are checked
+    :type t_matrix: np.array - (stations, stations) T times, indexed by trip_arrays.station_ids
+    :type trip_arrays: TripArrays
+    """
     terminal, new_coord, T_difs, taxi_difs, tot_saved = new_node
 
     # only evaluate those we haven't seen
@@ -137,39 +311,233 @@ def eval_node_for_trips(G, t_times, trips, T_old, new_node):
     taxi_difs = 0.0
     tot_saved = 0
 
-    # new t-gap distance between the new stop and the old terminal
-    new_gap_dist = latlng_dist(new_coord, G.node[terminal]['latlng'])
-    rate = mbta_graph.GREEN_RATE
-
-    # grabs first line from line array because it's a terminus--just one line
-    lineName = G.node[terminal]['lines'][0]
-    if "Red" in lineName:
-        rate = mbta_graph.RED_RATE
-
-    elif "Blue" in lineName:
-        rate = mbta_graph.BLUE_RATE
-
-    elif "Orange" in lineName:
-        rate = mbta_graph.ORANGE_RATE
-
-    elif "Silver" in lineName:
-        rate = mbta_graph.SILVER_RATE
-
-    new_gap = rate * new_gap_dist
+    new_gap = get_new_gap(G, terminal, new_coord)
     count = 0
-    for i, trip in enumerate(trips):
-
-        if not is_trip_relevant(trip, new_node, T_old[i]):
+    n_trips = len(trip_arrays.taxi_times)
+    trip_ids = xrange(n_trips) if trip_index is None else nearby_trips(trip_index, new_coord)
+    for i in trip_ids:
+        trip = trip_arrays.pickups[i], trip_arrays.dropoffs[i]
+        if not is_trip_relevant(trip, new_node, trip_arrays.baseline.valid[i]):
             count += 1
             continue
-        T_improvement, taxi_dif, saved = eval_node_for_trip(t_times, trip, T_old[i], new_node, new_gap)
+        T_improvement, taxi_dif, saved = eval_node_for_trip(t_matrix, trip_arrays, i, new_node, new_gap)
         T_difs += T_improvement
         taxi_difs += taxi_dif
         tot_saved += saved
 
+    evaluated = len(trip_ids) - count
+    metrics.count('trips_evaluated', evaluated)
+    metrics.count('trips_skipped', n_trips - evaluated)
+
     return terminal, new_coord, T_difs, taxi_difs, tot_saved
 
 
+def trip_columns(trips):
+    """ Returns (trips, 2) arrays of pickup and dropoff latlngs and an array of taxi trip times in minutes """
+    n = len(trips)
+    pickups = np.empty((n, 2), dtype=np.float64)
+    dropoffs = np.empty((n, 2), dtype=np.float64)
+    taxi_times = np.empty(n, dtype=np.float64)
+    for i, (from_coords, to_coords, t_start, t_stop) in enumerate(trips):
+        pickups[i] = from_coords
+        dropoffs[i] = to_coords
+        taxi_times[i] = float(int(t_stop) - int(t_start)) / 60.  # converts seconds to minutes
+    return pickups, dropoffs, taxi_times
+
+
+def make_baseline(T_old, station_ids):
+    """
+    Packs the itineraries of analyze_trip into a Baseline
+    :type station_ids: dict[str, int] - station name -> index into the T times matrix
+    """
+    n = len(T_old)
+    t_old = np.full(n, np.nan, dtype=np.float64)
+    from_stations = np.full(n, -1, dtype=np.int32)
+    to_stations = np.full(n, -1, dtype=np.int32)
+    from_walks = np.zeros(n, dtype=np.float64)
+    to_walks = np.zeros(n, dtype=np.float64)
+
+    for i, t in enumerate(T_old):
+        # trips without a T itinerary can never be improved, leave them as nan
+        if t[0] == INVALID_TRIP or t[0] is None:
+            continue
+        (from_station, from_walk), (to_station, to_walk) = t[1], t[2]
+        t_old[i] = t[0]
+        from_stations[i] = station_ids[from_station]
+        to_stations[i] = station_ids[to_station]
+        from_walks[i] = from_walk
+        to_walks[i] = to_walk
+
+    return Baseline(t_old, from_stations, from_walks, to_stations, to_walks, ~np.isnan(t_old))
+
+
+def make_trip_arrays(trips, T_old, station_ids):
+    """ Packs taxi trips and their analyze_trip itineraries into a TripArrays """
+    return TripArrays(*trip_columns(trips), baseline=make_baseline(T_old, station_ids), station_ids=station_ids)
+
+
+def score_nodes(trip_arrays, trip_ids, coords, new_gaps, station_times):
+    """
+    Sums the improvements of nodes over the selected trips, see eval_node_for_trip
+    :type trip_ids: np.array[int] - trips to score, indices into trip_arrays
+    :type coords: np.array - (nodes, 2) latlngs of the new stations
+    :type new_gaps: np.array - (nodes, 1) T times from the terminals to the new stations
+    :type station_times: np.array - (nodes, stations + 1) T times from the terminals to every station,
+     followed by an inf column for missing stations
+    :return tuple[np.array, np.array, np.array] - T_difs, taxi_difs and tot_saved of each node,
+     weighted by the trip_arrays weights if it has them
+    """
+    pickups = trip_arrays.pickups[trip_ids]
+    dropoffs = trip_arrays.dropoffs[trip_ids]
+    taxi_time = trip_arrays.taxi_times[trip_ids]
+    baseline = trip_arrays.baseline
+    t_old = baseline.t_old[trip_ids]
+
+    # (nodes, trips) matrices of walking distances
+    node_points = geo_points(coords)
+    points = trip_arrays.points
+    if points is None:
+        dist1 = dist_many_to_many(node_points, pickups)
+        dist2 = dist_many_to_many(node_points, dropoffs)
+    else:
+        dist1 = dist_many_to_many(node_points, GeoPoints(*[column[trip_ids] for column in points.pickups]),
+                                  approximate=points.approximate)
+        dist2 = dist_many_to_many(node_points, GeoPoints(*[column[trip_ids] for column in points.dropoffs]),
+                                  approximate=points.approximate)
+
+    # missing stations (-1) index the trailing inf column, these trips are masked out as not valid anyway
+    from_t_times = new_gaps + station_times[:, baseline.from_stations[trip_ids]]
+    to_t_times = new_gaps + station_times[:, baseline.to_stations[trip_ids]]
+
+    # walk to the new stop if it's closer to the pickup, otherwise walk from it to the dropoff
+    t_new = np.where(
+        dist1 < dist2,
+        dist1 * WALKING_SPEED + to_t_times + baseline.to_walks[trip_ids] + T_WAIT_TIME,
+        baseline.from_walks[trip_ids] + dist2 * WALKING_SPEED + from_t_times + T_WAIT_TIME,
+    )
+
+    relevant = baseline.valid[trip_ids] & ((dist1 <= WALKING_LIMIT) | (dist2 <= WALKING_LIMIT))
+    evaluated = int(relevant.sum())
+    metrics.count('trips_evaluated', evaluated)
+    metrics.count('trips_skipped', relevant.size - evaluated)
+
+    with np.errstate(invalid='ignore'):
+        improved = relevant & (t_new != float('inf')) & (t_new < t_old)
+        # trip can only be saved if previous trip was "necessary"
+        saved = improved & (t_new <= taxi_time) & (taxi_time < t_old)
+
+    T_difs = np.where(improved, t_old - t_new, 0.)
+    taxi_difs = np.where(saved, taxi_time - t_new, 0.)
+    if trip_arrays.weights is not None:
+        # binned trips count once per trip they stand for
+        weights = trip_arrays.weights[trip_ids]
+        return (T_difs * weights).sum(axis=1), (taxi_difs * weights).sum(axis=1), (saved * weights).sum(axis=1)
+    return T_difs.sum(axis=1), taxi_difs.sum(axis=1), saved.sum(axis=1)
+
+
+def eval_nodes_for_trips(G, t_matrix, trip_arrays, nodes, trip_index=None, chunk_size=EVAL_CHUNK_SIZE,
+                         score_cache=None):
+    """
+    Evaluates every unseen node against every trip at once, giving the same scores as eval_node_for_trips
+    :type t_matrix: np.array - (stations, stations) T times, indexed by trip_arrays.station_ids
+    :type trip_arrays: TripArrays
+    :type nodes: list[node] - (terminal, latlng, T_difs, taxi_time_saved, tot_saved) tuples
+    :type trip_index: TripIndex - if given, each node is only scored against the trips near it
+    :type chunk_size: int - number of trips scored together, bounds memory to len(nodes) * chunk_size
+    :type score_cache: ScoreCache - if given, scores of nodes in already evaluated grid cells are reused
+    :return list[node] - the nodes with their scores filled in
+    """
+    results = list(nodes)
+    # only evaluate those we haven't seen
+    unseen = [i for i, node in enumerate(nodes) if node[2] == NOT_SEEN]
+
+    if score_cache is not None:
+        keys = {}  # unseen node -> cache key
+        scores = {}  # cache key -> score
+        misses = OrderedDict()  # cache key -> the unseen node evaluated for it
+        for i in unseen:
+            key = keys[i] = score_cache.key(*nodes[i][:2])
+            if key in scores or key in misses:
+                continue  # same grid cell as another node, only look it up once
+            score = score_cache.get(key)
+            if score is None:
+                misses[key] = i
+            else:
+                scores[key] = score
+
+        evaluated = eval_nodes_for_trips(G, t_matrix, trip_arrays, [nodes[i] for i in misses.itervalues()],
+                                         trip_index=trip_index, chunk_size=chunk_size)
+        for key, node in zip(misses, evaluated):
+            scores[key] = node[2:]
+            score_cache.put(key, node[2:])
+        for i in unseen:
+            results[i] = nodes[i][:2] + scores[keys[i]]
+        return results
+
+    if not unseen:
+        return results
+    metrics.count('candidates_evaluated', len(unseen))
+
+    terminals = [nodes[i][0] for i in unseen]
+    coords = np.array([nodes[i][1] for i in unseen], dtype=np.float64)
+    new_gaps = np.array([get_new_gap(G, terminal, coords[k]) for k, terminal in enumerate(terminals)])[:, None]
+
+    # T time from each node's terminal to every station, missing stations (-1) index the trailing inf column
+    padded_t_matrix = np.hstack((t_matrix, np.full((len(t_matrix), 1), float('inf'))))
+    station_times = padded_t_matrix[[trip_arrays.station_ids[terminal] for terminal in terminals]]
+
+    if trip_index is None:
+        # every node against every trip
+        groups = [(slice(None), np.arange(len(trip_arrays.taxi_times)))]
+    else:
+        # each node against only the trips near it
+        groups = [(slice(k, k + 1), nearby_trips(trip_index, coords[k])) for k in xrange(len(unseen))]
+        metrics.count('trips_skipped', sum(len(trip_arrays.taxi_times) - len(trip_ids) for _, trip_ids in groups))
+
+    T_difs = np.zeros(len(unseen))
+    taxi_difs = np.zeros(len(unseen))
+    tot_saved = np.zeros(len(unseen), dtype=np.int64)
+    for rows, trip_ids in groups:
+        for start in xrange(0, len(trip_ids), chunk_size):
+            chunk_difs, chunk_taxi_difs, chunk_saved = score_nodes(
+                trip_arrays, trip_ids[start:start + chunk_size],
+                coords[rows], new_gaps[rows], station_times[rows],
+            )
+            T_difs[rows] += chunk_difs
+            taxi_difs[rows] += chunk_taxi_difs
+            tot_saved[rows] += chunk_saved
+
+    for k, i in enumerate(unseen):
+        results[i] = (terminals[k], nodes[i][1], float(T_difs[k]), float(taxi_difs[k]), int(tot_saved[k]))
+    return results
+
+
+def binning_errors(G, t_matrix, trip_arrays, exact_trip_arrays, nodes, trip_index=None, exact_trip_index=None):
+    """
+    Returns the relative error of the T_difs of nodes scored on binned trips, see bin_trips,
+    against their T_difs scored on the exact trips. Nodes without any exact improvement have an error of 0
+    if they have no binned improvement either, inf otherwise.
+    """
+    unseen = [(node[0], node[1], NOT_SEEN, NOT_SEEN, NOT_SEEN) for node in nodes]
+    binned = eval_nodes_for_trips(G, t_matrix, trip_arrays, unseen, trip_index=trip_index)
+    exact = eval_nodes_for_trips(G, t_matrix, exact_trip_arrays, unseen, trip_index=exact_trip_index)
+    errors = []
+    for binned_node, exact_node in zip(binned, exact):
+        if exact_node[2] == 0:
+            errors.append(0. if binned_node[2] == 0 else float('inf'))
+        else:
+            errors.append(abs(binned_node[2] - exact_node[2]) / exact_node[2])
+    return errors
+
+
+def allowed_gap(terminal):
+    """ Returns how far (km) a new stop can be from a terminal """
+    # change gap size for inner-city terminals so as to not cross T lines
+    if "Bowdoin" in terminal or "Dudley" in terminal or "Design" in terminal:
+        return 0.5
+    return NEW_GAP
+
+
 def get_random_successor(G, old_node):
     terminal, latlng, _, _, _ = old_node
     # type a possible successor
@@ -189,33 +557,53 @@ def get_random_successor(G, old_node):
         )
         # TODO: pass this as parameter so doesn't have to be recalculate in eval_node_for_trips (optimization)
         gap_dist = latlng_dist(terminal_latlng, succ_latlng)
-        allowed_gap = NEW_GAP
-        # change gap size for inner-city terminals so as to not cross T lines
-        if "Bowdoin" in terminal or "Dudley" in terminal or "Design" in terminal:
-            allowed_gap = 0.5
 
-        if gap_dist <= allowed_gap:
+        if gap_dist <= allowed_gap(terminal):
             # Allows us to pick another random point if the current one is invalid
             break
+        metrics.count('successor_retries')
     return terminal, succ_latlng, NOT_SEEN, NOT_SEEN, NOT_SEEN
 
 
-def beam_search(G, t_times, T_old, trips, frontier):
-    for _ in xrange(MAX_BEAM_SEARCH_ITERATIONS):
-        last_frontier = str(frontier)
+def frontier_signature(frontier):
+    """ Returns what identifies a frontier: the terminal, latlng and T_difs of its nodes """
+    return [(node[0], node[1][0], node[1][1], node[2]) for node in frontier]
+
+
+def beam_search(G, t_matrix, trip_arrays, frontier, trip_index=None, score_cache=None, on_iteration=None,
+                first_iteration=0, budget=None, evaluate=None):
+    """
+    Searches for the best new stations starting from a frontier of nodes
+    :type on_iteration: function - if given, called with the iteration number and frontier after every iteration
+    :type first_iteration: int - to resume a search from the frontier after first_iteration - 1
+    :type budget: SearchBudget - if given, the search stops once it's exhausted, with at least one iteration scored
+    :type evaluate: function - if given, scores lists of nodes instead of eval_nodes_for_trips over the trip_arrays,
+     e.g. distributed.Coordinator.eval_nodes
+    :return list[node] - the FRONTIER_SIZE best nodes found
+    """
+    for iteration in xrange(first_iteration, MAX_BEAM_SEARCH_ITERATIONS):
+        if iteration > 0 and budget is not None and budget.exhausted():
+            logger.info('Search budget exhausted after %s iterations', iteration)
+            metrics.count('budget_stops')
+            break
+        last_frontier = frontier_signature(frontier)
 
         # generate successors
-        # TODO make this faster (We calculate frontier (eval_node_for_trips) twice)
         new_frontier = list(frontier)  # we want to consider the existing nodes as well
         for node in frontier:
             succs = [get_random_successor(G, node) for _ in xrange(BRANCH_FACTOR)]
             new_frontier.extend(succs)
 
-        eval_frontier = []
-
-        # evaluate nodes in the frontier
-        for node in new_frontier:
-            eval_frontier.append(eval_node_for_trips(G, t_times, trips, T_old, node))
+        # evaluate all unseen nodes in the frontier at once
+        candidates = sum(1 for node in new_frontier if node[2] == NOT_SEEN)
+        metrics.record('candidates_per_iteration', candidates)
+        if budget is not None:
+            budget.spend(candidates)
+        if evaluate is None:
+            eval_frontier = eval_nodes_for_trips(G, t_matrix, trip_arrays, new_frontier,
+                                                 trip_index=trip_index, score_cache=score_cache)
+        else:
+            eval_frontier = evaluate(new_frontier)
 
         # compute new frontier
         # prune to get FRONTIER_SIZE smallest succs
@@ -224,43 +612,457 @@ def beam_search(G, t_times, T_old, trips, frontier):
             key=lambda tup: tup[2],
             # key=lambda new_node: eval_node_for_trips(G, t_times, stations, station_tree, trips, T_old, new_node),
         )
-        if str(frontier) == last_frontier:
+        if on_iteration is not None:
+            on_iteration(iteration, frontier)
+        if frontier_signature(frontier) == last_frontier:
             # we are done if the best frontier does not change
             break
 
     return frontier
 
 
-def main():
+def grid_search(G, t_matrix, trip_arrays, frontier, trip_index=None, score_cache=None, on_iteration=None,
+                first_iteration=0, budget=None, evaluate=None, spacing=GRID_SPACING, refinements=GRID_REFINEMENTS):
+    """
+    Searches for the best new stations like beam_search, but deterministically: scores a grid covering the allowed
+    gap around every terminal of the frontier in one batch, then refines a finer grid around the best nodes.
+    It doesn't evaluate fewer nodes than beam_search: the first grid alone is about 500 nodes around the MBTA's
+    terminals, and a run's searches evaluate about 10% more nodes than with beam_search, in fewer, larger batches.
+    :type first_iteration: int - to resume a search from the frontier after first_iteration - 1
+    :type budget: SearchBudget - if given, the search stops once it's exhausted, with at least the first grid scored
+    :type evaluate: function - if given, scores lists of nodes instead of eval_nodes_for_trips over the trip_arrays
+    :type spacing: float - km between the points of the first grid, divided by 3 at every refinement
+    :type refinements: int - number of finer grids to score around the best nodes
+    :return list[node] - the FRONTIER_SIZE best nodes found
+    """
+    for iteration in xrange(first_iteration, refinements + 1):
+        if iteration > 0 and budget is not None and budget.exhausted():
+            logger.info('Search budget exhausted after %s iterations', iteration)
+            metrics.count('budget_stops')
+            break
+        if iteration == 0:
+            candidates = [
+                (terminal, latlng, NOT_SEEN, NOT_SEEN, NOT_SEEN)
+                for terminal in sorted(set(node[0] for node in frontier))
+                for latlng in disk_grid(G.node[terminal]['latlng'], allowed_gap(terminal), spacing)
+            ]
+        else:
+            # the 8 neighbours of each best node on a 3 times finer grid, which cover its cell
+            refined_spacing = spacing / 3. ** iteration
+            candidates = list(frontier)
+            for terminal, latlng, _, _, _ in frontier:
+                terminal_latlng = G.node[terminal]['latlng']
+                for succ_latlng in disk_grid(latlng, refined_spacing * 1.5, refined_spacing):
+                    if (succ_latlng != latlng).any() and \
+                            latlng_dist(terminal_latlng, succ_latlng) <= allowed_gap(terminal):
+                        candidates.append((terminal, succ_latlng, NOT_SEEN, NOT_SEEN, NOT_SEEN))
+
+        n_candidates = sum(1 for node in candidates if node[2] == NOT_SEEN)
+        metrics.record('candidates_per_iteration', n_candidates)
+        if budget is not None:
+            budget.spend(n_candidates)
+        if evaluate is None:
+            eval_frontier = eval_nodes_for_trips(G, t_matrix, trip_arrays, candidates,
+                                                 trip_index=trip_index, score_cache=score_cache)
+        else:
+            eval_frontier = evaluate(candidates)
+        frontier = heapq.nlargest(FRONTIER_SIZE, eval_frontier, key=lambda tup: tup[2])
+        if on_iteration is not None:
+            on_iteration(iteration, frontier)
+
+    return frontier
+
+
+def terminal_search((i, frontier, seed, resumed)):
+    """
+    Runs the search of the i-th terminal's frontier on the search_data, with its own RNG seed,
+    or resumes it from the (iteration, frontier, rng_state, budget_used) it was interrupted after
+    """
+    random.seed(seed)
+    first_iteration, budget_used = 0, None
+    if resumed is not None:
+        iteration, frontier, rng_state, budget_used = resumed
+        first_iteration = iteration + 1
+        random.setstate(rng_state)
+    budget = search_data['budget']
+    if budget is not None:
+        budget = budget.fresh(budget_used)
+    on_iteration = search_data['on_iteration']
+    return search_data['search'](
+        search_data['graph'], search_data['t_matrix'], search_data['trip_arrays'], frontier,
+        trip_index=search_data['trip_index'], score_cache=search_data['score_cache'],
+        budget=budget, first_iteration=first_iteration,
+        on_iteration=None if on_iteration is None else lambda iteration, iteration_frontier: on_iteration(
+            i, iteration, iteration_frontier, random.getstate(), None if budget is None else budget.used()),
+    )
+
+
+def pooled_terminal_search(task):
+    """ Process pool entry point for terminal_search, also returning the metrics it recorded """
+    metrics.reset()
+    frontier = terminal_search(task)
+    iterations = search_data.get('iterations')
+    if iterations is not None:
+        # marks the end of the search's iterations, the parent reads up to it before the workers exit
+        iterations.put(None)
+    return frontier, metrics.snapshot()
+
+
+def terminal_searches(G, t_matrix, trip_arrays, frontiers, trip_index=None, jobs=1, seed=None, score_cache=None,
+                      search=beam_search, done=None, on_result=None, budget=None, on_iteration=None, resumed=None):
+    """
+    Runs a search per frontier, beam_search or grid_search, in a process pool if jobs > 1.
+    Each search gets its own seed drawn from seed, so results are the same for any number of jobs.
+    With a process pool each worker gets its own copy of the score_cache, its statistics stay in the workers.
+    :type done: dict[int, list[node]] - final frontiers of searches already run, e.g. before resuming a run
+    :type on_result: function - if given, called with the index and final frontier of every search as it finishes
+    :type budget: SearchBudget - limits of every search, each one gets a fresh budget when it starts
+    :type on_iteration: function - if given, called with the index, iteration, frontier, RNG state and budget used,
+        see SearchBudget.used, of every iteration of every search. Pooled searches send them back through a queue,
+        drained while waiting for their results.
+    :type resumed: dict[int, tuple] - (iteration, frontier, rng_state, budget_used) of searches interrupted after an
+        iteration, as given to on_iteration, they carry on from there
+    :return list[list[node]] - the final frontier of each search
+    """
+    rng = random.Random(seed)
+    resumed = resumed or {}
+    tasks = [(i, frontier, rng.randint(0, 2 ** 32 - 1), resumed.get(i)) for i, frontier in enumerate(frontiers)]
+    results = dict(done or {})
+    todo = [i for i in xrange(len(tasks)) if i not in results]
+    search_data.update(graph=G, t_matrix=t_matrix, trip_arrays=trip_arrays, trip_index=trip_index,
+                       score_cache=score_cache, search=search, budget=budget, on_iteration=on_iteration)
+    try:
+        if jobs <= 1:
+            for i in todo:
+                results[i] = terminal_search(tasks[i])
+                if on_result is not None:
+                    on_result(i, results[i])
+            return [results[i] for i in xrange(len(tasks))]
+        iterations = None
+        searches_drained = [0]  # searches whose iterations were all read
+        if on_iteration is not None:
+            iterations = multiprocessing.Queue()
+            search_data.update(on_iteration=lambda *iteration: iterations.put(iteration), iterations=iterations)
+
+        def drain_iterations(block=False):
+            while iterations is not None and searches_drained[0] < len(todo):
+                try:
+                    iteration = iterations.get(block)
+                except Queue.Empty:
+                    return
+                if iteration is None:
+                    searches_drained[0] += 1
+                else:
+                    on_iteration(*iteration)
+
+        # forked workers inherit search_data
+        pool = multiprocessing.Pool(jobs)
+        try:
+            pooled_results = pool.imap(pooled_terminal_search, [tasks[i] for i in todo], chunksize=1)
+            for i in todo:
+                while True:
+                    drain_iterations()
+                    try:
+                        frontier, snapshot = pooled_results.next(timeout=PROGRESS_POLL_SECONDS)
+                        break
+                    except multiprocessing.TimeoutError:
+                        pass
+                metrics.merge(snapshot)
+                results[i] = frontier
+                if on_result is not None:
+                    on_result(i, frontier)
+            # a worker only exits once the queue took everything it put, so it's read to the end before joining
+            drain_iterations(block=True)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        return [results[i] for i in xrange(len(tasks))]
+    finally:
+        search_data.clear()
+
+
+def with_trip_points(trip_arrays, approximate=False):
+    """ Returns the trip_arrays with the TripPoints of their trips """
+    return trip_arrays._replace(points=TripPoints(
+        geo_points(trip_arrays.pickups), geo_points(trip_arrays.dropoffs), approximate))
+
+
+def select_trips(trip_arrays, trip_ids):
+    """ Returns the TripArrays of some of the trips, with their baseline sliced instead of recomputed """
+    points = trip_arrays.points
+    if points is not None:
+        points = TripPoints(GeoPoints(*[column[trip_ids] for column in points.pickups]),
+                            GeoPoints(*[column[trip_ids] for column in points.dropoffs]), points.approximate)
+    return TripArrays(
+        trip_arrays.pickups[trip_ids], trip_arrays.dropoffs[trip_ids], trip_arrays.taxi_times[trip_ids],
+        Baseline(*[column[trip_ids] for column in trip_arrays.baseline]), trip_arrays.station_ids,
+        None if trip_arrays.weights is None else trip_arrays.weights[trip_ids], points,
+    )
+
+
+def commit_station(G, t_matrix, trip_arrays, node, trip_index=None, name=None):
+    """
+    Adds a node's station to the graph, in place, and updates the T times and T_old baseline for it,
+    so later searches are scored against the extended network.
+    Like the scoring, only trips with an endpoint within walking distance of the new station are counted as
+    able to use it, only their baseline is recomputed. Trips further away keep their baseline, even when the
+    new station becomes one of the closest stations build_baseline would look up for them.
+    :type trip_index: TripIndex - over the trip_arrays, built if not given
+    :type name: str - of the new station, defaults to one after its terminal
+    :return tuple[np.array, TripArrays] - the T times matrix and trip arrays including the new station
+    """
+    terminal, latlng = node[:2]
+    if name is None:
+        name = base_name = terminal + ' extension'
+        for i in itertools.count(2):
+            if name not in G:
+                break
+            name = '%s %d' % (base_name, i)
+    t_matrix, station_ids = mbta_graph.add_station(G, t_matrix, trip_arrays.station_ids, terminal, latlng, name)
+
+    station_names = sorted(station_ids, key=station_ids.get)
+    station_tree = cKDTree(scale_latlng([G.node[station]['latlng'] for station in station_names]))
+    if trip_index is None:
+        trip_index = build_trip_index(trip_arrays.pickups, trip_arrays.dropoffs)
+    point = scale_latlng(latlng)
+    radius = km_to_tree_distance(WALKING_LIMIT)
+    trip_ids = np.union1d(
+        trip_index.pickup_tree.query_ball_point(point, radius),
+        trip_index.dropoff_tree.query_ball_point(point, radius),
+    ).astype(np.intp)
+    metrics.count('baseline_trips_updated', len(trip_ids))
+
+    baseline = Baseline(*[np.copy(column) for column in trip_arrays.baseline])
+    updated = build_baseline(t_matrix, station_tree, trip_arrays.pickups[trip_ids],
+                             trip_arrays.dropoffs[trip_ids], trip_arrays.taxi_times[trip_ids])
+    for column, updated_column in zip(baseline, updated):
+        column[trip_ids] = updated_column
+    return t_matrix, trip_arrays._replace(baseline=baseline, station_ids=station_ids)
+
+
+def greedy_plan(G, t_matrix, trip_arrays, k, trip_index=None, search=beam_search):
+    """
+    Plans k new stations one at a time: searches from the current terminals, commits the best node found
+    with commit_station and searches again on the extended network. Stops early if no node improves T times.
+    The graph is copied, G and trip_arrays are left unchanged.
+    :return list[node] - the committed nodes, in order
+    """
+    G = G.copy()
+    if trip_index is None:
+        trip_index = build_trip_index(trip_arrays.pickups, trip_arrays.dropoffs)
+    plan = []
+    for _ in xrange(k):
+        frontier = [
+            (name, G.node[name]['latlng'], NOT_SEEN, NOT_SEEN, NOT_SEEN)
+            for name in G if G.degree(name) == 1
+        ]
+        # scores are only valid for one network, so there is no score cache across steps
+        best = search(G, t_matrix, trip_arrays, frontier, trip_index=trip_index)[0]
+        if best[2] <= 0:
+            break
+        t_matrix, trip_arrays = commit_station(G, t_matrix, trip_arrays, best, trip_index=trip_index)
+        plan.append(best)
+    return plan
+
+
+def load_trips(k, seed=None, stratify=None):
+    """
+    Loads a random sample of k preprocessed trips, from the binary trip store if there is one
+    :return tuple[np.array] - (trips, 2) arrays of pickup and dropoff latlngs, taxi trip times in minutes
+     and pickup epochs
+    """
+    if os.path.exists(PREPROCESSED_BINARY_PATH):
+        # memory mapped, only the sampled trips are read
+        store = read_data.load_trip_store(PREPROCESSED_BINARY_PATH)
+        records = store[read_data.sample_trip_store(store, k, seed=seed, stratify=stratify)]
+        return read_data.trip_store_columns(records) + (records['pickup_time'],)
+
+    # single pass, only the sampled trips are kept
+    with open(PREPROCESSED_PATH, 'rb') as trips_stream:
+        trips = read_data.sample_csv(trips_stream, k, seed=seed, stratify=stratify)
+    return trip_columns(trips) + (np.array([int(trip[2]) for trip in trips], dtype=np.int64),)
+
+
+def trip_chunks(chunk_size):
+    """ Yields every preprocessed trip, from the binary trip store if there is one, in chunks of TRIP_DTYPE records """
+    if os.path.exists(PREPROCESSED_BINARY_PATH):
+        for chunk in read_data.trip_store_chunks(read_data.load_trip_store(PREPROCESSED_BINARY_PATH), chunk_size):
+            yield chunk
+        return
+    with open(PREPROCESSED_PATH, 'rb') as trips_stream:
+        for chunk in read_data.csv_chunks(trips_stream, chunk_size):
+            yield chunk
+
+
+def archive_shard_dir(shard_size):
+    """ Returns the directory of the shards of every preprocessed trip, keyed by the trips, graph and shard size """
+    trips_path = PREPROCESSED_BINARY_PATH if os.path.exists(PREPROCESSED_BINARY_PATH) else PREPROCESSED_PATH
+    stat = os.stat(trips_path)
+    key = repr((trips_path, stat.st_size, stat.st_mtime, mbta_graph.graph_hash(MBTA_YAML_PATH), shard_size))
+    return os.path.join(SHARD_DIR, hashlib.sha1(key).hexdigest())
+
+
+def write_shards(chunks, t_matrix, station_tree, shard_dir):
+    """
+    Writes chunks of TRIP_DTYPE records to .npz shards in shard_dir with their baselines, see build_baseline,
+    keeping only one chunk in memory. The list of shards is written last, so a partially written set of shards
+    is never loaded.
+    :return tuple[list[str], int] - paths of the shards and their number of trips
+    """
+    shard_paths = []
+    n_trips = 0
+    for i, records in enumerate(chunks):
+        pickups, dropoffs, taxi_times = read_data.trip_store_columns(records)
+        baseline = build_baseline(t_matrix, station_tree, pickups, dropoffs, taxi_times)
+        shard_path = os.path.join(shard_dir, 'shard-%05d.npz' % i)
+        write_atomically(shard_path, lambda shard_file: np.savez(
+            shard_file, pickups=pickups, dropoffs=dropoffs, taxi_times=taxi_times, **baseline._asdict()))
+        shard_paths.append(shard_path)
+        n_trips += len(records)
+    write_atomically(os.path.join(shard_dir, 'shards.json'), lambda shards_file: json.dump(
+        {'shards': [os.path.basename(shard_path) for shard_path in shard_paths], 'trips': n_trips}, shards_file))
+    logger.info('Wrote %s trips in %s shards to %s', n_trips, len(shard_paths), shard_dir)
+    return shard_paths, n_trips
+
+
+def load_shards(shard_dir):
+    """ Returns the paths of the shards in shard_dir and their number of trips, None if they weren't all written """
+    list_path = os.path.join(shard_dir, 'shards.json')
+    if not os.path.exists(list_path):
+        return None
+    with open(list_path) as shards_file:
+        shards = json.load(shards_file)
+    return [os.path.join(shard_dir, name) for name in shards['shards']], shards['trips']
+
+
+def load_shard(shard_path, station_ids):
+    """ Returns the TripArrays of a shard written by write_shards """
+    with np.load(shard_path) as shard:
+        baseline = Baseline(*[shard[field] for field in Baseline._fields])
+        return TripArrays(shard['pickups'], shard['dropoffs'], shard['taxi_times'], baseline, station_ids)
+
+
+def eval_nodes_for_shards(G, t_matrix, shard_paths, station_ids, nodes, chunk_size=EVAL_CHUNK_SIZE,
+                          approximate=False):
+    """
+    Evaluates every unseen node against the trips of every shard, like eval_nodes_for_trips against all of
+    them at once. Scores are sums over trips, so each shard is loaded, indexed and scored in turn and its
+    partial scores added up, bounding memory to one shard.
+    :type shard_paths: list[str] - see write_shards
+    :type approximate: bool - whether walking distances use the equirectangular approximation, see geo_dist
+    :return list[node] - the nodes with their scores filled in
+    """
+    results = list(nodes)
+    unseen = [i for i, node in enumerate(nodes) if node[2] == NOT_SEEN]
+    if not unseen:
+        return results
+    unseen_nodes = [nodes[i] for i in unseen]
+    T_difs = np.zeros(len(unseen))
+    taxi_difs = np.zeros(len(unseen))
+    tot_saved = np.zeros(len(unseen), dtype=np.int64)
+    for shard_path in shard_paths:
+        trip_arrays = with_trip_points(load_shard(shard_path, station_ids), approximate)
+        trip_index = build_trip_index(trip_arrays.pickups, trip_arrays.dropoffs)
+        scored = eval_nodes_for_trips(G, t_matrix, trip_arrays, unseen_nodes, trip_index=trip_index,
+                                      chunk_size=chunk_size)
+        T_difs += [node[2] for node in scored]
+        taxi_difs += [node[3] for node in scored]
+        tot_saved += [node[4] for node in scored]
+        metrics.count('shards_scored')
+
+    for k, i in enumerate(unseen):
+        results[i] = nodes[i][:2] + (float(T_difs[k]), float(taxi_difs[k]), int(tot_saved[k]))
+    return results
+
+
+def node_json(node):
+    """ Returns a node as a JSON serializable dict """
+    terminal, latlng, T_difs, taxi_difs, tot_saved = node
+    return {'terminal': terminal, 'latlng': list(latlng), 'T_difs': T_difs, 'taxi_difs': taxi_difs,
+            'tot_saved': tot_saved}
+
+
+def write_progress(stream, event, search, frontier, **data):
+    """ Writes a JSON line of a search's best frontier so far to a progress stream, if there is one """
+    if stream is None:
+        return
+    stream.write(json.dumps(dict(
+        data, event=event, search=search, time=time.time(), frontier=[node_json(node) for node in frontier])) + '\n')
+    stream.flush()
+
+
+def checkpoint_config(args):
+    """ Returns the options of a run that its checkpoints depend on """
+    config = dict(vars(args))
+    for option in ('jobs', 'metrics', 'checkpoint', 'resume', 'progress', 'all_trips', 'shard_size', 'cache_dir'):
+        config.pop(option, None)
+    return config
+
+
+def main(args):
     global zero_count
     zero_count = 0
     logging.basicConfig(level=logging.WARN)
+    random.seed(args.seed)
+
+    # saved after every step, so a crashed run can be resumed
+    run_checkpoint = Checkpoint(args.checkpoint, checkpoint_config(args))
+    if args.resume:
+        run_checkpoint.load()
 
     # Load MBTA graph and taxi trips
-    graph, avg_gap = mbta_graph.build_graph(MBTA_YAML_PATH)
+    with metrics.phase('build_graph'):
+        graph, avg_gap, (station_names, coords, _) = mbta_graph.load_graph(MBTA_YAML_PATH, cache_dir=args.cache_dir)
     logger.debug(avg_gap)
-    with open(PREPROCESSED_PATH, 'rb') as trips_stream:
-        raw_trips = read_data.read_csv(trips_stream)
-
-    random.shuffle(raw_trips)
-    trips = raw_trips[:SAMPLE_NUM]
-
-    T_old = []
-    t_times = nx.shortest_path_length(graph, weight='weight')
-    stations = graph.nodes(data=True)
-
-    coords = np.array(map(lambda (name, data): data['latlng'], stations))
+    with metrics.phase('load_trips'):
+        sample_seed = random.randint(0, 2 ** 32 - 1)
+        trips = run_checkpoint.load_arrays('trips')
+        if trips is None:
+            trips = load_trips(SAMPLE_NUM, seed=sample_seed, stratify=args.stratify)
+            run_checkpoint.save_arrays('trips', trips)
+        pickups, dropoffs, taxi_times, pickup_times = trips
+
+    weights = None
+    if args.bin_size:
+        # score one weighted trip per origin-destination cell and taxi time bucket instead of every trip
+        with metrics.phase('bin_trips'):
+            trip_bins = bin_trips(pickups, dropoffs, taxi_times, args.bin_size, args.bin_minutes)
+        metrics.count('binned_trips', len(taxi_times))
+        metrics.count('trip_bins', len(trip_bins.weights))
+        metrics.record('binning_max_error_km', trip_bins.max_error_km)
+        logger.info('Binned %s trips into %s, moving endpoints up to %.3fkm',
+                    len(taxi_times), len(trip_bins.weights), trip_bins.max_error_km)
+        exact_trips = pickups, dropoffs, taxi_times
+        pickups, dropoffs, taxi_times, weights = trip_bins[:4]
+
+    # stations are ordered like the T times matrix
+    with metrics.phase('shortest_paths'):
+        _, t_matrix = mbta_graph.load_travel_times(graph, MBTA_YAML_PATH, cache_dir=args.cache_dir)
+    station_ids = {name: i for i, name in enumerate(station_names)}
     logger.debug(coords)
 
-    coords[:, 0] *= cos_factor
-    station_tree = cKDTree(coords)  # creates the kd-tree for fast station lookup
+    station_tree = cKDTree(scale_latlng(coords))  # creates the kd-tree for fast station lookup
 
     # calc T_old, initial hypothetical T times for taxi trips
-    for trip in tqdm(trips, unit=' trips'):
-        result = analyze_trip(t_times, stations, station_tree, trip)
-        T_old.append(result)
-
+    with metrics.phase('baseline'):
+        baseline = run_checkpoint.load_arrays('baseline')
+        if baseline is None:
+            baseline = build_baseline(t_matrix, station_tree, pickups, dropoffs, taxi_times)
+            run_checkpoint.save_arrays('baseline', baseline)
+        baseline = Baseline(*baseline)
+    trip_arrays = with_trip_points(TripArrays(pickups, dropoffs, taxi_times, baseline, station_ids, weights),
+                                   args.approximate_distances)
+
+    zero_count = int(((taxi_times == 0) * (1 if weights is None else weights)).sum())
+    metrics.count('zero_count', zero_count)
     # logger.warn("There were " + str(zero_count) + " trips that took 0 time.")
+    # kd-trees over trip endpoints, so new stations are only scored against the trips near them
+    with metrics.phase('trip_index'):
+        trip_index = build_trip_index(trip_arrays.pickups, trip_arrays.dropoffs)
 
     terminals = filter(
         lambda (name, data): graph.degree(nbunch=name) == 1,  # get all nodes of degree 1 (defn of terminus)
@@ -275,25 +1077,144 @@ def main():
     # frontier is a list of node: (terminal, latlng, T_difs, taxi_time_saved, tot_saved)
     frontier = map(lambda (name, data): (name, data['latlng'], NOT_SEEN, NOT_SEEN, NOT_SEEN), terminals)
 
-    print "Running the overall beam search...\n"
-    final_frontier = beam_search(graph, t_times, T_old, trips, frontier)
-
-    print "The best stops for the overall beam search are: "
+    # shared by all the searches of the run
+    score_cache = None
+    if args.cache_size:
+        score_cache = ScoreCache(resolution=args.cache_resolution, max_size=args.cache_size)
+
+    search = grid_search if args.search == 'grid' else beam_search
+    budget = None
+    if args.time_budget or args.eval_budget:
+        budget = SearchBudget(args.time_budget, args.eval_budget)
+    progress = None
+    if args.progress:
+        # a resumed run adds to the progress of the run it resumes
+        progress = sys.stdout if args.progress == '-' else open(args.progress, 'a' if args.resume else 'w')
+    print "Running the overall %s search...\n" % args.search
+    overall_search = run_checkpoint.state.get('overall_search')
+    with metrics.phase('overall_search'):
+        if overall_search is None or not overall_search['done']:
+            search_frontier, first_iteration, budget_used = frontier, 0, None
+            if overall_search is not None:
+                # resume after the last checkpointed iteration
+                search_frontier, first_iteration = overall_search['frontier'], overall_search['iteration'] + 1
+                random.setstate(overall_search['rng_state'])
+                budget_used = overall_search['budget_used']
+            search_budget = budget and budget.fresh(budget_used)
+
+            def on_iteration(iteration, iteration_frontier):
+                run_checkpoint.save(overall_search={
+                    'done': False, 'iteration': iteration, 'frontier': iteration_frontier,
+                    'rng_state': random.getstate(), 'budget_used': search_budget and search_budget.used(),
+                })
+                write_progress(progress, 'iteration', 'overall', iteration_frontier, iteration=iteration)
+
+            final_frontier = search(graph, t_matrix, trip_arrays, search_frontier, trip_index,
+                                    score_cache=score_cache, on_iteration=on_iteration,
+                                    first_iteration=first_iteration, budget=search_budget)
+            overall_search = {'done': True, 'frontier': final_frontier, 'rng_state': random.getstate()}
+            run_checkpoint.save(overall_search=overall_search)
+        final_frontier = overall_search['frontier']
+        random.setstate(overall_search['rng_state'])
+    write_progress(progress, 'done', 'overall', final_frontier)
+    # drawn before the window searches consume the RNG, so they don't depend on which windows were resumed
+    terminal_seed = random.randint(0, 2 ** 32 - 1)
+    plan_seed = random.randint(0, 2 ** 32 - 1)
+
+    print "The best stops for the overall %s search are: " % args.search
     for i, stop in enumerate(final_frontier):
         print str(i + 1) + ". Near terminal " + stop[0] + ", location " + str(stop[1]) + " saves " + str(
             stop[2]) + "min of T time"
 
+    if args.bin_size:
+        # how far the binned scores of the best stops are from their scores on every trip
+        exact_trip_arrays = with_trip_points(TripArrays(
+            *exact_trips, baseline=build_baseline(t_matrix, station_tree, *exact_trips), station_ids=station_ids),
+            args.approximate_distances)
+        with metrics.phase('binning_error'):
+            errors = binning_errors(graph, t_matrix, trip_arrays, exact_trip_arrays, final_frontier, trip_index,
+                                    build_trip_index(exact_trip_arrays.pickups, exact_trip_arrays.dropoffs))
+        for error in errors:
+            metrics.record('binning_T_difs_relative_error', error)
+        print "Relative error of the binned T time savings of the best stops: max " + str(max(errors))
+
+    if args.window:
+        with metrics.phase('time_index'):
+            time_index = build_time_index(pickup_times)
+    window_frontiers = run_checkpoint.state.get('window_searches', {})
+    # the last checkpointed iteration of the window being searched
+    window_progress = run_checkpoint.state.get('window_progress', {})
+    if 'window_rng_state' in run_checkpoint.state:
+        # the windows are searched in order, so the next one starts from the RNG of the last one searched
+        random.setstate(run_checkpoint.state['window_rng_state'])
+    for window in args.window:
+        # the trips of the window, with the baseline computed once for all of them
+        window_trip_arrays = select_trips(trip_arrays, window_trips(time_index, *parse_window(window)))
+        print "Running the %s search over the %d trips picked up in %s...\n" % (
+            args.search, len(window_trip_arrays.taxi_times), window)
+        if window not in window_frontiers:
+            search_frontier, first_iteration, budget_used = frontier, 0, None
+            if window in window_progress:
+                # resume after the last checkpointed iteration
+                search_frontier = window_progress[window]['frontier']
+                first_iteration = window_progress[window]['iteration'] + 1
+                random.setstate(window_progress[window]['rng_state'])
+                budget_used = window_progress[window]['budget_used']
+            search_budget = budget and budget.fresh(budget_used)
+
+            def on_window_iteration(iteration, iteration_frontier):
+                window_progress[window] = {
+                    'iteration': iteration, 'frontier': iteration_frontier, 'rng_state': random.getstate(),
+                    'budget_used': search_budget and search_budget.used(),
+                }
+                run_checkpoint.save(window_progress=window_progress)
+                write_progress(progress, 'iteration', window, iteration_frontier, iteration=iteration)
+
+            with metrics.phase('window_search ' + window):
+                window_trip_index = build_trip_index(window_trip_arrays.pickups, window_trip_arrays.dropoffs)
+                # scores are only valid for one window, so there is no score cache
+                window_frontiers[window] = search(
+                    graph, t_matrix, window_trip_arrays, search_frontier, window_trip_index,
+                    on_iteration=on_window_iteration, first_iteration=first_iteration, budget=search_budget,
+                )
+            run_checkpoint.save(window_searches=window_frontiers, window_rng_state=random.getstate())
+        window_frontier = window_frontiers[window]
+        write_progress(progress, 'done', window, window_frontier)
+        print "The best stops for " + window + " are: "
+        for i, stop in enumerate(window_frontier[:3]):
+            print str(i + 1) + ". Near terminal " + stop[0] + ", location " + str(stop[1]) + " saves " + str(
+                stop[2]) + "min of T time"
+        print "\n"
+
     frontiers = []  # allows us to run once per terminal
     print "\n"
     for term in frontier:
         term_list = [term]
         frontiers.append(term_list)
 
-    final_frontiers = []
-    print "Running the by-terminal beam search\n"
-    for front in frontiers:
-        final_front = beam_search(graph, t_times, T_old, trips, front)
-        final_frontiers.append(final_front)
+    print "Running the by-terminal %s search\n" % args.search
+    done_frontiers = run_checkpoint.state.get('terminal_searches', {})
+    # the last checkpointed (iteration, frontier, rng_state) of the searches that were running
+    terminal_progress = run_checkpoint.state.get('terminal_progress', {})
+
+    def on_result(i, terminal_frontier):
+        done_frontiers[i] = terminal_frontier
+        run_checkpoint.save(terminal_searches=done_frontiers)
+        write_progress(progress, 'done', frontiers[i][0][0], terminal_frontier)
+
+    def on_terminal_iteration(i, iteration, terminal_frontier, rng_state, budget_used):
+        terminal_progress[i] = iteration, terminal_frontier, rng_state, budget_used
+        run_checkpoint.save(terminal_progress=terminal_progress)
+        write_progress(progress, 'iteration', frontiers[i][0][0], terminal_frontier, iteration=iteration)
+
+    with metrics.phase('terminal_searches'):
+        final_frontiers = terminal_searches(
+            graph, t_matrix, trip_arrays, frontiers, trip_index,
+            jobs=args.jobs, seed=terminal_seed, score_cache=score_cache, search=search,
+            done=done_frontiers, on_result=on_result, budget=budget,
+            on_iteration=on_terminal_iteration,
+            resumed={i: last for i, last in terminal_progress.iteritems() if i not in done_frontiers},
+        )
 
     for f in final_frontiers:
         print "The best three locations for " + f[0][0] + " are: "
@@ -301,6 +1222,108 @@ def main():
         print "2. " + str(f[1][1]) + ", saving " + str(f[1][2]) + " T time"
         print "3. " + str(f[2][1]) + ", saving " + str(f[2][2]) + " T time\n\n"
 
+    if args.all_trips:
+        # the sample's best stops, rescored against every trip out of core
+        with metrics.phase('shards'):
+            shard_dir = archive_shard_dir(args.shard_size)
+            shards = load_shards(shard_dir)
+            if shards is None:
+                shards = write_shards(trip_chunks(args.shard_size), t_matrix, station_tree, shard_dir)
+        shard_paths, n_trips = shards
+        best_stops = final_frontier[:3] + [f[0] for f in final_frontiers]
+        with metrics.phase('score_all_trips'):
+            all_trips_stops = eval_nodes_for_shards(
+                graph, t_matrix, shard_paths, station_ids,
+                [(terminal, latlng, NOT_SEEN, NOT_SEEN, NOT_SEEN) for terminal, latlng, _, _, _ in best_stops],
+                approximate=args.approximate_distances)
+        metrics.count('all_trips', n_trips)
+        print "The best stops scored against all %d trips are: " % n_trips
+        for i, stop in enumerate(all_trips_stops):
+            print str(i + 1) + ". Near terminal " + stop[0] + ", location " + str(stop[1]) + " saves " + str(
+                stop[2]) + "min of T time"
+        print "\n"
+
+    if args.plan:
+        print "Planning %d new stations greedily\n" % args.plan
+        with metrics.phase('plan'):
+            plan = run_checkpoint.state.get('plan')
+            if plan is None:
+                # terminal searches run in this process reseed the RNG
+                random.seed(plan_seed)
+                plan = greedy_plan(graph, t_matrix, trip_arrays, args.plan, trip_index, search=search)
+                run_checkpoint.save(plan=plan)
+        for i, stop in enumerate(plan):
+            print str(i + 1) + ". Extend " + stop[0] + " to " + str(stop[1]) + ", saving " + str(
+                stop[2]) + "min of T time"
+
+    if score_cache is not None:
+        logger.info('Score cache: %s', score_cache.stats())
+        for name, n in score_cache.stats().iteritems():
+            metrics.count('score_cache_' + name, n)
+    if progress not in (None, sys.stdout):
+        progress.close()
+    metrics.write_report(args.metrics)
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-j", "--jobs", type=int, default=1,
+                    help="Number of by-terminal beam searches to run in parallel")
+parser.add_argument("-s", "--seed", type=int,
+                    help="Seed for sampling trips and the beam searches, so runs can be reproduced")
+parser.add_argument("--stratify", choices=['month', 'hour'],
+                    help="Stratify the trip sample by the month or hour of day of the pickups")
+parser.add_argument("--search", choices=['beam', 'grid'], default='beam',
+                    help="Random beam search, or deterministic grid search scoring grids around the terminals "
+                         "then finer grids around the best stops")
+parser.add_argument("--time-budget", type=float,
+                    help="Seconds each search may run for, it then stops with its best stops so far")
+parser.add_argument("--eval-budget", type=int,
+                    help="Number of candidate stops each search may evaluate, it then stops with its best stops so far")
+parser.add_argument("--progress",
+                    help="Path of a JSON lines stream of every search's best stops after each iteration, - for stdout")
+parser.add_argument("--cache-size", type=int, default=SCORE_CACHE_SIZE,
+                    help="Number of node scores to cache across searches, 0 disables the cache. It only pays off for "
+                         "--search grid, whose searches score the same grid points, the beam search's random "
+                         "successors rarely share a cell")
+parser.add_argument("--cache-resolution", type=float, default=SCORE_CACHE_RESOLUTION,
+                    help="Grid resolution (degrees of lat/lng) of the score cache, nodes in a grid cell share a score")
+parser.add_argument("--approximate-distances", action='store_true',
+                    help="Use the equirectangular approximation of walking distances instead of haversine")
+parser.add_argument("--bin-size", type=float, default=0,
+                    help="Grid cell size (km) to bin trips by pickup and dropoff cell, 0 scores every trip")
+parser.add_argument("--bin-minutes", type=float, default=BIN_TIME_BUCKET,
+                    help="Taxi time bucket (min) of the trip bins")
+parser.add_argument("--window", action='append', default=[],
+                    help="Also search over only the trips picked up in a time window, e.g. weekday:7-10 or 22-2, "
+                         "can be given several times")
+parser.add_argument("--plan", type=int, default=0,
+                    help="Number of new stations to plan greedily, each one searched with the previous ones built")
+parser.add_argument("--all-trips", action='store_true',
+                    help="Also score the best stops against every preprocessed trip, out of core in shards on disk")
+parser.add_argument("--shard-size", type=int, default=SHARD_SIZE,
+                    help="Number of trips per shard of --all-trips, bounds its memory")
+parser.add_argument("--checkpoint", default=CHECKPOINT_PATH,
+                    help="Path of the checkpoint saved after every search iteration and finished search")
+parser.add_argument("--resume", action='store_true',
+                    help="Resume from the checkpoint of a run with the same options, skipping its finished work and "
+                         "carrying on its searches after their last iteration. A --plan is planned again unless it "
+                         "was finished")
+parser.add_argument("--cache-dir", default=CACHE_DIR,
+                    help="Directory the graph and its T times are cached in")
+parser.add_argument("--metrics", default=METRICS_PATH,
+                    help="Path of the JSON report of phase timings, memory and counters to be output")
 
 if __name__ == "__main__":
-    main()
+    args = parser.parse_args()
+    for window in args.window:
+        try:
+            parse_window(window)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.search == 'grid' and args.cache_size and \
+            ScoreCache(args.cache_resolution).cell_km() >= GRID_SPACING / 3 ** GRID_REFINEMENTS / 2:
+        # neighbouring points of the finest grid would share a cached score
+        parser.error('--cache-resolution is too coarse for the finest grid of --search grid')
+    if args.window and args.bin_size:
+        parser.error('Binned trips mix pickup times, --window can\'t be used with --bin-size')
+    main(args)
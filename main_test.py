@@ -0,0 +1,523 @@
+# Tests for the trip evaluation in main
+
+import json
+import os
+import random
+import shutil
+import StringIO
+import tempfile
+
+import networkx as nx
+from nose.tools import *
+from scipy.spatial import cKDTree
+
+import main
+import mbta_graph
+import read_data
+from checkpoint import Checkpoint
+from constants import MBTA_YAML_PATH, NOT_SEEN, FRONTIER_SIZE, GRID_SPACING, GRID_REFINEMENTS
+from util import *
+
+graph = None
+t_times = None
+t_matrix = None
+station_ids = None
+stations = None
+station_tree = None
+
+
+def setup_module():
+    global graph, t_times, t_matrix, station_ids, stations, station_tree
+    graph, _ = mbta_graph.build_graph(MBTA_YAML_PATH)
+    t_times = nx.shortest_path_length(graph, weight='weight')
+    cache_dir = tempfile.mkdtemp()
+    try:
+        station_names, t_matrix = mbta_graph.load_travel_times(graph, MBTA_YAML_PATH, cache_dir=cache_dir)
+    finally:
+        shutil.rmtree(cache_dir)
+    station_ids = {name: i for i, name in enumerate(station_names)}
+    stations = [(name, graph.node[name]) for name in station_names]
+    coords = np.array([data['latlng'] for _, data in stations])
+    coords[:, 0] *= cos_factor
+    station_tree = cKDTree(coords)
+    main.zero_count = 0
+
+
+def make_trips(n, seed=0):
+    """ Random trips starting and ending near random stations """
+    rng = random.Random(seed)
+    trips = []
+    for _ in xrange(n):
+        _, from_data = rng.choice(stations)
+        _, to_data = rng.choice(stations)
+        t_start = rng.randint(1338500000, 1341000000) // 60 * 60
+        # some zero time trips to exercise INVALID_TRIP
+        t_stop = t_start + rng.choice([0, 60, 300, 600, 1200, 1800, 2700])
+        trips.append((
+            make_latlng(from_data['lat'] + rng.uniform(-.008, .008), from_data['long'] + rng.uniform(-.008, .008)),
+            make_latlng(to_data['lat'] + rng.uniform(-.008, .008), to_data['long'] + rng.uniform(-.008, .008)),
+            str(t_start), str(t_stop),
+        ))
+    return trips
+
+
+def make_nodes(seed=0):
+    """ Unseen nodes at every terminal and a few random successors of each """
+    random.seed(seed)
+    terminals = [name for name in graph if graph.degree(name) == 1]
+    nodes = [(name, graph.node[name]['latlng'], NOT_SEEN, NOT_SEEN, NOT_SEEN) for name in terminals]
+    return nodes + [main.get_random_successor(graph, node) for node in nodes for _ in xrange(3)]
+
+
+def test_eval_nodes_for_trips():
+    trips = make_trips(2000)
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    trip_arrays = main.make_trip_arrays(trips, T_old, station_ids)
+    nodes = make_nodes()
+
+    expected = [main.eval_node_for_trips(graph, t_matrix, trip_arrays, node) for node in nodes]
+    # small chunks to make sure partial sums are accumulated
+    result = main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, nodes, chunk_size=300)
+
+    assert len(result) == len(expected)
+    assert any(node[2] > 0 for node in expected)
+    for node, expected_node in zip(result, expected):
+        assert node[0] == expected_node[0]
+        assert node[1] is expected_node[1]
+        assert_almost_equal(node[2], expected_node[2], places=6)
+        assert_almost_equal(node[3], expected_node[3], places=6)
+        assert node[4] == expected_node[4]
+
+
+def test_eval_nodes_for_trips_seen():
+    trips = make_trips(10)
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    trip_arrays = main.make_trip_arrays(trips, T_old, station_ids)
+    seen = ('Alewife Station', graph.node['Alewife Station']['latlng'], 1.0, 2.0, 3)
+
+    assert main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, [seen]) == [seen]
+
+
+def test_eval_nodes_for_trips_trip_index():
+    trips = make_trips(2000, seed=1)
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    trip_arrays = main.make_trip_arrays(trips, T_old, station_ids)
+    trip_index = build_trip_index(trip_arrays.pickups, trip_arrays.dropoffs)
+    nodes = make_nodes(seed=1)
+
+    expected = main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, nodes)
+    result = main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, nodes, trip_index=trip_index, chunk_size=50)
+    for node, expected_node in zip(result, expected):
+        assert_almost_equal(node[2], expected_node[2], places=6)
+        assert_almost_equal(node[3], expected_node[3], places=6)
+        assert node[4] == expected_node[4]
+
+    for node in nodes[:5]:
+        expected_node = main.eval_node_for_trips(graph, t_matrix, trip_arrays, node)
+        node = main.eval_node_for_trips(graph, t_matrix, trip_arrays, node, trip_index=trip_index)
+        assert_almost_equal(node[2], expected_node[2], places=6)
+        assert node[4] == expected_node[4]
+
+
+def test_eval_nodes_for_trips_trip_points():
+    trips = make_trips(2000, seed=2)
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    trip_arrays = main.make_trip_arrays(trips, T_old, station_ids)
+    trip_index = build_trip_index(trip_arrays.pickups, trip_arrays.dropoffs)
+    nodes = make_nodes(seed=2)
+
+    # cached trip points, sliced by chunk and by trip index, give the same scores
+    expected = main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, nodes, trip_index=trip_index)
+    result = main.eval_nodes_for_trips(graph, t_matrix, main.with_trip_points(trip_arrays), nodes,
+                                       trip_index=trip_index, chunk_size=300)
+    assert result == expected
+    trip_ids = np.arange(0, len(trips), 3)
+    assert main.eval_nodes_for_trips(graph, t_matrix, main.select_trips(main.with_trip_points(trip_arrays), trip_ids),
+                                     nodes) == \
+        main.eval_nodes_for_trips(graph, t_matrix, main.select_trips(trip_arrays, trip_ids), nodes)
+
+    # the equirectangular approximation barely moves the scores over walking distances
+    approximate = main.eval_nodes_for_trips(graph, t_matrix, main.with_trip_points(trip_arrays, approximate=True),
+                                            nodes, trip_index=trip_index)
+    assert any(node[2] > 0 for node in expected)
+    for node, expected_node in zip(approximate, expected):
+        assert abs(node[2] - expected_node[2]) <= .01 * abs(expected_node[2]) + 1
+
+
+def test_build_baseline():
+    trips = make_trips(1000, seed=2)
+    # one trip far from any station
+    trips.append((make_latlng(45., -60.), make_latlng(45.01, -60.), '1338500000', '1338500600'))
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    expected = main.make_baseline(T_old, station_ids)
+
+    pickups, dropoffs, taxi_times = main.trip_columns(trips)
+    best_times, from_stations, from_walks, to_stations, to_walks, valid = main.build_baseline(
+        t_matrix, station_tree, pickups, dropoffs, taxi_times, chunk_size=128)
+
+    assert np.isnan(best_times[-1])
+    assert np.isnan(best_times[taxi_times == 0]).all()
+    assert (np.isnan(best_times) == np.isnan(expected.t_old)).all()
+    assert (valid == ~np.isnan(best_times)).all()
+    assert (valid == expected.valid).all()
+    assert (best_times[valid] == expected.t_old[valid]).all()
+    assert (from_walks[valid] == expected.from_walks[valid]).all()
+    assert (to_walks[valid] == expected.to_walks[valid]).all()
+    assert (from_stations == expected.from_stations).all()
+    assert (to_stations == expected.to_stations).all()
+    assert (from_stations[~valid] == -1).all()
+
+
+def test_terminal_searches():
+    trips = make_trips(1000, seed=3)
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    trip_arrays = main.make_trip_arrays(trips, T_old, station_ids)
+    frontiers = [[node] for node in make_nodes()[:3]]
+
+    serial_iterations, parallel_iterations = [], []
+    serial = main.terminal_searches(graph, t_matrix, trip_arrays, frontiers, seed=4,
+                                    on_iteration=lambda *iteration: serial_iterations.append(iteration))
+    parallel = main.terminal_searches(graph, t_matrix, trip_arrays, frontiers, jobs=2, seed=4,
+                                      on_iteration=lambda *iteration: parallel_iterations.append(iteration))
+    assert len(serial) == 3
+    assert [[(node[0], list(node[1]), node[2]) for node in frontier] for frontier in serial] == \
+        [[(node[0], list(node[1]), node[2]) for node in frontier] for frontier in parallel]
+    assert main.search_data == {}
+
+    # the pooled searches' iterations are sent back to the parent
+    assert sorted(set(iteration[0] for iteration in serial_iterations)) == [0, 1, 2]
+    assert sorted((i, iteration, [node[2] for node in frontier])
+                  for i, iteration, frontier, _, _ in parallel_iterations) == \
+        sorted((i, iteration, [node[2] for node in frontier]) for i, iteration, frontier, _, _ in serial_iterations)
+
+
+def test_score_cache():
+    score_cache = main.ScoreCache(resolution=0.001, max_size=2)
+    key = score_cache.key('Alewife Station', make_latlng(42.3951, -71.1412))
+    assert key == score_cache.key('Alewife Station', make_latlng(42.3949, -71.1414))
+    assert key != score_cache.key('Alewife Station', make_latlng(42.3949, -71.1424))
+    assert key != score_cache.key('Davis Station', make_latlng(42.3951, -71.1412))
+
+    assert score_cache.get(key) is None
+    score_cache.put(key, (1., 2., 3))
+    score_cache.put(('a', 0, 0), (0., 0., 0))
+    assert score_cache.get(key) == (1., 2., 3)
+    # the least recently used is evicted
+    score_cache.put(('b', 0, 0), (0., 0., 0))
+    assert score_cache.get(('a', 0, 0)) is None
+    assert score_cache.get(key) == (1., 2., 3)
+    assert score_cache.stats() == {'hits': 2, 'misses': 2, 'evictions': 1, 'size': 2}
+
+    # by default every point of the grid search's finest grid has its own score
+    score_cache = main.ScoreCache()
+    grid = disk_grid(graph.node['Alewife Station']['latlng'], 0.1, GRID_SPACING / 3 ** GRID_REFINEMENTS)
+    assert len(set(score_cache.key('Alewife Station', latlng) for latlng in grid)) == len(grid)
+
+
+def test_eval_nodes_for_trips_score_cache():
+    trips = make_trips(1000, seed=5)
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    trip_arrays = main.make_trip_arrays(trips, T_old, station_ids)
+    nodes = make_nodes(seed=5)
+    score_cache = main.ScoreCache(resolution=1e-9)
+
+    expected = main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, nodes)
+    result = main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, nodes, score_cache=score_cache)
+    assert result == expected
+    assert score_cache.stats()['misses'] == len(nodes)
+
+    # nodes in evaluated cells are not evaluated again
+    again = [(node[0], node[1].copy(), NOT_SEEN, NOT_SEEN, NOT_SEEN) for node in nodes]
+    result = main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, again + again, score_cache=score_cache)
+    assert [node[2:] for node in result] == [node[2:] for node in expected + expected]
+    assert score_cache.stats()['hits'] == len(nodes)
+
+
+def test_commit_station():
+    trips = make_trips(2000, seed=6)
+    pickups, dropoffs, taxi_times = main.trip_columns(trips)
+    baseline = main.build_baseline(t_matrix, station_tree, pickups, dropoffs, taxi_times)
+    trip_arrays = main.TripArrays(pickups, dropoffs, taxi_times, baseline, station_ids)
+    extended = graph.copy()
+    node = ('Dudley Square Station', graph.node['Dudley Square Station']['latlng'] + [0.004, -0.004],
+            NOT_SEEN, NOT_SEEN, NOT_SEEN)
+
+    new_t_matrix, new_trip_arrays = main.commit_station(extended, t_matrix, trip_arrays, node)
+    assert len(extended) == len(graph) + 1
+    assert (trip_arrays.baseline.from_stations < len(t_matrix)).all()  # left unchanged
+
+    # trips within walking distance of the new station are the same as rebuilding the baseline from scratch
+    near = np.array([is_trip_relevant(trip[:2], node, True) for trip in trips])
+    far = ~np.array([is_trip_relevant(trip[:2], node, True, walking_limit=1.) for trip in trips])
+    assert near.sum() > 0
+    assert far.sum() > len(trips) * 0.9
+    station_names = sorted(new_trip_arrays.station_ids, key=new_trip_arrays.station_ids.get)
+    new_station_tree = cKDTree(scale_latlng([extended.node[name]['latlng'] for name in station_names]))
+    expected = main.build_baseline(new_t_matrix, new_station_tree, pickups, dropoffs, taxi_times)
+    for column, old_column, expected_column in zip(new_trip_arrays.baseline, baseline, expected):
+        assert np.allclose(column[near], expected_column[near], equal_nan=True)
+        # trips further away than the kd-tree lookup, a superset of walking distance, aren't recomputed
+        assert np.allclose(column[far], old_column[far], equal_nan=True)
+    new_id = new_trip_arrays.station_ids['Dudley Square Station extension']
+    new_baseline = new_trip_arrays.baseline
+    assert ((new_baseline.from_stations == new_id) | (new_baseline.to_stations == new_id)).any()
+
+
+def test_greedy_plan():
+    trips = make_trips(1000, seed=7)
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    trip_arrays = main.make_trip_arrays(trips, T_old, station_ids)
+    n_stations = len(graph)
+
+    random.seed(7)
+    plan = main.greedy_plan(graph, t_matrix, trip_arrays, 2)
+    assert len(graph) == n_stations
+    assert 1 <= len(plan) <= 2
+    assert all(node[2] > 0 for node in plan)
+
+
+def test_eval_nodes_for_trips_weights():
+    trips = make_trips(500, seed=8)
+    pickups, dropoffs, taxi_times = main.trip_columns(trips)
+    nodes = make_nodes(seed=8)
+    repeats = np.random.RandomState(8).randint(1, 4, size=len(trips))
+    repeated = [np.repeat(column, repeats, axis=0) for column in (pickups, dropoffs, taxi_times)]
+    repeated_arrays = main.TripArrays(
+        *repeated, baseline=main.build_baseline(t_matrix, station_tree, *repeated), station_ids=station_ids)
+
+    # bins of identical trips score like every trip
+    trip_bins = bin_trips(repeated[0], repeated[1], repeated[2], cell_size=0.001, time_bucket=1)
+    assert (np.sort(trip_bins.weights) == np.sort(repeats)).all()
+    trip_arrays = main.TripArrays(
+        *trip_bins[:3], baseline=main.build_baseline(t_matrix, station_tree, *trip_bins[:3]),
+        station_ids=station_ids, weights=trip_bins.weights)
+    expected = main.eval_nodes_for_trips(graph, t_matrix, repeated_arrays, nodes)
+    result = main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, nodes, chunk_size=100)
+    for node, expected_node in zip(result, expected):
+        assert_almost_equal(node[2], expected_node[2], places=6)
+        assert_almost_equal(node[3], expected_node[3], places=6)
+        assert node[4] == expected_node[4]
+    assert main.binning_errors(graph, t_matrix, trip_arrays, repeated_arrays, nodes) == [0.] * len(nodes)
+
+
+def test_grid_search():
+    trips = make_trips(1000, seed=9)
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    trip_arrays = main.make_trip_arrays(trips, T_old, station_ids)
+    frontier = [node for node in make_nodes() if node[0] in ('Alewife Station', 'Dudley Square Station')]
+
+    result = main.grid_search(graph, t_matrix, trip_arrays, frontier, spacing=0.2, refinements=2)
+    again = main.grid_search(graph, t_matrix, trip_arrays, frontier, spacing=0.2, refinements=2)
+    assert [(node[0], list(node[1])) + node[2:] for node in result] == \
+        [(node[0], list(node[1])) + node[2:] for node in again]
+    assert len(result) == FRONTIER_SIZE
+    assert result[0][2] >= result[-1][2]
+    for terminal, latlng, _, _, _ in result:
+        assert latlng_dist(graph.node[terminal]['latlng'], latlng) <= main.allowed_gap(terminal)
+    # the refinements only improve on the best node of the first grid
+    assert result[0][2] >= main.grid_search(graph, t_matrix, trip_arrays, frontier, spacing=0.2, refinements=0)[0][2]
+
+
+def test_select_trips():
+    trips = make_trips(1000, seed=10)
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    trip_arrays = main.make_trip_arrays(trips, T_old, station_ids)
+    pickup_times = np.array([int(trip[2]) for trip in trips])
+    trip_ids = window_trips(build_time_index(pickup_times), *parse_window('weekday:7-10'))
+    assert 0 < len(trip_ids) < len(trips)
+    nodes = make_nodes(seed=10)
+
+    # slicing the baseline is the same as computing it for the window's trips
+    expected = main.make_trip_arrays([trips[i] for i in trip_ids], [T_old[i] for i in trip_ids], station_ids)
+    window_trip_arrays = main.select_trips(trip_arrays, trip_ids)
+    assert main.eval_nodes_for_trips(graph, t_matrix, window_trip_arrays, nodes) == \
+        main.eval_nodes_for_trips(graph, t_matrix, expected, nodes)
+
+
+def test_resume_searches():
+    trips = make_trips(1000, seed=11)
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    trip_arrays = main.make_trip_arrays(trips, T_old, station_ids)
+    frontier = make_nodes()[:4]
+    checkpoints = {}
+
+    def on_iteration(iteration, iteration_frontier):
+        checkpoints[iteration] = iteration_frontier, random.getstate()
+
+    random.seed(11)
+    expected = main.beam_search(graph, t_matrix, trip_arrays, frontier, on_iteration=on_iteration)
+    assert len(checkpoints) >= 2
+    # resuming from an iteration finds the same stops
+    checkpoint_frontier, rng_state = checkpoints[0]
+    random.setstate(rng_state)
+    result = main.beam_search(graph, t_matrix, trip_arrays, checkpoint_frontier, first_iteration=1)
+    assert [node[2:] for node in result] == [node[2:] for node in expected]
+
+    expected = main.grid_search(graph, t_matrix, trip_arrays, frontier, on_iteration=on_iteration, refinements=2)
+    result = main.grid_search(graph, t_matrix, trip_arrays, checkpoints[0][0], first_iteration=1, refinements=2)
+    assert [node[2:] for node in result] == [node[2:] for node in expected]
+
+    # finished terminal searches aren't run again
+    frontiers = [[node] for node in frontier]
+    results = {}
+    expected = main.terminal_searches(graph, t_matrix, trip_arrays, frontiers, seed=12,
+                                      on_result=results.__setitem__)
+    assert sorted(results) == range(4)
+    finished = []
+    result = main.terminal_searches(graph, t_matrix, trip_arrays, frontiers, seed=12, jobs=2,
+                                    done={0: results[0], 2: results[2]}, on_result=lambda i, _: finished.append(i))
+    assert sorted(finished) == [1, 3]
+    assert [[node[2:] for node in f] for f in result] == [[node[2:] for node in f] for f in expected]
+
+
+def test_search_budget():
+    trips = make_trips(1000, seed=12)
+    T_old = [main.analyze_trip(t_times, stations, station_tree, trip) for trip in trips]
+    trip_arrays = main.make_trip_arrays(trips, T_old, station_ids)
+    frontier = make_nodes()[:4]
+    iterations = []
+
+    # the first iteration's evaluations exhaust the budget
+    result = main.beam_search(graph, t_matrix, trip_arrays, frontier, budget=main.SearchBudget(evaluations=1),
+                              on_iteration=lambda iteration, _: iterations.append(iteration))
+    assert iterations == [0]
+    assert len(result) == FRONTIER_SIZE
+    assert all(node[2] != NOT_SEEN for node in result)
+
+    # a beam search always scores its first iteration, even with no budget at all
+    del iterations[:]
+    result = main.beam_search(graph, t_matrix, trip_arrays, frontier, budget=main.SearchBudget(seconds=0),
+                              on_iteration=lambda iteration, _: iterations.append(iteration))
+    assert iterations == [0]
+    assert len(result) == FRONTIER_SIZE
+    assert all(node[2] != NOT_SEEN for node in result)
+
+    # a grid search always scores its first grid
+    del iterations[:]
+    result = main.grid_search(graph, t_matrix, trip_arrays, frontier, budget=main.SearchBudget(seconds=0),
+                              on_iteration=lambda iteration, _: iterations.append(iteration))
+    assert iterations == [0]
+    assert result[0][2] == main.grid_search(graph, t_matrix, trip_arrays, frontier, refinements=0)[0][2]
+
+    budget = main.SearchBudget(seconds=60, evaluations=10)
+    assert not budget.exhausted()
+    budget.spend(10)
+    assert budget.exhausted()
+    assert not budget.fresh().exhausted()
+
+
+class Crash(Exception):
+    pass
+
+
+def test_resume_main():
+    run_dir = tempfile.mkdtemp()
+    try:
+        checkpoint_path = os.path.join(run_dir, 'checkpoint.pkl')
+        args = main.parser.parse_args([
+            '--seed', '13', '--window', 'weekday:7-10', '--eval-budget', '100', '--plan', '1', '--resume',
+            '--checkpoint', checkpoint_path, '--metrics', os.path.join(run_dir, 'metrics.json'),
+            '--progress', os.path.join(run_dir, 'progress.jsonl'), '--cache-dir', run_dir,
+        ])
+        # the run's trip sample, so it isn't read from the preprocessed trips
+        trips = make_trips(1000, seed=13)
+        run_checkpoint = Checkpoint(checkpoint_path, main.checkpoint_config(args))
+        run_checkpoint.save_arrays('trips', main.trip_columns(trips) + (np.array([int(trip[2]) for trip in trips]),))
+        main.main(args)
+        run_checkpoint.load()
+        expected = dict(run_checkpoint.state)
+        with open(args.progress) as progress:
+            expected_progress = progress.readlines()
+        assert expected['window_searches'] and expected['terminal_searches'] and expected['plan']
+        write_progress_to_stream = main.write_progress
+
+        def stops(frontier):
+            return [(node[0], list(node[1])) + tuple(node[2:]) for node in frontier]
+
+        def assert_same_searches():
+            run_checkpoint.load()
+            assert stops(run_checkpoint.state['plan']) == stops(expected['plan'])
+            assert {i: stops(frontier) for i, frontier in run_checkpoint.state['terminal_searches'].iteritems()} == \
+                {i: stops(frontier) for i, frontier in expected['terminal_searches'].iteritems()}
+            assert {window: stops(frontier) for window, frontier in run_checkpoint.state['window_searches'].iteritems()
+                    } == {window: stops(frontier) for window, frontier in expected['window_searches'].iteritems()}
+
+        # crashed after the window search, then after the terminal searches
+        for lost in (['terminal_searches', 'terminal_progress', 'plan'], ['plan']):
+            run_checkpoint.state = {key: value for key, value in expected.iteritems() if key not in lost}
+            run_checkpoint.save()
+            main.main(args)
+            assert_same_searches()
+
+        # crashed in the middle of the window search, then of the second terminal search
+        for crash_search, crash_iteration in (('weekday:7-10', 0), (expected['terminal_searches'][1][0][0], 0)):
+            run_checkpoint.state = {key: value for key, value in expected.iteritems()
+                                    if key in ('trips_arrays', 'baseline_arrays', 'overall_search')}
+            run_checkpoint.save()
+            crashed, iterations = [], []
+
+            def write_progress(stream, event, search, frontier, **data):
+                if event == 'iteration' and search == crash_search:
+                    if crashed:
+                        iterations.append(data['iteration'])
+                    elif data['iteration'] == crash_iteration:
+                        crashed.append(data['iteration'])
+                        raise Crash()
+
+            main.write_progress = write_progress
+            try:
+                assert_raises(Crash, main.main, args)
+                main.main(args)
+            finally:
+                main.write_progress = write_progress_to_stream
+            # the search carried on after the crashed iteration instead of starting over
+            assert iterations[0] == crash_iteration + 1
+            assert_same_searches()
+
+        # the resumed runs' progress follows the first run's
+        with open(args.progress) as progress:
+            lines = progress.readlines()
+        assert lines[:len(expected_progress)] == expected_progress
+        assert len(lines) > len(expected_progress)
+    finally:
+        shutil.rmtree(run_dir)
+
+
+def test_write_progress():
+    stream = StringIO.StringIO()
+    frontier = make_nodes()[:2]
+    main.write_progress(stream, 'iteration', 'overall', frontier, iteration=3)
+    main.write_progress(None, 'done', 'overall', frontier)
+    progress = json.loads(stream.getvalue())
+    assert progress['event'] == 'iteration'
+    assert progress['iteration'] == 3
+    assert [node['terminal'] for node in progress['frontier']] == [node[0] for node in frontier]
+
+
+def test_eval_nodes_for_shards():
+    records = read_data.trip_records(make_trips(1000, seed=13))
+    pickups, dropoffs, taxi_times = read_data.trip_store_columns(records)
+    trip_arrays = main.TripArrays(pickups, dropoffs, taxi_times,
+                                  main.build_baseline(t_matrix, station_tree, pickups, dropoffs, taxi_times),
+                                  station_ids)
+    nodes = make_nodes(seed=13)
+    shard_dir = tempfile.mkdtemp()
+    try:
+        assert main.load_shards(shard_dir) is None
+        chunks = read_data.trip_store_chunks(records, 300)
+        shard_paths, n_trips = main.write_shards(chunks, t_matrix, station_tree, shard_dir)
+        assert len(shard_paths) == 4
+        assert n_trips == 1000
+        assert main.load_shards(shard_dir) == (shard_paths, n_trips)
+
+        # partial scores of the shards add up to the scores against every trip
+        expected = main.eval_nodes_for_trips(graph, t_matrix, trip_arrays, nodes)
+        result = main.eval_nodes_for_shards(graph, t_matrix, shard_paths, station_ids, nodes, chunk_size=128)
+        for node, expected_node in zip(result, expected):
+            assert node[0] == expected_node[0]
+            assert_almost_equal(node[2], expected_node[2])
+            assert_almost_equal(node[3], expected_node[3])
+            assert node[4] == expected_node[4]
+        assert main.eval_nodes_for_shards(graph, t_matrix, shard_paths, station_ids, result) == result
+    finally:
+        shutil.rmtree(shard_dir)
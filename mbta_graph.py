@@ -1,12 +1,22 @@
 import argparse
+import cPickle
+import hashlib
 import logging
+import os
 import time
 
 import networkx as nx
+import numpy as np
 import yaml
+from scipy.sparse.csgraph import shortest_path
 
 from constants import *
-from util import latlng_dist, make_latlng
+from util import latlng_dist, make_latlng, write_atomically
+
+try:
+    from yaml import CSafeLoader as YamlLoader  # libyaml, about 10x faster
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 logger = logging.getLogger(__name__)
 
@@ -20,12 +30,25 @@ ORANGE_RATE = 2 / .41  # time from Ruggles to Mass Ave / dist
 SILVER_RATE = 1 / (33.635 / 60)
 
 
+def line_rate(line_name):
+    """ Returns the travel rate (min/km) of a given MBTA line, defaulting to green since it has the most stations """
+    if "Red" in line_name:
+        return RED_RATE
+    elif "Blue" in line_name:
+        return BLUE_RATE
+    elif "Orange" in line_name:
+        return ORANGE_RATE
+    elif "Silver" in line_name:
+        return SILVER_RATE
+    return GREEN_RATE
+
+
 def build_graph(yaml_file):
     # note for later: we'll probably want to get rid of the commuter rail data
     line_dists = []
     overall_start = time.time()
     with open(yaml_file, 'r') as mbta_file:
-        mbta_data = yaml.load(mbta_file)
+        mbta_data = yaml.load(mbta_file, Loader=YamlLoader)
 
         M = nx.Graph()
 
@@ -43,7 +66,7 @@ def build_graph(yaml_file):
         if "Commuter" in lineName:
             break
 
-        print "Building the " + lineName + "..." + "\n"
+        logger.info("Building the %s...", lineName)
         start_time = time.time()
 
         for station in line['stations']:
@@ -76,26 +99,11 @@ def build_graph(yaml_file):
                 dist_sum += dist
                 count += 1
 
-                # default to green, since it has the most stations
-
                 color = line['color']
-
-                min_per_km = GREEN_RATE
-
-                if "Red" in lineName:
-                    min_per_km = RED_RATE
-
-                elif "Blue" in lineName:
+                if "Blue" in lineName:
                     color = '#0000ff'
-                    min_per_km = BLUE_RATE
-
-                elif "Orange" in lineName:
-                    min_per_km = ORANGE_RATE
-
-                elif "Silver" in lineName:
-                    min_per_km = SILVER_RATE
 
-                w = min_per_km * dist
+                w = line_rate(lineName) * dist
 
                 M.add_edge(prev_name, curr_name, {
                     'color': color,
@@ -103,23 +111,133 @@ def build_graph(yaml_file):
                     'len': (1 + dist) / 2
                 })
 
-                print "Edge: {}({}), {}({}), {}min, {}km".format(prev_name, latlng1, curr_name, latlng2, w, dist)
+                logger.debug("Edge: %s(%s), %s(%s), %smin, %skm", prev_name, latlng1, curr_name, latlng2, w, dist)
 
             prev_name = curr_name
 
         line_dists.append(line_dist)
 
         dif = time.time() - start_time
-        print "\nBuilt line in " + str(dif) + "s"
-        print "\n\n"
+        logger.info("Built line in %ss", dif)
 
     overall_dif = time.time() - overall_start
-    print "Imported data and built graph in " + str(overall_dif) + "s\n"
+    logger.info("Imported data and built graph in %ss", overall_dif)
 
     avg_gap = float(dist_sum / count)
     return M, avg_gap
 
 
+def station_index(graph):
+    """ Returns the sorted station names and a mapping of station name -> index into them """
+    station_names = sorted(graph.nodes())
+    return station_names, {name: i for i, name in enumerate(station_names)}
+
+
+def graph_hash(yaml_file):
+    """ Returns a hash of the MBTA data and line rates a graph is built from, used to key cached data """
+    sha = hashlib.sha1()
+    with open(yaml_file, 'rb') as mbta_file:
+        sha.update(mbta_file.read())
+    sha.update(repr((GREEN_RATE, RED_RATE, BLUE_RATE, ORANGE_RATE, SILVER_RATE)))
+    return sha.hexdigest()
+
+
+def station_arrays(graph):
+    """ Returns the sorted station names, an (N, 2) array of their latlngs and a list of the lines of each """
+    station_names, _ = station_index(graph)
+    coords = np.array([graph.node[name]['latlng'] for name in station_names], dtype=np.float64)
+    lines = [list(graph.node[name]['lines']) for name in station_names]
+    return station_names, coords, lines
+
+
+def load_graph(yaml_file, cache_dir=CACHE_DIR):
+    """
+    Returns the graph built from the yaml file, its average gap between stations and its station_arrays.
+    They are cached in cache_dir, keyed by the graph_hash of the yaml file.
+    """
+    cache_path = os.path.join(cache_dir, 'graph-%s.pkl' % graph_hash(yaml_file))
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as cache_file:
+            graph, avg_gap, stations = cPickle.load(cache_file)
+        logger.info('Loaded graph from %s', cache_path)
+        return graph, avg_gap, stations
+
+    graph, avg_gap = build_graph(yaml_file)
+    pickled = cPickle.dumps((graph, avg_gap, station_arrays(graph)), cPickle.HIGHEST_PROTOCOL)
+    write_atomically(cache_path, lambda cache_file: cache_file.write(pickled))
+    logger.info('Cached graph to %s', cache_path)
+    # unpickling rebuilds the node and edge dicts in a different order, returning the unpickled graph keeps
+    # seeded searches reproducible whether or not the cache was hit
+    return cPickle.loads(pickled)
+
+
+def shortest_travel_times(graph, station_names):
+    """ Returns a dense (stations, stations) matrix of the shortest T times between stations, inf if unreachable """
+    adjacency = nx.to_scipy_sparse_matrix(graph, nodelist=station_names, weight='weight')
+    return shortest_path(adjacency, method='D', directed=False)
+
+
+def load_travel_times(graph, yaml_file, cache_dir=CACHE_DIR):
+    """
+    Returns the station names and their shortest T times matrix, see shortest_travel_times.
+    The matrix is cached in cache_dir, keyed by the graph_hash of the yaml file the graph was built from.
+    """
+    station_names, _ = station_index(graph)
+    cache_path = os.path.join(cache_dir, 't_times-%s.npy' % graph_hash(yaml_file))
+
+    if os.path.exists(cache_path):
+        t_matrix = np.load(cache_path)
+        if t_matrix.shape == (len(station_names), len(station_names)):
+            logger.info('Loaded T times from %s', cache_path)
+            return station_names, t_matrix
+        logger.warn('Ignoring T times cache %s of the wrong shape', cache_path)
+
+    t_matrix = shortest_travel_times(graph, station_names)
+    write_atomically(cache_path, lambda cache_file: np.save(cache_file, t_matrix))
+    logger.info('Cached T times to %s', cache_path)
+    return station_names, t_matrix
+
+
+def add_station(graph, t_matrix, station_ids, terminal, latlng, name):
+    """
+    Adds a new station extending a terminal's line to the graph, in place, and its T times to the matrix.
+    A new leaf doesn't change the T times between existing stations, so only its own row and column are computed.
+    :type t_matrix: np.array - (stations, stations) T times, indexed by station_ids
+    :type station_ids: dict[str, int] - station name -> index into the T times matrix
+    :return tuple[np.array, dict[str, int]] - the T times matrix and station ids with the new station last
+    """
+    if name in graph:
+        raise ValueError('Station %s is already in the graph' % name)
+    terminal_data = graph.node[terminal]
+    line_name = terminal_data['lines'][0]
+    dist = latlng_dist(terminal_data['latlng'], latlng)
+    gap = line_rate(line_name) * dist
+
+    graph.add_node(name, {
+        'lat': latlng[0],
+        'long': latlng[1],
+        'latlng': make_latlng(latlng[0], latlng[1]),
+        'lines': [line_name],
+        'shape': 'rect',
+    })
+    edge_data = next((data for _, _, data in graph.edges_iter(terminal, data=True)), {})
+    graph.add_edge(terminal, name, {
+        'color': edge_data.get('color'),
+        'weight': gap,
+        'len': (1 + dist) / 2
+    })
+
+    n = len(t_matrix)
+    new_t_matrix = np.empty((n + 1, n + 1), dtype=t_matrix.dtype)
+    new_t_matrix[:n, :n] = t_matrix
+    # every trip to the new station goes through its terminal
+    new_t_matrix[n, :n] = new_t_matrix[:n, n] = t_matrix[station_ids[terminal]] + gap
+    new_t_matrix[n, n] = 0.
+    new_station_ids = dict(station_ids)
+    new_station_ids[name] = n
+    return new_t_matrix, new_station_ids
+
+
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("-m", "--mbta-yaml",
                     default=MBTA_YAML_PATH, help="YAML file containing MBTA station and line data")
@@ -131,7 +249,7 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     args = parser.parse_args()
 
-    mbta_graph, gap = build_graph(args.mbta_yaml)
+    mbta_graph, gap, _ = load_graph(args.mbta_yaml)
 
     a_graph = nx.nx_agraph.to_agraph(mbta_graph)
     logger.info('Laying out graph')
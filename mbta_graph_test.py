@@ -0,0 +1,97 @@
+# Tests for building the MBTA graph and its T times
+
+import os
+import shutil
+import tempfile
+
+import networkx as nx
+import numpy as np
+from nose.tools import *
+
+import mbta_graph
+from constants import MBTA_YAML_PATH
+
+graph = None
+cache_dir = None
+
+
+def setup_module():
+    global graph, cache_dir
+    graph, _ = mbta_graph.build_graph(MBTA_YAML_PATH)
+    cache_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(cache_dir)
+
+
+def test_line_rate():
+    assert mbta_graph.line_rate('Red Line (main)') == mbta_graph.RED_RATE
+    assert mbta_graph.line_rate('Silver Line (SL1)') == mbta_graph.SILVER_RATE
+    assert mbta_graph.line_rate('Green Line (B)') == mbta_graph.GREEN_RATE
+
+
+def test_station_index():
+    station_names, station_ids = mbta_graph.station_index(graph)
+    assert len(station_names) == len(graph)
+    assert station_names == sorted(station_names)
+    assert all(station_names[station_ids[name]] == name for name in graph)
+
+
+def test_shortest_travel_times():
+    station_names, _ = mbta_graph.station_index(graph)
+    t_matrix = mbta_graph.shortest_travel_times(graph, station_names)
+    t_times = nx.shortest_path_length(graph, weight='weight')
+    for i, from_station in enumerate(station_names):
+        for j, to_station in enumerate(station_names):
+            assert_almost_equal(t_matrix[i, j], t_times[from_station][to_station])
+
+
+def test_load_travel_times():
+    station_names, t_matrix = mbta_graph.load_travel_times(graph, MBTA_YAML_PATH, cache_dir=cache_dir)
+    cache_files = os.listdir(cache_dir)
+    assert cache_files == ['t_times-%s.npy' % mbta_graph.graph_hash(MBTA_YAML_PATH)]
+
+    cached_names, cached_matrix = mbta_graph.load_travel_times(graph, MBTA_YAML_PATH, cache_dir=cache_dir)
+    assert cached_names == station_names
+    assert (cached_matrix == t_matrix).all()
+    assert os.listdir(cache_dir) == cache_files
+
+
+def edges(graph):
+    return sorted((min(u, v), max(u, v), data['weight']) for u, v, data in graph.edges_iter(data=True))
+
+
+def test_load_graph():
+    built_graph, avg_gap, (station_names, coords, lines) = mbta_graph.load_graph(MBTA_YAML_PATH, cache_dir=cache_dir)
+    assert 'graph-%s.pkl' % mbta_graph.graph_hash(MBTA_YAML_PATH) in os.listdir(cache_dir)
+    assert edges(built_graph) == edges(graph)
+    assert station_names == sorted(graph)
+    assert coords.shape == (len(graph), 2)
+    assert (coords[5] == graph.node[station_names[5]]['latlng']).all()
+    assert lines[5] == graph.node[station_names[5]]['lines']
+
+    cached_graph, cached_avg_gap, (cached_names, cached_coords, _) = mbta_graph.load_graph(
+        MBTA_YAML_PATH, cache_dir=cache_dir)
+    assert cached_avg_gap == avg_gap
+    assert edges(cached_graph) == edges(graph)
+    assert cached_names == station_names
+    assert (cached_coords == coords).all()
+
+
+def test_add_station():
+    extended = graph.copy()
+    station_names, station_ids = mbta_graph.station_index(graph)
+    t_matrix = mbta_graph.shortest_travel_times(graph, station_names)
+    latlng = graph.node['Alewife Station']['latlng'] + [0.005, -0.005]
+
+    new_t_matrix, new_station_ids = mbta_graph.add_station(
+        extended, t_matrix, station_ids, 'Alewife Station', latlng, 'Alewife extension')
+    assert 'Alewife extension' not in graph
+    assert extended.neighbors('Alewife extension') == ['Alewife Station']
+    assert new_station_ids['Alewife extension'] == len(station_names)
+    assert_raises(ValueError, mbta_graph.add_station,
+                  extended, new_t_matrix, new_station_ids, 'Alewife Station', latlng, 'Alewife extension')
+
+    expected = mbta_graph.shortest_travel_times(extended, station_names + ['Alewife extension'])
+    assert np.allclose(new_t_matrix, expected)
@@ -0,0 +1,83 @@
+# Instrumentation of a run: wall time and peak memory per phase, counters and per-iteration series,
+# reported as JSON at the end of main
+
+import json
+import logging
+import os
+import resource
+import time
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+phases = OrderedDict()  # phase name -> {'seconds', 'peak_rss_mb', 'rss_growth_mb'}
+counters = defaultdict(int)  # counter name -> count
+series = defaultdict(list)  # series name -> values, e.g. one per beam search iteration
+
+
+def peak_rss_mb():
+    """ Returns the peak resident memory of the process so far, in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # KB on linux
+
+
+@contextmanager
+def phase(name):
+    """ Records the wall time and peak memory of the code run within it """
+    start_rss = peak_rss_mb()
+    start = time.time()
+    try:
+        yield
+    finally:
+        end_rss = peak_rss_mb()
+        phases[name] = {
+            'seconds': time.time() - start,
+            'peak_rss_mb': end_rss,
+            'rss_growth_mb': end_rss - start_rss,  # how much the phase raised the peak
+        }
+        logger.info('%s took %.3fs, peak memory %.1fMB', name, phases[name]['seconds'], end_rss)
+
+
+def count(name, n=1):
+    counters[name] += n
+
+
+def record(name, value):
+    series[name].append(value)
+
+
+def snapshot():
+    """ Returns the counters and series, e.g. to send them from a worker process to be merged """
+    return dict(counters), dict(series)
+
+
+def merge((other_counters, other_series)):
+    """ Adds the counters and series of a snapshot """
+    for name, n in other_counters.iteritems():
+        counters[name] += n
+    for name, values in other_series.iteritems():
+        series[name].extend(values)
+
+
+def reset():
+    phases.clear()
+    counters.clear()
+    series.clear()
+
+
+def report():
+    return {
+        'phases': phases,
+        'counters': dict(counters),
+        'series': dict(series),
+    }
+
+
+def write_report(path):
+    """ Writes the report as JSON """
+    output_dir = os.path.dirname(path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(path, 'w') as report_file:
+        json.dump(report(), report_file, indent=2)
+    logger.info('Wrote metrics to %s', path)
@@ -2,12 +2,31 @@
 
 import argparse
 import calendar
+import cPickle
 import csv
+import heapq
+import itertools
+import multiprocessing
 import os
+import shutil
 import sys
-from datetime import datetime
+import tempfile
+from datetime import date, datetime
+from operator import itemgetter
+
+import numpy as np
 
 from constants import *
+from read_data import TRIP_DTYPE
+
+ROW_OVERHEAD = 400  # estimated bytes of python objects per buffered row, on top of its strings
+WRITE_BATCH_SIZE = 10000  # trips converted to binary records at once
+MERGE_FAN_IN = 64  # sorted runs merged at once, bounds the open files of a streaming join
+OUTPUT_FIELDNAMES = list(set(PREPROCESSED_KEYS.values()))  # columns of the CSV trips, to a file or standard out
+TIME_CACHE_SIZE = 1000000  # parsed time strings to remember, the data is at minute granularity so they repeat a lot
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+time_cache = {}
 
 
 def create_id(trip, pickups_file):
@@ -15,8 +34,8 @@ def create_id(trip, pickups_file):
     return pickups_file + '-' + trip.get('ID', trip.get('TRIP_ID'))
 
 
-def parse_time(time_str):
-    """ Returns an epoch time for quicker parsing, parsing the date as needed"""
+def strptime_time(time_str):
+    """ Returns an epoch time for quicker parsing, parsing the date with strptime """
     if time_str[-1] == 'M':
         dt = datetime.strptime(time_str, PREPROCESSED_12HR_DATE_FORMAT)
     else:
@@ -24,6 +43,48 @@ def parse_time(time_str):
     return calendar.timegm(dt.timetuple())
 
 
+def split_time(time_str):
+    """
+    Returns an epoch time by splitting the fields of the PREPROCESSED_12HR_DATE_FORMAT and
+    PREPROCESSED_24HR_DATE_FORMAT formats directly, falling back to strptime_time for anything else
+    """
+    try:
+        if time_str[-1] == 'M':
+            day_str, clock_str, period = time_str.split(' ')
+            month, day, year = day_str.split('/')
+            hour, minute = map(int, clock_str.split(':'))
+            if len(year) != 2 or not 1 <= hour <= 12 or period not in ('AM', 'PM'):
+                return strptime_time(time_str)
+            year = int(year)
+            year += 2000 if year < 69 else 1900  # same pivot as %y
+            hour = hour % 12 + (12 if period == 'PM' else 0)
+        else:
+            day_str, clock_str = time_str.split(' ')
+            month, day, year = day_str.split('/')
+            hour, minute = map(int, clock_str.split(':'))
+            if len(year) != 4 or not 0 <= hour <= 23:
+                return strptime_time(time_str)
+            year = int(year)
+        if not 0 <= minute <= 59:
+            return strptime_time(time_str)
+        # raises ValueError on invalid dates
+        ordinal = date(year, int(month), int(day)).toordinal()
+    except ValueError:
+        return strptime_time(time_str)
+    return (ordinal - EPOCH_ORDINAL) * 86400 + hour * 3600 + minute * 60
+
+
+def parse_time(time_str):
+    """ Returns an epoch time for quicker parsing, parsing the date as needed"""
+    epoch = time_cache.get(time_str)
+    if epoch is None:
+        epoch = split_time(time_str)
+        if len(time_cache) >= TIME_CACHE_SIZE:
+            time_cache.clear()
+        time_cache[time_str] = epoch
+    return epoch
+
+
 def cross_check_trips(pickups_file, dropoffs_file):
     """ Makes sure all trips have the same pickup and dropoff """
     trips = {}
@@ -65,21 +126,255 @@ def cross_check_trips(pickups_file, dropoffs_file):
     return real_trips
 
 
+def normalize_trip(trip):
+    """ Returns the trip with only the preprocessed keys """
+    return {PREPROCESSED_KEYS[key]: value for key, value in trip.iteritems() if key in PREPROCESSED_KEYS}
+
+
+def write_sorted_runs(csv_file, pickups_file, run_dir, memory_budget):
+    """
+    Splits a CSV file into runs of normalized trips sorted by id, each fitting in the memory budget
+    :type memory_budget: int - bytes of trips to buffer before writing out a run
+    :return list[str] - paths of the run files
+    """
+    run_paths = []
+    buffered = []
+    buffered_size = 0
+
+    def write_run():
+        # stable sort, so trips with the same id stay in file order
+        buffered.sort(key=itemgetter(0))
+        run_path = os.path.join(run_dir, 'run-%d' % len(run_paths))
+        with open(run_path, 'wb') as run_file:
+            for row in buffered:
+                cPickle.dump(row, run_file, cPickle.HIGHEST_PROTOCOL)
+        run_paths.append(run_path)
+        del buffered[:]
+
+    with open(csv_file, 'r') as file:
+        reader = csv.DictReader(file)
+        for seq, trip in enumerate(reader):
+            buffered.append((create_id(trip, pickups_file), seq, normalize_trip(trip)))
+            buffered_size += ROW_OVERHEAD + sum(len(key) + len(value or '') for key, value in trip.iteritems())
+            if buffered_size >= memory_budget:
+                write_run()
+                buffered_size = 0
+    if buffered or not run_paths:
+        write_run()
+    return run_paths
+
+
+def read_run(run_path):
+    """ Yields the (id, seq, trip) rows of a run file """
+    with open(run_path, 'rb') as run_file:
+        while True:
+            try:
+                yield cPickle.load(run_file)
+            except EOFError:
+                return
+
+
+def merge_run_files(run_paths, merged_path):
+    """ Merges sorted run files into one sorted run file """
+    with open(merged_path, 'wb') as merged_file:
+        # (id, seq) keys are unique so trips themselves are never compared
+        for row in heapq.merge(*map(read_run, run_paths)):
+            cPickle.dump(row, merged_file, cPickle.HIGHEST_PROTOCOL)
+
+
+def merge_runs(run_paths, fan_in=MERGE_FAN_IN):
+    """
+    Yields (id, trips) groups from sorted run files, in id order then file order.
+    At most fan_in runs are open at once: while there are more, groups of fan_in runs are first merged into
+    longer runs next to them, which are deleted once merged again.
+    """
+    run_paths = list(run_paths)
+    merged_paths = set()
+    passes = 0
+    while len(run_paths) > fan_in:
+        passes += 1
+        next_paths = []
+        for start in xrange(0, len(run_paths), fan_in):
+            group = run_paths[start:start + fan_in]
+            merged_path = '%s.merged-%d-%d' % (run_paths[0], passes, len(next_paths))
+            merge_run_files(group, merged_path)
+            for run_path in merged_paths.intersection(group):
+                os.remove(run_path)
+            merged_paths.add(merged_path)
+            next_paths.append(merged_path)
+        run_paths = next_paths
+
+    try:
+        merged = heapq.merge(*map(read_run, run_paths))
+        for id, rows in itertools.groupby(merged, key=itemgetter(0)):
+            yield id, [trip for _, _, trip in rows]
+    finally:
+        for run_path in merged_paths.intersection(run_paths):
+            os.remove(run_path)
+
+
+def stream_cross_check_trips(pickups_file, dropoffs_file, memory_budget):
+    """
+    Makes sure all trips have the same pickup and dropoff like cross_check_trips, yielding matched trips
+    as they are found. Both files are sort-merged by id over runs on disk, so memory is bounded by the budget
+    rather than by the size of the files.
+    :type memory_budget: int - bytes of trips to buffer per file
+    """
+    run_dir = tempfile.mkdtemp(prefix='preprocess-')
+    try:
+        print "Sorting pickups file: %s" % pickups_file
+        os.makedirs(os.path.join(run_dir, 'pickups'))
+        pickups = merge_runs(write_sorted_runs(
+            pickups_file, pickups_file, os.path.join(run_dir, 'pickups'), memory_budget))
+
+        print "Sorting dropoffs file: %s" % dropoffs_file
+        os.makedirs(os.path.join(run_dir, 'dropoffs'))
+        dropoffs = merge_runs(write_sorted_runs(
+            dropoffs_file, pickups_file, os.path.join(run_dir, 'dropoffs'), memory_budget))
+
+        count = 0
+        pickup_id, pickup_trips = next(pickups, (None, None))
+        dropoff_id, dropoff_trips = next(dropoffs, (None, None))
+        while pickup_id is not None and dropoff_id is not None:
+            if pickup_id < dropoff_id:
+                pickup_id, pickup_trips = next(pickups, (None, None))
+            elif dropoff_id < pickup_id:
+                dropoff_id, dropoff_trips = next(dropoffs, (None, None))
+            else:
+                # the last pickup with an id wins, updated by its dropoffs in order
+                real_trip = dict(pickup_trips[-1])
+                for dropoff_trip in dropoff_trips:
+                    real_trip.update(dropoff_trip)
+                # Load dates as unix time
+                real_trip['PICKUP_TIME'] = parse_time(real_trip['PICKUP_TIME'])
+                real_trip['DROPOFF_TIME'] = parse_time(real_trip['DROPOFF_TIME'])
+                count += 1
+                yield real_trip
+
+                pickup_id, pickup_trips = next(pickups, (None, None))
+                dropoff_id, dropoff_trips = next(dropoffs, (None, None))
+
+        print "Found %d complete trips" % count
+    finally:
+        shutil.rmtree(run_dir)
+
+
 def write_output(output_path, trips, use_stdout=False, clear_file=True):
-    """ Writes out trips to a CSV file """
+    """ Writes out trips (a dict of trips by id or an iterable of trips) to a CSV file """
     print "%s to %s" % ('Writing' if clear_file else 'Appending', output_path)
     dir = os.path.dirname(output_path)
     if not os.path.exists(dir):
         os.makedirs(dir)
+    if isinstance(trips, dict):
+        trips = trips.itervalues()
     if use_stdout:
-        writer = csv.DictWriter(sys.stdout, fieldnames=PREPROCESSED_KEYS)
+        writer = csv.DictWriter(sys.stdout, fieldnames=OUTPUT_FIELDNAMES)
         if clear_file: writer.writeheader()
-        writer.writerows(trips.itervalues())
+        writer.writerows(trips)
     else:
         with open(output_path, 'wb' if clear_file else 'ab') as output_file:
-            writer = csv.DictWriter(output_file, fieldnames=set(PREPROCESSED_KEYS.values()))
+            writer = csv.DictWriter(output_file, fieldnames=OUTPUT_FIELDNAMES)
             if clear_file: writer.writeheader()
-            writer.writerows(trips.itervalues())
+            writer.writerows(trips)
+
+
+def write_binary_output(output_path, trips, clear_file=True):
+    """
+    Writes out trips (a dict of trips by id or an iterable of trips) as fixed width records to a binary trip store,
+    see read_data.load_trip_store
+    """
+    print "%s to %s" % ('Writing' if clear_file else 'Appending', output_path)
+    dir = os.path.dirname(output_path)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    trips = trips.itervalues() if isinstance(trips, dict) else iter(trips)
+    with open(output_path, 'wb' if clear_file else 'ab') as output_file:
+        while True:
+            batch = list(itertools.islice(trips, WRITE_BATCH_SIZE))
+            if not batch:
+                break
+            records = np.empty(len(batch), dtype=TRIP_DTYPE)
+            for i, trip in enumerate(batch):
+                records[i] = (
+                    (trip['PICKUP_LAT'], trip['PICKUP_LONG']),
+                    (trip['DROPOFF_LAT'], trip['DROPOFF_LONG']),
+                    trip['PICKUP_TIME'],
+                    trip['DROPOFF_TIME'],
+                )
+            records.tofile(output_file)
+
+
+def preprocess_pair(pickups_file, dropoffs_file, output_path, output_format='csv',
+                    use_stdout=False, clear_file=True, memory_budget=None):
+    """ Matches the trips of one pickups and dropoffs file pair and writes them out """
+    if memory_budget:
+        trips = stream_cross_check_trips(pickups_file, dropoffs_file, memory_budget)
+    else:
+        trips = cross_check_trips(pickups_file, dropoffs_file)
+    if output_format == 'binary':
+        write_binary_output(output_path, trips, clear_file=clear_file)
+    else:
+        write_output(output_path, trips, use_stdout=use_stdout, clear_file=clear_file)
+
+
+def preprocess_shard(args):
+    """ Process pool entry point for preprocess_pair """
+    return preprocess_pair(*args)
+
+
+def concatenate_shards(shard_paths, output_file, skip_headers=False):
+    """ Appends shard files to output_file in order, skipping the header line of all but the first if asked """
+    for i, shard_path in enumerate(shard_paths):
+        with open(shard_path, 'rb') as shard:
+            if skip_headers and i > 0:
+                shard.readline()
+            shutil.copyfileobj(shard, output_file)
+
+
+def preprocess(pickups_files, dropoffs_files, output_path, output_format='csv',
+               use_stdout=False, memory_budget=None, jobs=1):
+    """
+    Matches the trips of every pickups and dropoffs file pair and writes them all out to one file.
+    With more than one job, pairs are processed in a process pool, each writing its own shard,
+    and shards are concatenated in pair order so the trips written are the same as processing them one after
+    another. The memory_budget (bytes) is that of the whole run, divided between the jobs.
+    """
+    pairs = zip(pickups_files, dropoffs_files)
+    if jobs <= 1:
+        for i, (pickup, dropoff) in enumerate(pairs):
+            preprocess_pair(pickup, dropoff, output_path, output_format,
+                            use_stdout=use_stdout, clear_file=(i == 0), memory_budget=memory_budget)
+        return
+
+    output_dir = os.path.dirname(output_path)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    shard_dir = tempfile.mkdtemp(prefix='shards-', dir=output_dir)
+    jobs = max(min(jobs, len(pairs)), 1)
+    if memory_budget:
+        memory_budget = max(memory_budget // jobs, 1)
+    try:
+        shard_paths = [os.path.join(shard_dir, 'shard-%d' % i) for i in xrange(len(pairs))]
+        pool = multiprocessing.Pool(jobs)
+        try:
+            pool.map(preprocess_shard, [
+                (pickup, dropoff, shard_path, output_format, False, True, memory_budget)
+                for (pickup, dropoff), shard_path in zip(pairs, shard_paths)
+            ], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        # every CSV shard has its own header
+        skip_headers = output_format != 'binary'
+        print "Concatenating %d shards to %s" % (len(shard_paths), 'standard out' if use_stdout else output_path)
+        if use_stdout:
+            concatenate_shards(shard_paths, sys.stdout, skip_headers=skip_headers)
+        else:
+            with open(output_path, 'wb') as output_file:
+                concatenate_shards(shard_paths, output_file, skip_headers=skip_headers)
+    finally:
+        shutil.rmtree(shard_dir)
 
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -90,7 +385,15 @@ parser.add_argument("-d", "--dropoffs", action='append',
 group = parser.add_mutually_exclusive_group()
 group.add_argument("-O", "--stdout", action="store_true", help="If set, prints output to standard out")
 group.add_argument("-o", "--output",
-                   default=PREPROCESSED_PATH, help="Path of the CSV file to be output")
+                   help="Path of the file to be output, defaults to %s or %s depending on the format" % (
+                       PREPROCESSED_PATH, PREPROCESSED_BINARY_PATH))
+parser.add_argument("-m", "--memory-budget", type=int,
+                    help="If set, joins pickups and dropoffs with a streaming sort-merge on disk, "
+                         "buffering at most this many MB of trips at once, divided between the --jobs")
+parser.add_argument("-j", "--jobs", type=int, default=1,
+                    help="Number of pickups and dropoffs file pairs to process in parallel")
+parser.add_argument("-f", "--format", choices=['csv', 'binary'], default='csv',
+                    help="Output a CSV file or a binary trip store of fixed width records that can be memory mapped")
 
 if __name__ == "__main__":
     args = parser.parse_args()
@@ -100,10 +403,14 @@ if __name__ == "__main__":
         args.pickups = TAXI_PICKUP_PATHS
     if not args.dropoffs:
         args.dropoffs = TAXI_DROPOFF_PATHS
+    if args.format == 'binary' and args.stdout:
+        parser.error('binary output can not be printed to standard out')
+    if not args.output:
+        args.output = PREPROCESSED_BINARY_PATH if args.format == 'binary' else PREPROCESSED_PATH
 
-    for i, (pickup, dropoff) in enumerate(zip(args.pickups, args.dropoffs)):
-        trips = cross_check_trips(pickup, dropoff)
-        write_output(
-            args.output, trips,
-            use_stdout=args.stdout, clear_file=(i == 0),
-        )
+    preprocess(
+        args.pickups, args.dropoffs, args.output,
+        output_format=args.format, use_stdout=args.stdout,
+        memory_budget=args.memory_budget * 1024 * 1024 if args.memory_budget else None,
+        jobs=args.jobs,
+    )
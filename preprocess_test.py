@@ -0,0 +1,144 @@
+# Tests for preprocessing the raw taxi data
+
+import csv
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+
+from nose.tools import *
+
+from preprocess import *
+
+tmp_dir = None
+pickups_file = None
+dropoffs_file = None
+
+
+def write_csv(path, fieldnames, rows):
+    with open(path, 'wb') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def setup_module():
+    global tmp_dir, pickups_file, dropoffs_file
+    tmp_dir = tempfile.mkdtemp()
+    pickups_file = os.path.join(tmp_dir, 'pickups.csv')
+    dropoffs_file = os.path.join(tmp_dir, 'dropoffs.csv')
+
+    pickups = [
+        {'TRIP_ID': str(i), 'PICKUPLAT': str(42 + i / 1000.), 'PICKUPLONG': '-71.06',
+         'PICKUPTIME': '6/%d/12 %d:%02d PM' % (i % 28 + 1, i % 12 + 1, i % 60), 'OTHER': 'x'}
+        for i in xrange(0, 300, 2)
+    ]
+    # a repeated pickup, the last one wins
+    pickups.append(dict(pickups[3], PICKUPLAT='41.5'))
+    dropoffs = [
+        {'TRIP_ID': str(i), 'DROPLAT': str(42.2 + i / 1000.), 'DROPLONG': '-71.1',
+         'DROPTIME': '06/%d/2012 %d:%02d' % (i % 28 + 1, i % 24, i % 60)}
+        for i in reversed(xrange(0, 300, 3))
+    ]
+    write_csv(pickups_file, ['TRIP_ID', 'PICKUPLAT', 'PICKUPLONG', 'PICKUPTIME', 'OTHER'], pickups)
+    write_csv(dropoffs_file, ['TRIP_ID', 'DROPLAT', 'DROPLONG', 'DROPTIME'], dropoffs)
+
+
+def teardown_module():
+    shutil.rmtree(tmp_dir)
+
+
+def test_stream_cross_check_trips():
+    expected = cross_check_trips(pickups_file, dropoffs_file)
+    assert len(expected) == 50
+
+    # a tiny budget so both files are split into many runs
+    trips = list(stream_cross_check_trips(pickups_file, dropoffs_file, memory_budget=2000))
+    assert sorted(trips) == sorted(expected.values())
+
+
+def test_write_sorted_runs():
+    run_dir = os.path.join(tmp_dir, 'runs')
+    os.makedirs(run_dir)
+    run_paths = write_sorted_runs(pickups_file, pickups_file, run_dir, memory_budget=2000)
+    assert len(run_paths) > 10
+    for run_path in run_paths:
+        ids = [id for id, _, _ in read_run(run_path)]
+        assert ids == sorted(ids)
+
+    groups = list(merge_runs(run_paths))
+    assert [id for id, _ in groups] == sorted(create_id({'ID': str(i)}, pickups_file) for i in xrange(0, 300, 2))
+    repeated = dict(groups)[create_id({'ID': '6'}, pickups_file)]
+    assert [trip['PICKUP_LAT'] for trip in repeated] == ['42.006', '41.5']
+
+    # merging a few runs at a time in several passes gives the same groups, and cleans up after itself
+    assert list(merge_runs(run_paths, fan_in=3)) == groups
+    assert sorted(os.listdir(run_dir)) == sorted(os.path.basename(run_path) for run_path in run_paths)
+
+
+def test_write_output_stream():
+    output_path = os.path.join(tmp_dir, 'out', 'trips.csv')
+    write_output(output_path, stream_cross_check_trips(pickups_file, dropoffs_file, memory_budget=2000))
+    with open(output_path, 'rb') as output_file:
+        rows = list(csv.DictReader(output_file))
+    assert len(rows) == 50
+    assert set(rows[0]) == set(PREPROCESSED_KEYS.values())
+
+
+def test_preprocess_jobs():
+    pickups_files = [pickups_file, pickups_file.replace('pickups', 'pickups2')]
+    shutil.copy(pickups_files[0], pickups_files[1])
+    for output_format in ['csv', 'binary']:
+        serial_path = os.path.join(tmp_dir, 'serial-' + output_format, 'trips')
+        parallel_path = os.path.join(tmp_dir, 'parallel-' + output_format, 'trips')
+        preprocess(pickups_files, [dropoffs_file] * 2, serial_path, output_format=output_format)
+        preprocess(pickups_files, [dropoffs_file] * 2, parallel_path, output_format=output_format, jobs=2)
+
+        with open(serial_path, 'rb') as serial_file, open(parallel_path, 'rb') as parallel_file:
+            assert serial_file.read() == parallel_file.read()
+        assert os.listdir(os.path.dirname(parallel_path)) == ['trips']
+
+    # the run's memory budget is split between the jobs
+    serial_path = os.path.join(tmp_dir, 'serial-budget', 'trips')
+    parallel_path = os.path.join(tmp_dir, 'parallel-budget', 'trips')
+    preprocess(pickups_files, [dropoffs_file] * 2, serial_path, memory_budget=2000)
+    preprocess(pickups_files, [dropoffs_file] * 2, parallel_path, memory_budget=2000, jobs=2)
+    with open(serial_path, 'rb') as serial_file, open(parallel_path, 'rb') as parallel_file:
+        assert serial_file.read() == parallel_file.read()
+
+    # standard out gets the same CSV as a file, whatever the jobs
+    stdout = sys.stdout
+    outputs = []
+    for jobs in (1, 2):
+        sys.stdout = StringIO.StringIO()
+        try:
+            preprocess(pickups_files, [dropoffs_file] * 2, os.path.join(tmp_dir, 'stdout', 'trips'),
+                       use_stdout=True, jobs=jobs)
+            outputs.append([line for line in sys.stdout.getvalue().splitlines() if ',' in line])
+        finally:
+            sys.stdout = stdout
+    assert outputs[0] == outputs[1]
+    with open(os.path.join(tmp_dir, 'serial-csv', 'trips'), 'rb') as serial_file:
+        assert outputs[0] == serial_file.read().splitlines()
+
+
+def test_split_time():
+    time_strs = [
+        '6/1/12 12:00 AM', '6/1/12 12:59 PM', '06/01/12 1:05 AM', '12/31/12 11:59 PM', '2/29/12 7:07 PM',
+        '1/1/69 3:00 AM', '1/1/68 3:00 AM', '6/1/2012 0:00', '06/30/2012 23:59', '11/5/2012 12:00', '3/1/2000 9:30',
+    ]
+    for time_str in time_strs:
+        assert split_time(time_str) == strptime_time(time_str), time_str
+    # anything outside the known formats is left to strptime
+    assert_raises(ValueError, split_time, '2/30/12 1:00 PM')
+    assert_raises(ValueError, split_time, '6/1/12 13:00 PM')
+    assert_raises(ValueError, split_time, '6/1/2012 24:00')
+    assert_raises(ValueError, split_time, 'not a time')
+
+
+def test_write_binary_output_list():
+    output_path = os.path.join(tmp_dir, 'list', 'trips.bin')
+    trips = cross_check_trips(pickups_file, dropoffs_file).values()
+    write_binary_output(output_path, trips)
+    assert os.path.getsize(output_path) == len(trips) * TRIP_DTYPE.itemsize
@@ -4,15 +4,29 @@
 
 import csv
 import fileinput
+import itertools
 import logging
+import os
+import random
+import time
+from collections import defaultdict
 
+import numpy as np
 from tqdm import tqdm
 
 from constants import *
-from util import make_latlng
+from util import hour_of_week, make_latlng
 
 logger = logging.getLogger(__name__)
 
+# fixed width record of the binary trip store, 48 bytes per trip
+TRIP_DTYPE = np.dtype([
+    ('pickup', '<f8', (2,)),  # latlng
+    ('dropoff', '<f8', (2,)),  # latlng
+    ('pickup_time', '<i8'),  # epoch seconds
+    ('dropoff_time', '<i8'),  # epoch seconds
+])
+
 
 def parse_row(row):
     """ given a dict from the csv.DictReader, returns a ruple of parsed data """
@@ -33,6 +47,158 @@ def read_csv(input_stream):
     return map(parse_row, iterator)
 
 
+def stratum_key(stratify):
+    """ Returns a function from a pickup epoch time to its stratum: its month, its hour of day, or None """
+    if stratify is None:
+        return lambda pickup_time: None
+    elif stratify == 'month':
+        return lambda pickup_time: time.gmtime(pickup_time).tm_mon
+    elif stratify == 'hour':
+        # epochs were parsed from local times as if they were UTC, so the UTC hour is the local hour
+        return lambda pickup_time: pickup_time // 3600 % 24
+    raise ValueError('Unknown stratification: %s' % stratify)
+
+
+def pickup_strata(pickup_times, stratify):
+    """ Returns the strata of an array of pickup epochs like stratum_key, in a few array operations """
+    pickup_times = np.asarray(pickup_times, dtype=np.int64)
+    if stratify == 'month':
+        # months since 1/1970, to months of the year like tm_mon
+        return pickup_times.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64) % 12 + 1
+    elif stratify == 'hour':
+        return hour_of_week(pickup_times) % 24
+    raise ValueError('Unknown stratification: %s' % stratify)
+
+
+def allocate_sample(counts, k):
+    """
+    Splits a sample of k between strata proportionally to their counts, with the largest remainder method
+    :type counts: dict[stratum, int]
+    :return dict[stratum, int] - sample size of each stratum, adding up to k or the total count if smaller
+    """
+    total = sum(counts.itervalues())
+    if total <= k:
+        return dict(counts)
+    shares = {key: float(k) * count / total for key, count in counts.iteritems()}
+    sizes = {key: int(share) for key, share in shares.iteritems()}
+    by_remainder = sorted(shares, key=lambda key: (sizes[key] - shares[key], key))
+    for key in by_remainder[:k - sum(sizes.itervalues())]:
+        sizes[key] += 1
+    return sizes
+
+
+def reservoir_sample(rows, k, stratum=None, rng=random):
+    """
+    Returns a uniform random sample of k rows in a single pass, keeping at most k rows in memory per stratum
+    :type stratum: function - if given, the sample is stratified by stratum(row), proportionally to the
+     number of rows of each stratum
+    :type rng: random.Random
+    """
+    counts = defaultdict(int)
+    reservoirs = defaultdict(list)
+    for row in rows:
+        key = stratum(row) if stratum else None
+        counts[key] += 1
+        reservoir = reservoirs[key]
+        if len(reservoir) < k:
+            reservoir.append(row)
+        else:
+            # Algorithm R, the row replaces a kept one with probability k / count
+            j = rng.randint(0, counts[key] - 1)
+            if j < k:
+                reservoir[j] = row
+
+    sample = []
+    for key, size in sorted(allocate_sample(counts, k).iteritems()):
+        # a uniform subset of a uniform sample is uniform
+        sample.extend(rng.sample(reservoirs[key], size))
+    return sample
+
+
+def sample_csv(input_stream, k, seed=None, stratify=None):
+    """
+    Reads a uniform random sample of k trips in a single pass, without keeping the other trips in memory
+    :type stratify: str - 'month' or 'hour' (of day) to stratify the sample by the pickup time
+    :return list[trip] - parsed trips like read_csv
+    """
+    reader = csv.DictReader(input_stream)
+    # make sure file is in the right format
+    assert set(reader.fieldnames) == set(PREPROCESSED_KEYS.values())
+    pickup_stratum = stratum_key(stratify)
+    iterator = tqdm(reader, desc='sampling trip input', unit=' trips', mininterval=0.2)
+    sample = reservoir_sample(
+        iterator, k,
+        stratum=lambda row: pickup_stratum(int(row['PICKUP_TIME'])) if stratify else None,
+        rng=random.Random(seed),
+    )
+    return map(parse_row, sample)
+
+
+def load_trip_store(path):
+    """
+    Memory maps a binary trip store written by preprocess.py, without copying it.
+    The pages are shared by every process mapping the same file.
+    :return np.memmap - read only array of TRIP_DTYPE records
+    """
+    size = os.path.getsize(path)
+    assert size % TRIP_DTYPE.itemsize == 0, 'Trip store %s is not made of %s byte records' % (
+        path, TRIP_DTYPE.itemsize)
+    if size == 0:
+        return np.empty(0, dtype=TRIP_DTYPE)  # mmap can't map empty files
+    return np.memmap(path, dtype=TRIP_DTYPE, mode='r')
+
+
+def sample_trip_store(store, k, seed=None, stratify=None):
+    """
+    Returns the sorted indices of a uniform random sample of k trips of a trip store
+    :type stratify: str - 'month' or 'hour' (of day) to stratify the sample by the pickup time
+    """
+    rng = random.Random(seed)
+    if stratify is None:
+        return sorted(rng.sample(xrange(len(store)), min(k, len(store))))
+
+    strata = pickup_strata(store['pickup_time'], stratify)
+    keys, inverse, counts = np.unique(strata, return_inverse=True, return_counts=True)
+    sizes = allocate_sample(dict(enumerate(counts)), k)
+    sample = []
+    for i in xrange(len(keys)):
+        sample.extend(rng.sample(np.flatnonzero(inverse == i), sizes[i]))
+    return sorted(sample)
+
+
+def trip_records(trips):
+    """ Packs parsed trips, see parse_row, into an array of TRIP_DTYPE records """
+    records = np.empty(len(trips), dtype=TRIP_DTYPE)
+    for i, (pickup, dropoff, pickup_time, dropoff_time) in enumerate(trips):
+        records[i] = pickup, dropoff, int(pickup_time), int(dropoff_time)
+    return records
+
+
+def csv_chunks(input_stream, chunk_size):
+    """ Yields the trips of a preprocessed CSV as arrays of up to chunk_size TRIP_DTYPE records, one at a time """
+    reader = csv.DictReader(input_stream)
+    # make sure file is in the right format
+    assert set(reader.fieldnames) == set(PREPROCESSED_KEYS.values())
+    iterator = tqdm(reader, desc='chunking trip input', unit=' trips', mininterval=0.2)
+    while True:
+        chunk = [parse_row(row) for row in itertools.islice(iterator, chunk_size)]
+        if not chunk:
+            break
+        yield trip_records(chunk)
+
+
+def trip_store_chunks(store, chunk_size):
+    """ Yields the trips of a trip store as arrays of up to chunk_size TRIP_DTYPE records, copied out one at a time """
+    for start in xrange(0, len(store), chunk_size):
+        yield np.array(store[start:start + chunk_size])
+
+
+def trip_store_columns(records):
+    """ Returns (trips, 2) arrays of pickup and dropoff latlngs and an array of taxi trip times in minutes """
+    taxi_times = (records['dropoff_time'] - records['pickup_time']) / 60.  # converts seconds to minutes
+    return records['pickup'], records['dropoff'], taxi_times
+
+
 if __name__ == "__main__":
     """ Debug CLI to test file reading. """
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,138 @@
+# Tests for reading preprocessed trip data
+
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from nose.tools import *
+
+import preprocess
+from read_data import *
+
+tmp_dir = None
+
+
+def setup_module():
+    global tmp_dir
+    tmp_dir = tempfile.mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(tmp_dir)
+
+
+trips = {
+    'a-1': {'PICKUP_LAT': '42.35064', 'PICKUP_LONG': '-71.074488', 'DROPOFF_LAT': '42.35468',
+            'DROPOFF_LONG': '-71.059043', 'PICKUP_TIME': 1340113620, 'DROPOFF_TIME': 1340114040, 'ID': '1'},
+    'a-2': {'PICKUP_LAT': '42.361785', 'PICKUP_LONG': '-71.070493', 'DROPOFF_LAT': '42.341617',
+            'DROPOFF_LONG': '-71.068933', 'PICKUP_TIME': 1339717860, 'DROPOFF_TIME': 1339718340, 'ID': '2'},
+}
+
+
+def test_trip_store():
+    path = os.path.join(tmp_dir, 'trips.bin')
+    preprocess.write_binary_output(path, trips)
+    preprocess.write_binary_output(path, {'a-1': trips['a-1']}, clear_file=False)
+    assert os.path.getsize(path) == 3 * 48
+
+    store = load_trip_store(path)
+    assert len(store) == 3
+    expected = trips.values() + [trips['a-1']]
+    for record, trip in zip(store, expected):
+        assert record['pickup'][0] == float(trip['PICKUP_LAT'])
+        assert record['dropoff'][1] == float(trip['DROPOFF_LONG'])
+        assert record['pickup_time'] == trip['PICKUP_TIME']
+
+    pickups, dropoffs, taxi_times = trip_store_columns(store)
+    assert pickups.shape == (3, 2)
+    assert dropoffs.shape == (3, 2)
+    assert list(taxi_times) == [
+        (trip['DROPOFF_TIME'] - trip['PICKUP_TIME']) / 60. for trip in expected]
+
+
+def test_trip_store_empty():
+    path = os.path.join(tmp_dir, 'empty.bin')
+    preprocess.write_binary_output(path, {})
+    assert len(load_trip_store(path)) == 0
+
+
+def test_pickup_strata():
+    pickup_times = np.array([1325376000, 1338508800 + 3599, 1338508800 + 3600, 1356998399, 1356998400])
+    for stratify in ['month', 'hour']:
+        pickup_stratum = stratum_key(stratify)
+        assert list(pickup_strata(pickup_times, stratify)) == [pickup_stratum(t) for t in pickup_times]
+    assert_raises(ValueError, pickup_strata, pickup_times, 'day')
+
+
+def test_allocate_sample():
+    assert allocate_sample({'a': 50, 'b': 30, 'c': 20}, 10) == {'a': 5, 'b': 3, 'c': 2}
+    assert allocate_sample({'a': 1, 'b': 1, 'c': 1}, 2) == {'a': 1, 'b': 1, 'c': 0}
+    assert sum(allocate_sample({'a': 7, 'b': 13, 'c': 29}, 11).values()) == 11
+    assert allocate_sample({'a': 2, 'b': 3}, 10) == {'a': 2, 'b': 3}
+
+
+def test_reservoir_sample():
+    rows = range(1000)
+    sample = reservoir_sample(iter(rows), 100, rng=random.Random(0))
+    assert len(sample) == 100
+    assert len(set(sample)) == 100
+    assert sample == reservoir_sample(iter(rows), 100, rng=random.Random(0))
+    assert sorted(reservoir_sample(iter(rows), 2000)) == rows
+    # roughly uniform
+    assert 300 < np.mean(sample) < 700
+
+    sample = reservoir_sample(iter(rows), 100, stratum=lambda row: row < 200, rng=random.Random(1))
+    assert len(sample) == 100
+    assert len([row for row in sample if row < 200]) == 20
+
+
+def test_sample_csv():
+    path = os.path.join(tmp_dir, 'trips.csv')
+    rows = [dict(trips['a-1'], PICKUP_TIME=1340113620 + i * 3600, DROPOFF_TIME=1340113620 + i * 3600 + 600)
+            for i in xrange(240)]
+    preprocess.write_output(path, rows)
+
+    with open(path, 'rb') as input_stream:
+        sample = sample_csv(input_stream, 48, seed=0, stratify='hour')
+    assert len(sample) == 48
+    # two trips for each hour of the day
+    hours = [int(pickup_time) // 3600 % 24 for _, _, pickup_time, _ in sample]
+    assert sorted(hours) == sorted(range(24) * 2)
+    assert type(sample[0][0]) == np.ndarray
+
+
+def test_sample_trip_store():
+    path = os.path.join(tmp_dir, 'trips-sample.bin')
+    rows = [dict(trips['a-1'], PICKUP_TIME=1338508800 + i * 86400 * 3, DROPOFF_TIME=1338508800 + i * 86400 * 3 + 60)
+            for i in xrange(60)]  # 6 months
+    preprocess.write_binary_output(path, rows)
+    store = load_trip_store(path)
+
+    sample = sample_trip_store(store, 12, seed=0, stratify='month')
+    assert len(sample) == 12 == len(set(sample))
+    assert sample == sorted(sample)
+    months = [time.gmtime(pickup_time).tm_mon for pickup_time in store[sample]['pickup_time']]
+    assert sorted(set(months)) == [6, 7, 8, 9, 10, 11]
+    assert len(sample_trip_store(store, 100, seed=0)) == 60
+
+
+def test_trip_chunks():
+    rows = [dict(trips['a-1'], PICKUP_TIME=1340113620 + i * 60, DROPOFF_TIME=1340113620 + i * 60 + 600)
+            for i in xrange(25)]
+    csv_path = os.path.join(tmp_dir, 'trips-chunks.csv')
+    bin_path = os.path.join(tmp_dir, 'trips-chunks.bin')
+    preprocess.write_output(csv_path, rows)
+    preprocess.write_binary_output(bin_path, rows)
+    store = load_trip_store(bin_path)
+
+    with open(csv_path, 'rb') as input_stream:
+        chunks = list(csv_chunks(input_stream, 10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert np.array_equal(np.concatenate(chunks), store)
+
+    chunks = list(trip_store_chunks(store, 10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert np.array_equal(np.concatenate(chunks), store)
+    assert not isinstance(chunks[0], np.memmap)
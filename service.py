@@ -0,0 +1,236 @@
+#!/bin/env python2
+
+# Long running HTTP/JSON service scoring candidate stops against trips loaded once and kept in memory
+
+import argparse
+import BaseHTTPServer
+import itertools
+import json
+import logging
+import multiprocessing
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+from collections import OrderedDict
+
+from scipy.spatial import cKDTree
+
+import main
+import mbta_graph
+from constants import MBTA_YAML_PATH, NOT_SEEN, SAMPLE_NUM
+from util import build_trip_index, make_latlng, scale_latlng
+
+logger = logging.getLogger(__name__)
+
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8080
+SEARCHES = {'beam': main.beam_search, 'grid': main.grid_search}
+MAX_SEARCHES = 100  # searches kept, the oldest finished ones are forgotten to make room for new ones
+
+# the graph, T times and trips of a pool worker's service, set by init_search_worker
+search_data = {}
+
+
+class RequestError(Exception):
+    """ A request that can't be answered, reported to the client with a 400 """
+    pass
+
+
+def init_search_worker(graph, t_matrix, trip_arrays, trip_index):
+    """ Process pool initializer keeping the data of the worker's own service for its searches """
+    search_data.update(graph=graph, t_matrix=t_matrix, trip_arrays=trip_arrays, trip_index=trip_index)
+
+
+def search_job((search, frontier, seed)):
+    """ Process pool entry point running a search on the search_data of the worker's service """
+    random.seed(seed)
+    return [main.node_json(node) for node in SEARCHES[search](
+        search_data['graph'], search_data['t_matrix'], search_data['trip_arrays'], frontier,
+        trip_index=search_data['trip_index'])]
+
+
+class ScoringService(object):
+    """
+    Scores candidate stops against trips kept in memory, and runs searches in a process pool
+    so they never hold up scoring requests
+    """
+
+    def __init__(self, graph, t_matrix, trip_arrays, trip_index=None, jobs=1, max_searches=MAX_SEARCHES):
+        self.graph = graph
+        self.t_matrix = t_matrix
+        self.trip_arrays = trip_arrays
+        if trip_index is None:
+            trip_index = build_trip_index(trip_arrays.pickups, trip_arrays.dropoffs)
+        self.trip_index = trip_index
+        self.pool = multiprocessing.Pool(jobs, initializer=init_search_worker,
+                                         initargs=(graph, t_matrix, trip_arrays, self.trip_index))
+        self.searches = OrderedDict()  # search id -> AsyncResult, oldest first
+        self.max_searches = max_searches
+        self.search_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def node(self, candidate):
+        """ Returns the unseen node of a {'terminal', 'latlng'} candidate """
+        try:
+            terminal = candidate['terminal']
+            latlng = make_latlng(*candidate['latlng'])
+        except (KeyError, TypeError, ValueError):
+            raise RequestError('Candidates need a terminal and a [lat, lng] latlng: %s' % json.dumps(candidate))
+        if terminal not in self.graph or self.graph.degree(terminal) != 1:
+            raise RequestError('Unknown terminal %s' % terminal)
+        return terminal, latlng, NOT_SEEN, NOT_SEEN, NOT_SEEN
+
+    def score(self, candidates):
+        """ Returns the scores of candidates, evaluated together """
+        if not isinstance(candidates, list):
+            raise RequestError('Candidates must be a list')
+        nodes = [self.node(candidate) for candidate in candidates]
+        return [main.node_json(node) for node in main.eval_nodes_for_trips(
+            self.graph, self.t_matrix, self.trip_arrays, nodes, trip_index=self.trip_index)]
+
+    def start_search(self, terminals=None, search='beam', seed=None):
+        """ Starts a search from terminals, all of them by default, returning its id """
+        if search not in SEARCHES:
+            raise RequestError('Unknown search %s' % search)
+        if terminals is None:
+            terminals = [name for name in self.graph if self.graph.degree(name) == 1]
+        elif not isinstance(terminals, list):
+            raise RequestError('Terminals must be a list')
+        frontier = [self.node({'terminal': terminal, 'latlng': self.graph.node[terminal]['latlng']})
+                    for terminal in terminals]
+        if seed is None:
+            seed = random.randint(0, 2 ** 32 - 1)
+        with self.lock:
+            for finished_id in [search_id for search_id, result in self.searches.iteritems() if result.ready()]:
+                if len(self.searches) < self.max_searches:
+                    break
+                del self.searches[finished_id]
+            if len(self.searches) >= self.max_searches:
+                raise RequestError('Too many searches running, %d at most' % self.max_searches)
+            search_id = str(next(self.search_ids))
+            self.searches[search_id] = self.pool.apply_async(search_job, ((search, frontier, seed),))
+        return search_id
+
+    def search_status(self, search_id):
+        """ Returns the status of a search, with its final frontier once it's done """
+        with self.lock:
+            result = self.searches.get(search_id)
+        if result is None:
+            return None
+        if not result.ready():
+            return {'id': search_id, 'status': 'running'}
+        try:
+            return {'id': search_id, 'status': 'done', 'frontier': result.get()}
+        except Exception as e:
+            return {'id': search_id, 'status': 'failed', 'error': str(e)}
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    GET /status - the number of trips and stations loaded
+    POST /score {"candidates": [{"terminal": ..., "latlng": [lat, lng]}, ...]} - their scores
+    POST /searches {"terminals": [...], "search": "beam" or "grid", "seed": ...} - starts a search, all optional
+    GET /searches/<id> - a search's status, with its final frontier once it's done, until MAX_SEARCHES newer
+        searches were started
+    """
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlparse.urlparse(self.path).path
+        if path == '/status':
+            self.send_json(200, {'trips': len(service.trip_arrays.taxi_times), 'stations': len(service.graph),
+                                 'searches': len(service.searches)})
+        elif path.startswith('/searches/'):
+            status = service.search_status(path[len('/searches/'):])
+            if status is None:
+                self.send_json(404, {'error': 'Unknown search'})
+            else:
+                self.send_json(200, status)
+        else:
+            self.send_json(404, {'error': 'Unknown path %s' % path})
+
+    def do_POST(self):
+        service = self.server.service
+        path = urlparse.urlparse(self.path).path
+        try:
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))) or '{}')
+            except ValueError:
+                raise RequestError('Request body is not JSON')
+            if not isinstance(body, dict):
+                raise RequestError('Request body must be a JSON object')
+            if path == '/score':
+                start = time.time()
+                scores = service.score(body.get('candidates', []))
+                self.send_json(200, {'scores': scores, 'seconds': time.time() - start})
+            elif path == '/searches':
+                search_id = service.start_search(
+                    terminals=body.get('terminals'), search=body.get('search', 'beam'), seed=body.get('seed'))
+                self.send_json(202, {'id': search_id, 'status': 'running'})
+            else:
+                self.send_json(404, {'error': 'Unknown path %s' % path})
+        except RequestError as e:
+            self.send_json(400, {'error': str(e)})
+
+    def send_json(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info(format, *args)
+
+
+class ScoringServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP server answering each request in its own thread """
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.service = service
+
+
+def load_service(seed=None, stratify=None, jobs=1):
+    """ Loads the graph, T times, trips and their baseline like main, returning a ScoringService over them """
+    rng = random.Random(seed)
+    graph, _, (station_names, coords, _) = mbta_graph.load_graph(MBTA_YAML_PATH)
+    pickups, dropoffs, taxi_times, _ = main.load_trips(SAMPLE_NUM, seed=rng.randint(0, 2 ** 32 - 1),
+                                                       stratify=stratify)
+    _, t_matrix = mbta_graph.load_travel_times(graph, MBTA_YAML_PATH)
+    station_ids = {name: i for i, name in enumerate(station_names)}
+    baseline = main.build_baseline(t_matrix, cKDTree(scale_latlng(coords)), pickups, dropoffs, taxi_times)
+    trip_arrays = main.with_trip_points(main.TripArrays(pickups, dropoffs, taxi_times, baseline, station_ids))
+    return ScoringService(graph, t_matrix, trip_arrays, jobs=jobs)
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--host", default=SERVICE_HOST, help="Address to listen on")
+parser.add_argument("-p", "--port", type=int, default=SERVICE_PORT, help="Port to listen on")
+parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of searches to run in parallel")
+parser.add_argument("-s", "--seed", type=int, help="Seed for sampling trips")
+parser.add_argument("--stratify", choices=['month', 'hour'],
+                    help="Stratify the trip sample by the month or hour of day of the pickups")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+
+    service = load_service(seed=args.seed, stratify=args.stratify, jobs=args.jobs)
+    server = ScoringServer((args.host, args.port), service)
+    logger.info('Serving %s trips on http://%s:%s', len(service.trip_arrays.taxi_times), args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
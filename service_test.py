@@ -0,0 +1,158 @@
+# Tests for the scoring service, over a server on a random port
+
+import json
+import threading
+import time
+import urllib2
+
+import numpy as np
+from nose.tools import *
+from scipy.spatial import cKDTree
+
+import benchmark
+import main
+import mbta_graph
+import read_data
+import service
+from constants import MBTA_YAML_PATH
+from util import scale_latlng
+
+graph = None
+scoring_service = None
+server = None
+url = None
+
+
+def make_trip_arrays(t_matrix, num_trips, seed):
+    """ Returns the TripArrays of num_trips synthetic trips """
+    station_names, coords, _ = mbta_graph.station_arrays(graph)
+    pickups, dropoffs, taxi_times = read_data.trip_store_columns(benchmark.generate_trips(num_trips, seed=seed))
+    baseline = main.build_baseline(t_matrix, cKDTree(scale_latlng(coords)), pickups, dropoffs, taxi_times)
+    return main.TripArrays(pickups, dropoffs, taxi_times, baseline, {name: i for i, name in enumerate(station_names)})
+
+
+def setup_module():
+    global graph, scoring_service, server, url
+    graph, _ = mbta_graph.build_graph(MBTA_YAML_PATH)
+    station_names, _, _ = mbta_graph.station_arrays(graph)
+    t_matrix = mbta_graph.shortest_travel_times(graph, station_names)
+    scoring_service = service.ScoringService(graph, t_matrix, make_trip_arrays(t_matrix, 2000, 0))
+    server = service.ScoringServer(('127.0.0.1', 0), scoring_service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def teardown_module():
+    server.shutdown()
+    server.server_close()
+    scoring_service.close()
+
+
+def request(path, body=None):
+    """ Returns the status code and JSON response of a GET, or a POST if there is a body """
+    data = None if body is None else json.dumps(body)
+    try:
+        response = urllib2.urlopen(url + path, data)
+    except urllib2.HTTPError as e:
+        response = e
+    return response.getcode(), json.loads(response.read())
+
+
+def test_status():
+    code, status = request('/status')
+    assert code == 200
+    assert status['trips'] == 2000
+    assert status['stations'] == len(graph)
+
+
+def test_score():
+    latlng = list(graph.node['Dudley Square Station']['latlng'] + [0.004, -0.004])
+    candidates = [{'terminal': 'Dudley Square Station', 'latlng': latlng},
+                  {'terminal': 'Alewife Station', 'latlng': list(graph.node['Alewife Station']['latlng'])}]
+    code, response = request('/score', {'candidates': candidates})
+    assert code == 200
+
+    nodes = [(candidate['terminal'], np.array(candidate['latlng']), -1, -1, -1) for candidate in candidates]
+    expected = main.eval_nodes_for_trips(graph, scoring_service.t_matrix, scoring_service.trip_arrays, nodes)
+    assert [(score['terminal'], score['latlng'], score['T_difs'], score['tot_saved']) for score in response['scores']] \
+        == [(node[0], list(node[1]), node[2], node[4]) for node in expected]
+
+
+def test_score_errors():
+    assert request('/score', {'candidates': [{'terminal': 'Nowhere', 'latlng': [42.3, -71.1]}]})[0] == 400
+    assert request('/score', {'candidates': [{'terminal': 'Alewife Station'}]})[0] == 400
+    assert request('/scores', {})[0] == 404
+
+
+def test_searches():
+    code, response = request('/searches', {'terminals': ['Alewife Station'], 'search': 'grid'})
+    assert code == 202
+    search_id = response['id']
+
+    # scoring isn't held up by the search
+    code, _ = request('/score', {'candidates': [
+        {'terminal': 'Alewife Station', 'latlng': list(graph.node['Alewife Station']['latlng'])}]})
+    assert code == 200
+
+    for _ in xrange(600):
+        code, status = request('/searches/' + search_id)
+        assert code == 200
+        if status['status'] != 'running':
+            break
+        time.sleep(0.1)
+    assert status['status'] == 'done'
+    assert len(status['frontier']) > 0
+    assert all(node['terminal'] == 'Alewife Station' for node in status['frontier'])
+    assert request('/searches/nope')[0] == 404
+    assert request('/searches', {'search': 'dfs'})[0] == 400
+
+
+def test_request_body_errors():
+    assert request('/score', [])[0] == 400
+    assert request('/searches', 1)[0] == 400
+    assert request('/score', {'candidates': 5})[0] == 400
+    assert request('/searches', {'terminals': 'Alewife Station'})[0] == 400
+
+
+class Running(object):
+    """ A search that never finishes """
+
+    def ready(self):
+        return False
+
+
+def test_searches_evicted():
+    searches = service.ScoringService(scoring_service.graph, scoring_service.t_matrix, scoring_service.trip_arrays,
+                                      trip_index=scoring_service.trip_index, max_searches=1)
+    try:
+        searches.searches['running'] = Running()
+        # the only slot is taken by a running search
+        assert_raises(service.RequestError, searches.start_search, terminals=['Alewife Station'], search='grid')
+        del searches.searches['running']
+
+        first = searches.start_search(terminals=['Alewife Station'], search='grid')
+        searches.searches[first].wait()
+        # the finished search is forgotten to make room
+        second = searches.start_search(terminals=['Alewife Station'], search='grid')
+        assert searches.search_status(first) is None
+        assert searches.search_status(second) is not None
+    finally:
+        searches.close()
+
+
+def test_services_independent():
+    other = service.ScoringService(graph, scoring_service.t_matrix, make_trip_arrays(scoring_service.t_matrix, 500, 1))
+    try:
+        started = [(searches, searches.start_search(terminals=['Dudley Square Station'], search='grid', seed=0))
+                   for searches in [scoring_service, other]]
+        frontiers = [searches.searches[search_id].get(60) for searches, search_id in started]
+        # each service searches its own trips
+        assert [node['T_difs'] for node in frontiers[0]] != [node['T_difs'] for node in frontiers[1]]
+    finally:
+        other.close()
+
+    # closing a service leaves the others' data alone
+    search_id = scoring_service.start_search(terminals=['Dudley Square Station'], search='grid', seed=0)
+    assert scoring_service.searches[search_id].get(60) == frontiers[0]
@@ -1,8 +1,12 @@
 # Helper functions
 # All methods here should have tests
 
+import os
+from collections import namedtuple
+
 import numpy as np
 from numpy import sin, cos, radians, arctan2, sqrt  # import from numpy
+from scipy.spatial import cKDTree
 
 from constants import WALKING_LIMIT, INVALID_TRIP
 
@@ -10,6 +14,24 @@ from constants import WALKING_LIMIT, INVALID_TRIP
 cos_factor = abs(cos(radians(42.3601)))
 R = 6371.  # Earth's radius in kilometers
 
+# kd-trees over trip pickups and dropoffs, in the same scaled coordinates as the station kd-tree
+TripIndex = namedtuple('TripIndex', ['pickup_tree', 'dropoff_tree'])
+
+# trips ordered by pickup time and bucketed by hour of the week (0 is Monday midnight), see build_time_index
+# times are the sorted pickup epochs of the trips in order, the trips of hour of the week h are
+# bucket_order[bucket_starts[h]:bucket_starts[h + 1]]
+TimeIndex = namedtuple('TimeIndex', ['times', 'order', 'bucket_order', 'bucket_starts'])
+WEEKDAYS = range(5)  # Monday to Friday
+WEEKEND = [5, 6]
+
+# latlngs in radians with the cosines of their latitudes, precomputed for batches of distances, see geo_points
+GeoPoints = namedtuple('GeoPoints', ['lat', 'lng', 'cos_lat'])
+
+# trips aggregated by origin-destination cell and taxi time bucket, see bin_trips
+# the latlngs and taxi times are the means of the binned trips, weights their counts,
+# bins maps every original trip to its bin and max_error_km is the furthest any endpoint moved
+TripBins = namedtuple('TripBins', ['pickups', 'dropoffs', 'taxi_times', 'weights', 'bins', 'max_error_km'])
+
 
 def make_latlng(lat, lng):
     """ Used to standardize the representation of latitude, longitude coordinates """
@@ -44,6 +66,61 @@ def latlng_dist(loc1, loc2):
     return km
 
 
+def geo_points(latlngs):
+    """
+    Returns the latitudes, longitudes and cosines of latitude, in radians, of latlngs (one or an (N, 2) array),
+    so they are only computed once when the points are used for many distances. GeoPoints are returned as is.
+    """
+    if isinstance(latlngs, GeoPoints):
+        return latlngs
+    latlngs = radians(np.asarray(latlngs, dtype=np.float64))
+    lat, lng = latlngs[..., 0], latlngs[..., 1]
+    return GeoPoints(lat, lng, cos(lat))
+
+
+def geo_dist(lat1, lng1, cos_lat1, lat2, lng2, cos_lat2, approximate=False):
+    """
+    Returns the distances in kilometers between broadcast arrays of points in radians, see latlng_dist.
+    With approximate, uses an equirectangular projection scaled by cos_factor instead of the haversine formula,
+    which is accurate to within 0.5% for points within about 50km of Boston.
+    """
+    if approximate:
+        return R * np.hypot(lat2 - lat1, (lng2 - lng1) * cos_factor)
+    a = sin((lat2 - lat1) / 2) ** 2 + cos_lat1 * cos_lat2 * sin((lng2 - lng1) / 2.0) ** 2
+    return R * 2.0 * arctan2(sqrt(a), sqrt(1.0 - a))
+
+
+def dist_one_to_many(latlng, latlngs, approximate=False):
+    """
+    Returns the distances in kilometers from a latlng to each of the latlngs
+    :type latlng: np.array | GeoPoints - one latlng
+    :type latlngs: np.array | GeoPoints - (N, 2) latlngs
+    :return np.array - (N,) distances
+    """
+    return geo_dist(*geo_points(latlng) + geo_points(latlngs), approximate=approximate)
+
+
+def dist_many_to_many(latlngs1, latlngs2, approximate=False):
+    """
+    Returns the distances in kilometers from each of latlngs1 to each of latlngs2
+    :type latlngs1: np.array | GeoPoints - (N, 2) latlngs
+    :type latlngs2: np.array | GeoPoints - (M, 2) latlngs
+    :return np.array - (N, M) distances
+    """
+    lat1, lng1, cos_lat1 = geo_points(latlngs1)
+    return geo_dist(lat1[:, None], lng1[:, None], cos_lat1[:, None], *geo_points(latlngs2), approximate=approximate)
+
+
+def dist_pairwise(latlngs1, latlngs2, approximate=False):
+    """
+    Returns the distances in kilometers between the rows of latlngs1 and latlngs2
+    :type latlngs1: np.array | GeoPoints - (N, 2) latlngs
+    :type latlngs2: np.array | GeoPoints - (N, 2) latlngs
+    :return np.array - (N,) distances
+    """
+    return geo_dist(*geo_points(latlngs1) + geo_points(latlngs2), approximate=approximate)
+
+
 def closest_stations(stations, station_tree, (lat, lng), max_distance=float('inf'), limit=3):
     """
     Returns closest station according to given parameters
@@ -60,12 +137,184 @@ def closest_stations(stations, station_tree, (lat, lng), max_distance=float('inf
     return zip(filter(lambda d: d != float('inf'), distances), filter(lambda s: s is not None, closest_stations))
 
 
-def is_trip_relevant(trip, new_node, t_old, walking_limit=WALKING_LIMIT):
-    """ determines whether trip could be impacted by this new stop """
-    if t_old[0] == INVALID_TRIP:
+def is_trip_relevant(trip, new_node, valid, walking_limit=WALKING_LIMIT):
+    """
+    determines whether trip could be impacted by this new stop
+    :type trip: tuple - starting with the pickup and dropoff latlngs
+    :type valid: bool - whether the trip has a T itinerary in the baseline
+    """
+    if not valid:
         return False
 
-    from_coord, to_coord, t_start, t_stop = trip
+    from_coord, to_coord = trip[:2]
     terminal, coord, _, _, _ = new_node
 
     return latlng_dist(from_coord, coord) <= walking_limit or latlng_dist(to_coord, coord) <= walking_limit
+
+
+def scale_latlng(coords):
+    """ Returns a copy of latlng coordinates (one or an (N, 2) array) scaled by cos_factor for kd-tree lookups """
+    scaled = np.array(coords, dtype=np.float64)
+    scaled[..., 0] *= cos_factor
+    return scaled
+
+
+def km_to_tree_distance(km):
+    """
+    Returns a distance in scaled kd-tree coordinates covering all points within km kilometers.
+    Lookups with it are a superset, the exact distances still need to be checked with latlng_dist.
+    The 1% slack covers latitudes across the Boston area, where cos(lat) is within 1% of cos_factor.
+    """
+    return 1.01 * km / (R * radians(1.) * cos_factor)
+
+
+def build_trip_index(pickups, dropoffs):
+    """ Builds a TripIndex over (N, 2) arrays of trip pickup and dropoff latlngs """
+    return TripIndex(cKDTree(scale_latlng(pickups)), cKDTree(scale_latlng(dropoffs)))
+
+
+def nearby_trips(trip_index, latlng, max_distance=WALKING_LIMIT):
+    """
+    Returns the sorted indices of trips that may be picked up or dropped off within max_distance km of latlng
+    :type trip_index: TripIndex
+    :return np.array[int] - a superset of the nearby trips, see km_to_tree_distance
+    """
+    point = scale_latlng(latlng)
+    tree_distance = km_to_tree_distance(max_distance)
+    pickups = trip_index.pickup_tree.query_ball_point(point, tree_distance)
+    dropoffs = trip_index.dropoff_tree.query_ball_point(point, tree_distance)
+    return np.union1d(pickups, dropoffs).astype(np.intp)
+
+
+def bin_trips(pickups, dropoffs, taxi_times, cell_size, time_bucket):
+    """
+    Aggregates trips with pickups and dropoffs in the same grid cells and taxi times in the same bucket
+    into one weighted trip. Trips that took no time are binned apart from the others so they stay invalid.
+    :type pickups: np.array - (trips, 2) latlngs
+    :type dropoffs: np.array - (trips, 2) latlngs
+    :type taxi_times: np.array - (trips,) taxi trip times in minutes
+    :type cell_size: float - km, width of the grid cells
+    :type time_bucket: float - minutes, width of the taxi time buckets
+    :return TripBins
+    """
+    lat_size = cell_size / (R * radians(1.))
+    cell_sizes = np.array([lat_size, lat_size / cos_factor])
+    time_keys = np.where(taxi_times == 0, -1, np.floor(taxi_times / time_bucket)).astype(np.int64)
+    keys = np.column_stack((
+        np.floor(pickups / cell_sizes).astype(np.int64),
+        np.floor(dropoffs / cell_sizes).astype(np.int64),
+        time_keys,
+    ))
+    _, bins = np.unique(keys, axis=0, return_inverse=True)
+    weights = np.bincount(bins)
+
+    def bin_means(values):
+        return np.bincount(bins, weights=values, minlength=len(weights)) / weights
+
+    binned_pickups = np.column_stack((bin_means(pickups[:, 0]), bin_means(pickups[:, 1])))
+    binned_dropoffs = np.column_stack((bin_means(dropoffs[:, 0]), bin_means(dropoffs[:, 1])))
+    max_error_km = 0.
+    if len(bins):
+        max_error_km = float(max(
+            dist_pairwise(pickups, binned_pickups[bins]).max(),
+            dist_pairwise(dropoffs, binned_dropoffs[bins]).max(),
+        ))
+    return TripBins(binned_pickups, binned_dropoffs, bin_means(taxi_times), weights, bins, max_error_km)
+
+
+def disk_grid(center, radius, spacing):
+    """
+    Returns the points of a regular grid around a center that are within a radius of it
+    :type center: np.array - latlng
+    :type radius: float - km
+    :type spacing: float - km between neighbouring grid points
+    :return np.array - (points, 2) latlngs, including the center
+    """
+    lat_step = spacing / (R * radians(1.))
+    lng_step = lat_step / cos(radians(center[0]))
+    steps = np.arange(-int(radius // spacing), int(radius // spacing) + 1)
+    lats, lngs = np.meshgrid(center[0] + steps * lat_step, center[1] + steps * lng_step, indexing='ij')
+    grid = np.column_stack((lats.ravel(), lngs.ravel()))
+    return grid[dist_one_to_many(center, grid) <= radius]
+
+
+def hour_of_week(pickup_times):
+    """ Returns the hour of the week of epochs, from 0 on Monday midnight to 167 """
+    # epochs were parsed from local times as if they were UTC, so the UTC hour is the local hour
+    # and 1/1/1970 was a Thursday
+    return (np.asarray(pickup_times) // 3600 + 3 * 24) % (7 * 24)
+
+
+def build_time_index(pickup_times):
+    """ Builds a TimeIndex over an array of trip pickup epochs """
+    order = np.argsort(pickup_times, kind='mergesort')
+    hours = hour_of_week(pickup_times)
+    bucket_order = np.argsort(hours, kind='mergesort')
+    bucket_starts = np.searchsorted(hours[bucket_order], np.arange(7 * 24 + 1))
+    return TimeIndex(np.asarray(pickup_times)[order], order, bucket_order, bucket_starts)
+
+
+def window_trips(time_index, days=None, hours=None, start=None, end=None):
+    """
+    Returns the sorted indices of the trips picked up in a time window
+    :type time_index: TimeIndex
+    :type days: list[int] - days of the week (0 is Monday) of the window, all if None
+    :type hours: list[int] - hours of the day of the window, all if None. Hours past 23 are the early hours of
+        the next day, so that an overnight window belongs to the day it starts on
+    :type start: int - epoch the window starts at, inclusive
+    :type end: int - epoch the window ends at, exclusive
+    """
+    if days is None and hours is None:
+        trip_ids = time_index.order
+    else:
+        buckets = [
+            (day * 24 + hour) % (7 * 24)
+            for day in (range(7) if days is None else days)
+            for hour in (range(24) if hours is None else hours)
+        ]
+        trip_ids = np.concatenate([np.arange(0, dtype=np.intp)] + [
+            time_index.bucket_order[time_index.bucket_starts[bucket]:time_index.bucket_starts[bucket + 1]]
+            for bucket in buckets
+        ])
+    if start is not None or end is not None:
+        first = 0 if start is None else np.searchsorted(time_index.times, start)
+        last = len(time_index.times) if end is None else np.searchsorted(time_index.times, end)
+        trip_ids = np.intersect1d(trip_ids, time_index.order[first:last])
+    return np.sort(trip_ids).astype(np.intp)
+
+
+def parse_window(window):
+    """
+    Parses a time window of the form [days:]hours, e.g. 7-10 (hours 7, 8 and 9 of every day), weekday:16-19 or
+    weekend:22-2 (wrapping around midnight). Days are weekday, weekend or all. The days are those the window
+    starts on, so weekend:22-2 is Saturday and Sunday 22-24 followed by Sunday and Monday 0-2.
+    :return tuple[list[int], list[int]] - the days of the week (0 is Monday) and hours of the day of the window,
+        see window_trips
+    """
+    days, _, hours = window.rpartition(':')
+    if days not in ('', 'all', 'weekday', 'weekend'):
+        raise ValueError('Unknown days %s in window %s' % (days, window))
+    try:
+        first, last = [int(hour) for hour in hours.split('-')]
+    except ValueError:
+        raise ValueError('Window %s hours are not of the form start-end' % window)
+    if not (0 <= first < 24 and 0 <= last <= 24) or first == last:
+        raise ValueError('Window %s hours are not within a day' % window)
+    return (
+        {'': range(7), 'all': range(7), 'weekday': WEEKDAYS, 'weekend': WEEKEND}[days],
+        range(first, last if last > first else last + 24),
+    )
+
+
+def write_atomically(path, write):
+    """
+    Writes a file with write(file) to a temporary file then renames it,
+    so concurrent runs never read a partial file
+    """
+    dir = os.path.dirname(path)
+    if dir and not os.path.exists(dir):
+        os.makedirs(dir)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as tmp_file:
+        write(tmp_file)
+    os.rename(tmp_path, path)
@@ -1,5 +1,8 @@
 # Unit tests for util methods
 
+import shutil
+import tempfile
+
 from nose.tools import *
 from numpy import float64
 from scipy.spatial.ckdtree import cKDTree
@@ -96,20 +99,187 @@ test_trip3 = (make_latlng(42.362132, -71.017792), make_latlng(42.347163, -71.079
 new_station1 = ('Wonderland Station', make_latlng(42.414246, -70.992144), -1, -1, -1)
 new_station2 = ('Bowdoin Station', make_latlng(42.361457, -71.062129), -1, -1, -1)
 
-invalid_T_old = (INVALID_TRIP, None, None)
-T_olds = [
-    (9.023499811512, ('Arlington Station', 0.0003409899177539427),
-     ('Downtown Crossing Station', 0.00015026688104975255)),
-    (9.9532735194938979, ('Arlington Station', 0.00061065985738176785),
-     ('East Berkeley Street Station', 0.00027846932684267488)),
-    (19.471031258881446, ('Terminal B Stop 1', 8.2882292135137069e-05), ('Back Bay Station', 0.00030532469916985785)),
-]
-
 
 def test_is_trip_relevant():
-    assert not is_trip_relevant(test_trip, new_station1, (INVALID_TRIP, None, None))
-    assert not is_trip_relevant(test_trip, new_station2, (INVALID_TRIP, None, None))
-    assert is_trip_relevant(test_trip, new_station1, T_olds[0], walking_limit=8.7)
-    assert not is_trip_relevant(test_trip, new_station1, T_olds[0], walking_limit=8.6)
-    assert is_trip_relevant(test_trip, new_station2, T_olds[1], walking_limit=0.8)
-    assert not is_trip_relevant(test_trip, new_station2, T_olds[1], walking_limit=0.7)
+    assert not is_trip_relevant(test_trip, new_station1, False)
+    assert not is_trip_relevant(test_trip, new_station2, False, walking_limit=8.7)
+    assert is_trip_relevant(test_trip, new_station1, True, walking_limit=8.7)
+    assert not is_trip_relevant(test_trip, new_station1, True, walking_limit=8.6)
+    assert is_trip_relevant(test_trip, new_station2, True, walking_limit=0.8)
+    assert not is_trip_relevant(test_trip, new_station2, True, walking_limit=0.7)
+    assert is_trip_relevant(test_trip[:2], new_station2, True, walking_limit=0.8)
+
+
+def test_scale_latlng():
+    coord = make_latlng(42.35, -71.06)
+    result = scale_latlng(coord)
+    assert_almost_equal(result[0], 42.35 * cos_factor)
+    assert_almost_equal(result[1], -71.06)
+    assert coord[0] == 42.35
+
+    result = scale_latlng(np.array([[42.35, -71.06], [42.4, -71.1]]))
+    assert result.shape == (2, 2)
+    assert_almost_equal(result[1, 0], 42.4 * cos_factor)
+
+
+def test_km_to_tree_distance():
+    # points due east, north and diagonal of the Boston area are within the tree distance of their km distance
+    for lat in [42.2, 42.36, 42.5]:
+        origin = make_latlng(lat, -71.06)
+        for d_lat, d_lng in [(0, 1), (1, 0), (1, 1), (-1, 1)]:
+            point = make_latlng(lat + d_lat * .004, -71.06 + d_lng * .006)
+            tree_dist = np.linalg.norm(scale_latlng(point) - scale_latlng(origin))
+            assert tree_dist <= km_to_tree_distance(latlng_dist(origin, point))
+
+
+def test_nearby_trips():
+    pickups = np.array([[42.35, -71.06], [42.36, -71.06], [42.45, -71.06]])
+    dropoffs = np.array([[42.45, -71.16], [42.45, -71.16], [42.352, -71.061]])
+    trip_index = build_trip_index(pickups, dropoffs)
+
+    result = nearby_trips(trip_index, make_latlng(42.35, -71.06), max_distance=0.5)
+    assert list(result) == [0, 2]
+    result = nearby_trips(trip_index, make_latlng(42.35, -71.06), max_distance=1.5)
+    assert list(result) == [0, 1, 2]
+    result = nearby_trips(trip_index, make_latlng(42.0, -71.0))
+    assert len(result) == 0
+    assert result.dtype == np.intp
+
+
+def test_bin_trips():
+    pickups = np.array([[42.35, -71.06], [42.35001, -71.06001], [42.35, -71.06], [42.36, -71.06], [42.35, -71.06]])
+    dropoffs = np.array([[42.37, -71.1], [42.37, -71.1], [42.37, -71.1], [42.37, -71.1], [42.37, -71.1]])
+    taxi_times = np.array([10., 10.5, 12., 10., 0.])
+
+    trip_bins = bin_trips(pickups, dropoffs, taxi_times, cell_size=0.05, time_bucket=1)
+    assert len(trip_bins.weights) == 4
+    assert trip_bins.weights.sum() == 5
+    # the first two trips share a bin, the others are a different time, cell or took no time
+    assert trip_bins.bins[0] == trip_bins.bins[1]
+    assert len(set(trip_bins.bins[1:])) == 4
+    assert trip_bins.weights[trip_bins.bins[0]] == 2
+    assert trip_bins.taxi_times[trip_bins.bins[0]] == 10.25
+    assert trip_bins.taxi_times[trip_bins.bins[4]] == 0
+    assert_almost_equal(trip_bins.pickups[trip_bins.bins[0]][0], 42.350005)
+    assert 0 < trip_bins.max_error_km < 0.05 * np.sqrt(2)
+
+    trip_bins = bin_trips(pickups, dropoffs, taxi_times, cell_size=5, time_bucket=5)
+    assert trip_bins.bins[0] == trip_bins.bins[1] == trip_bins.bins[2]
+    assert trip_bins.weights[trip_bins.bins[4]] == 1
+    assert trip_bins.max_error_km < 5 * np.sqrt(2)
+
+
+def test_disk_grid():
+    center = make_latlng(42.35, -71.06)
+    grid = disk_grid(center, 1., 0.1)
+    dists = latlng_dist((grid[:, 0], grid[:, 1]), center)
+    assert (dists <= 1.).all()
+    assert dists.min() == 0
+    # about pi * 10 ** 2 points, about 0.1km apart
+    assert 300 < len(grid) < 330
+    assert_almost_equal(np.sort(dists)[1], 0.1, places=3)
+    assert len(disk_grid(center, 0.05, 0.1)) == 1
+
+
+def test_geo_points():
+    points = geo_points([[42.35, -71.06], [0., 90.]])
+    assert_almost_equal(points.lat[0], np.radians(42.35))
+    assert_almost_equal(points.lng[1], np.pi / 2)
+    assert_almost_equal(points.cos_lat[1], 1.)
+    assert geo_points(points) is points
+
+
+def test_batch_distances():
+    rng = np.random.RandomState(0)
+    latlngs1 = rng.normal((42.35, -71.06), 0.05, size=(20, 2))
+    latlngs2 = rng.normal((42.35, -71.06), 0.05, size=(30, 2))
+    expected = np.array([[latlng_dist(a, b) for b in latlngs2] for a in latlngs1])
+
+    result = dist_many_to_many(latlngs1, latlngs2)
+    assert result.shape == (20, 30)
+    assert np.allclose(result, expected, rtol=1e-12)
+    assert np.allclose(dist_one_to_many(latlngs1[3], latlngs2), expected[3], rtol=1e-12)
+    assert np.allclose(dist_one_to_many(latlngs1[3], geo_points(latlngs2)), expected[3], rtol=1e-12)
+    assert np.allclose(dist_pairwise(latlngs1, latlngs2[:20]), expected[np.arange(20), np.arange(20)], rtol=1e-12)
+
+    # the approximation is within metro-scale error
+    approximate = dist_many_to_many(latlngs1, latlngs2, approximate=True)
+    assert np.allclose(approximate, expected, rtol=5e-3)
+    assert np.allclose(dist_pairwise(latlngs1, latlngs2[:20], approximate=True),
+                       expected[np.arange(20), np.arange(20)], rtol=5e-3)
+    assert_almost_equal(
+        dist_one_to_many(make_latlng(42.43156, -71.11124), [[42.429276, -71.189149]], approximate=True)[0],
+        6.401, delta=6.401 * 5e-3)
+
+
+def test_hour_of_week():
+    # 6/4/2012 was a Monday
+    assert hour_of_week(1338768000) == 0
+    assert hour_of_week(1338768000 + 3599) == 0
+    assert list(hour_of_week(np.array([1338768000 + 3600 * 25, 1338768000 - 1]))) == [25, 167]
+
+
+def test_window_trips():
+    monday = 1338768000
+    pickup_times = np.array([
+        monday + 3600 * 8,  # Monday 8am
+        monday + 3600 * 18,  # Monday 6pm
+        monday + 3600 * (5 * 24 + 8) + 120,  # Saturday 8am
+        monday + 3600 * (7 * 24 + 8) + 60,  # next Monday 8am
+        monday + 3600 * 23,  # Monday 11pm
+    ])
+    time_index = build_time_index(pickup_times)
+    assert list(time_index.times) == sorted(pickup_times)
+
+    assert list(window_trips(time_index)) == range(5)
+    assert list(window_trips(time_index, hours=[8])) == [0, 2, 3]
+    assert list(window_trips(time_index, days=WEEKDAYS, hours=[8, 9])) == [0, 3]
+    assert list(window_trips(time_index, days=WEEKEND)) == [2]
+    assert list(window_trips(time_index, hours=[8], start=monday + 3600 * 24)) == [2, 3]
+    assert list(window_trips(time_index, end=monday + 3600 * 19)) == [0, 1]
+    assert window_trips(time_index, hours=[3]).dtype == np.intp
+
+
+def test_parse_window():
+    assert parse_window('7-10') == (range(7), [7, 8, 9])
+    assert parse_window('weekday:16-19') == (WEEKDAYS, [16, 17, 18])
+    assert parse_window('weekend:22-2') == (WEEKEND, [22, 23, 24, 25])
+    assert parse_window('all:0-24') == (range(7), range(24))
+    assert_raises(ValueError, parse_window, 'holiday:7-10')
+    assert_raises(ValueError, parse_window, '7')
+    assert_raises(ValueError, parse_window, '7-7')
+    assert_raises(ValueError, parse_window, '7-25')
+
+
+def test_parse_window_overnight():
+    monday = 1338768000
+    pickup_times = np.array([
+        monday + 3600 * (4 * 24 + 23),  # Friday 11pm
+        monday + 3600 * (5 * 24 + 1),  # Saturday 1am, Friday night
+        monday + 3600 * (5 * 24 + 23),  # Saturday 11pm
+        monday + 3600 * (6 * 24 + 1),  # Sunday 1am, Saturday night
+        monday + 3600 * (7 * 24 + 1),  # Monday 1am, Sunday night
+        monday + 3600 * (7 * 24 + 3),  # Monday 3am
+    ])
+    time_index = build_time_index(pickup_times)
+
+    # the early hours belong to the night the window starts on
+    assert list(window_trips(time_index, *parse_window('weekend:22-2'))) == [2, 3, 4]
+    assert list(window_trips(time_index, *parse_window('weekday:22-2'))) == [0, 1]
+    assert list(window_trips(time_index, *parse_window('22-2'))) == [0, 1, 2, 3, 4]
+
+
+def test_write_atomically():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'nested', 'file.txt')
+        write_atomically(path, lambda out: out.write('first'))
+        write_atomically(path, lambda out: out.write('second'))
+        with open(path) as written:
+            assert written.read() == 'second'
+        # a failed write leaves the previous file
+        assert_raises(ValueError, write_atomically, path, lambda out: int('not a number'))
+        with open(path) as written:
+            assert written.read() == 'second'
+    finally:
+        shutil.rmtree(tmp_dir)